@@ -0,0 +1,111 @@
+"""
+Benchmark of ConcurrentMidiNoteQueue against a MidiNoteQueue protected by a lock.
+
+A producer thread pushes note messages (as the callback of a midi backend) while a consumer
+thread parses the melody every 256 messages. For each queue, the throughput of the producer
+and the latency percentiles of its push calls are reported: with the lock, a push waits
+for the parsing in progress on the consumer thread.
+
+usage: python benchmarks/bench_concurrent_queue.py
+"""
+import statistics
+import threading
+import time
+from melodically import ConcurrentMidiNoteQueue, MidiNoteQueue, get_durations, parse_melody
+
+
+def generate_messages(n_notes):
+    messages = []
+    for i in range(n_notes):
+        note = 48 + (i * 7) % 36
+        messages.append(('note_on', note, 1.0 + i * 0.25))
+        messages.append(('note_off', note, 1.2 + i * 0.25))
+    return messages
+
+
+class LockedQueue:
+    """
+    Baseline: a MidiNoteQueue with a lock around every push and every parsing.
+    """
+
+    def __init__(self):
+        self.queue = MidiNoteQueue()
+        self.lock = threading.Lock()
+
+    def push(self, msg_type, note, timestamp):
+        with self.lock:
+            self.queue.push(msg_type, note, timestamp)
+        return True
+
+    def parse(self, durations, force=False):
+        with self.lock:
+            if force or len(self.queue.get_container()) >= 256:
+                parse_melody(self.queue, 'CM', durations)
+                self.queue.clear()
+
+
+class ConcurrentQueue:
+    def __init__(self):
+        self.queue = ConcurrentMidiNoteQueue(capacity=4096)
+
+    def push(self, msg_type, note, timestamp):
+        return self.queue.push(msg_type, note, timestamp)
+
+    def parse(self, durations, force=False):
+        # the note held during the parsing stays in the ring queue until its note_off
+        midi_queue = self.queue.snapshot() if force else self.queue.snapshot_closed()
+        if force or len(midi_queue.get_container()) >= 256:
+            parse_melody(midi_queue, 'CM', durations)
+            midi_queue.clear()
+
+
+def run(queue, messages):
+    """
+    Runs the producer and the consumer threads.
+
+    :param queue: LockedQueue or ConcurrentQueue
+    :param messages: messages pushed by the producer
+    :return: (producer throughput in messages per second, list of push latencies in seconds)
+    """
+    latencies = []
+    done = threading.Event()
+    durations = get_durations(120)
+
+    def produce():
+        clock = time.perf_counter
+        for msg in messages:
+            start = clock()
+            while not queue.push(*msg):
+                time.sleep(0)
+            latencies.append(clock() - start)
+        done.set()
+
+    def consume():
+        while not done.is_set():
+            queue.parse(durations)
+        queue.parse(durations, force=True)
+
+    producer = threading.Thread(target=produce)
+    consumer = threading.Thread(target=consume)
+    start = time.perf_counter()
+    consumer.start()
+    producer.start()
+    producer.join()
+    elapsed = time.perf_counter() - start
+    consumer.join()
+    return len(messages) / elapsed, latencies
+
+
+def main():
+    messages = generate_messages(50000)
+    print('{:>12} {:>14} {:>12} {:>12} {:>12}'.format('queue', 'messages/s', 'p50 [us]', 'p99 [us]', 'max [us]'))
+    for name, queue_class in [('locked', LockedQueue), ('concurrent', ConcurrentQueue)]:
+        throughput, latencies = run(queue_class(), messages)
+        latencies.sort()
+        print('{:>12} {:>14.0f} {:>12.2f} {:>12.2f} {:>12.2f}'.format(
+            name, throughput, statistics.median(latencies) * 1e6,
+            latencies[int(len(latencies) * 0.99)] * 1e6, latencies[-1] * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Benchmark of the cold start of melodically.
+
+Each measure runs in a new interpreter: the import of the package, the import
+followed by midi_to_std (that doesn't need any table), by a chord lookup (that
+doesn't need numpy) and by the first use of all the tables, built from scratch
+or loaded from a cache file (see melodically.tables.save_tables).
+
+usage: python benchmarks/bench_import.py [repetitions]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import statistics
+
+_snippets = {
+    'import': 'import melodically',
+    'import + midi_to_std': 'import melodically; melodically.midi_to_std(60)',
+    'import + chord lookup': 'import melodically; melodically.parse_musical_note("E", "CM")',
+    'import + tables': 'import melodically; melodically.parse_musical_note("E", "CM"); '
+                       'melodically.HarmonicState().get_mode_notes()',
+}
+
+
+def measure(snippet, environment, repetitions):
+    """
+    Measures the median time in seconds needed to run a snippet in a new interpreter.
+
+    :param snippet: python code
+    :param environment: environment variables of the interpreter
+    :param repetitions: number of runs
+    :return: median time in seconds
+    """
+    code = 'import time; _start = time.perf_counter(); {}; print(time.perf_counter() - _start)'.format(snippet)
+    times = []
+    for _ in range(repetitions):
+        output = subprocess.run([sys.executable, '-c', code], env=environment, check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout
+        times.append(float(output))
+    return statistics.median(times)
+
+
+def main():
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    environment = dict(os.environ)
+    with tempfile.TemporaryDirectory() as directory:
+        cache_path = os.path.join(directory, 'tables.npz')
+        subprocess.run([sys.executable, '-c', 'import melodically.tables as t; import melodically; '
+                                              't.save_tables({!r})'.format(cache_path)], env=environment, check=True)
+        print('{:<30} {:>12}'.format('snippet', 'median [ms]'))
+        for name, snippet in _snippets.items():
+            print('{:<30} {:>12.1f}'.format(name, measure(snippet, environment, repetitions) * 1000))
+        environment['MELODICALLY_TABLES'] = cache_path
+        name = 'import + tables (cache file)'
+        print('{:<30} {:>12.1f}'.format(name, measure(_snippets['import + tables'], environment, repetitions) * 1000))
+
+
+if __name__ == '__main__':
+    main()
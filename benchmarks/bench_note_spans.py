@@ -0,0 +1,75 @@
+"""
+Benchmark of the note pairing step used by parse_rhythm and parse_melody.
+
+The linear pairing of get_note_spans is compared with the previous
+forward scan (quadratic when notes are held across many others),
+on synthetic takes from 1k to 1M messages.
+
+usage: python benchmarks/bench_note_spans.py
+"""
+import time
+from melodically import MidiNoteQueue, get_note_spans
+
+
+def generate_queue(n_messages, held_every=100):
+    """
+    Builds a MidiNoteQueue containing a melody where, every held_every notes,
+    a note is held until the end of the take (as with a pedal tone).
+
+    :param n_messages: approximate number of messages in the queue
+    :param held_every: interval in notes between two held notes
+    :return: MidiNoteQueue object
+    """
+    midi_queue = MidiNoteQueue()
+    timestamp = 1.0
+    held = []
+    for i in range(n_messages // 2):
+        note = 48 + i % 36
+        timestamp = timestamp + 0.1
+        midi_queue.push('note_on', note, timestamp)
+        if i % held_every == 0 and note not in held:
+            held.append(note)
+        elif note not in held:
+            midi_queue.push('note_off', note, timestamp + 0.05)
+    for note in held:
+        timestamp = timestamp + 0.1
+        midi_queue.push('note_off', note, timestamp)
+    return midi_queue
+
+
+def forward_scan_pairing(midi_queue):
+    """
+    Pairing step of the previous parse_rhythm implementation.
+
+    :param midi_queue: MidiNoteQueue object
+    :return: list of (onset, offset, pitch) tuples
+    """
+    container = midi_queue.get_container()
+    spans = []
+    for i in range(len(container)):
+        if container[i]['type'] == 'note_on':
+            j = i + 1
+            while not (container[j]['type'] == 'note_off' and container[j]['note'] == container[i]['note']):
+                j = j + 1
+            spans.append((container[i]['timestamp'], container[j]['timestamp'], container[i]['note']))
+    return spans
+
+
+def measure(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    print('{:>10} {:>14} {:>14}'.format('messages', 'linear [s]', 'scan [s]'))
+    for n_messages in [1000, 10000, 100000, 1000000]:
+        midi_queue = generate_queue(n_messages)
+        linear_time = measure(get_note_spans, midi_queue)
+        # the forward scan is too slow on the longest takes
+        scan_time = measure(forward_scan_pairing, midi_queue) if n_messages <= 10000 else float('nan')
+        print('{:>10} {:>14.4f} {:>14.4f}'.format(len(midi_queue.get_container()), linear_time, scan_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Benchmark of parse_melody on large inputs.
+
+The integer core (pitch classes and 12-bit chord masks) is compared with
+the string based classification of the notes (membership tests on the
+lists of chord_tones).
+
+usage: python benchmarks/bench_parse_melody.py
+"""
+import time
+from melodically import MidiNoteQueue, chord_tones, get_durations, get_note_spans, midi_to_std, parse_melody, \
+    parse_rhythm
+
+
+def generate_queue(n_notes):
+    """
+    Builds a MidiNoteQueue containing a monophonic melody with rests.
+
+    :param n_notes: number of notes
+    :return: MidiNoteQueue object
+    """
+    midi_queue = MidiNoteQueue()
+    timestamp = 1.0
+    for i in range(n_notes):
+        note = 48 + (i * 7) % 36
+        midi_queue.push('note_on', note, timestamp)
+        timestamp = timestamp + 0.25 * (1 + i % 3)
+        midi_queue.push('note_off', note, timestamp)
+        timestamp = timestamp + (0.25 if i % 5 == 0 else 0)
+    return midi_queue
+
+
+def string_parse_melody(midi_queue, chord, rhythmical_durations):
+    """
+    parse_melody classifying the notes with string comparisons.
+    """
+    rhythmic_symbols = parse_rhythm(midi_queue, rhythmical_durations)
+    notes = [midi_to_std(p) for p in get_note_spans(midi_queue)['pitch'].tolist()]
+    note_count = 0
+    result = []
+    for symbol in rhythmic_symbols:
+        if 'r' not in symbol:
+            note = notes[note_count]
+            if note in chord_tones[chord]['c']:
+                symbol = 'c' + symbol
+            elif note in chord_tones[chord]['l']:
+                symbol = 'l' + symbol
+            else:
+                symbol = 'x' + symbol
+            note_count = note_count + 1
+        result.append(symbol)
+    return result
+
+
+def measure(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    durations = get_durations(120)
+    print('{:>10} {:>14} {:>14}'.format('notes', 'integer [s]', 'string [s]'))
+    for n_notes in [1000, 10000, 100000, 1000000]:
+        midi_queue = generate_queue(n_notes)
+        integer_time = measure(parse_melody, midi_queue, 'Dm', durations)
+        string_time = measure(string_parse_melody, midi_queue, 'Dm', durations)
+        print('{:>10} {:>14.4f} {:>14.4f}'.format(n_notes, integer_time, string_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Benchmark of parse_melody_batch on bursts of short phrases.
+
+A burst of phrases is parsed calling parse_melody on each of them,
+with a single parse_melody_batch call, and with parse_melody_batch on a thread pool.
+
+usage: python benchmarks/bench_parse_melody_batch.py
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from melodically import MidiNoteQueue, get_durations, parse_melody, parse_melody_batch
+
+chords = ['CM', 'Dm', 'G7', 'Am', 'Bdim']
+
+
+def generate_jobs(n_phrases, n_notes=16):
+    """
+    Builds a list of (midi_queue, chord, durations) jobs with short phrases.
+
+    :param n_phrases: number of phrases
+    :param n_notes: notes of each phrase
+    :return: list of jobs
+    """
+    durations = [get_durations(bpm) for bpm in (90, 120, 140)]
+    jobs = []
+    for p in range(n_phrases):
+        midi_queue = MidiNoteQueue()
+        timestamp = 1.0
+        for i in range(n_notes):
+            note = 48 + (i * 7 + p) % 36
+            midi_queue.push('note_on', note, timestamp)
+            timestamp = timestamp + 0.25 * (1 + (i + p) % 3)
+            midi_queue.push('note_off', note, timestamp)
+            timestamp = timestamp + (0.25 if i % 5 == 0 else 0)
+        jobs.append((midi_queue, chords[p % len(chords)], durations[p % len(durations)]))
+    return jobs
+
+
+def measure(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    print('{:>10} {:>14} {:>14} {:>14}'.format('phrases', 'single [s]', 'batch [s]', 'threads [s]'))
+    with ThreadPoolExecutor(4) as executor:
+        for n_phrases in [100, 1000, 10000]:
+            jobs = generate_jobs(n_phrases)
+            single_time = measure(lambda: [parse_melody(*job) for job in jobs])
+            batch_time = measure(parse_melody_batch, jobs)
+            thread_time = measure(parse_melody_batch, jobs, executor, 256)
+            print('{:>10} {:>14.4f} {:>14.4f} {:>14.4f}'.format(n_phrases, single_time, batch_time, thread_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+"""
+Benchmark suite of the hot paths of melodically.
+
+Every benchmark runs on synthetic workloads of increasing size; the best time of
+some repetitions is written in a JSON file and compared with a stored baseline,
+flagging the benchmarks slower than the baseline by more than a threshold.
+
+usage: python benchmarks/suite.py [--quick] [--filter NAME] [--repetitions N]
+                                  [--output results.json] [--baseline benchmarks/baseline.json]
+                                  [--threshold 1.5] [--save-baseline]
+
+The exit status is 1 when a regression is found.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+_default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+_sizes = [100, 1000, 10000, 100000, 1000000]
+
+
+def generate_messages(n_events, unclosed_every=0):
+    """
+    Generates the messages of a monophonic melody with rests.
+
+    :param n_events: number of messages
+    :param unclosed_every: if not 0, a note every unclosed_every notes has no note_off
+    :return: list of (msg_type, note, timestamp)
+    """
+    messages = []
+    timestamp = 1.0
+    for i in range(n_events // 2):
+        note = 48 + (i * 7) % 36
+        messages.append(('note_on', note, timestamp))
+        timestamp = timestamp + 0.25 * (1 + i % 3)
+        if not unclosed_every or i % unclosed_every:
+            messages.append(('note_off', note, timestamp))
+        timestamp = timestamp + (0.25 if i % 5 == 0 else 0.07)
+    return messages
+
+
+def fill_queue(queue, messages):
+    for msg_type, note, timestamp in messages:
+        queue.push(msg_type, note, timestamp)
+    return queue
+
+
+def bench_queue_push(m, size):
+    messages = generate_messages(size)
+    return lambda: fill_queue(m.MidiNoteQueue(), messages)
+
+
+def bench_compact_queue_push(m, size):
+    messages = generate_messages(size)
+    return lambda: fill_queue(m.CompactMidiNoteQueue(), messages)
+
+
+def bench_concurrent_queue_push(m, size):
+    messages = generate_messages(size)
+
+    def run():
+        concurrent_queue = m.ConcurrentMidiNoteQueue(capacity=size)
+        fill_queue(concurrent_queue, messages)
+        concurrent_queue.snapshot()
+    return run
+
+
+def bench_queue_pop(m, size):
+    queue = fill_queue(m.MidiNoteQueue(), generate_messages(size))
+    container = list(queue.get_container())
+
+    def run():
+        queue.get_container()[:] = container
+        for _ in range(len(container)):
+            queue.pop()
+    return run
+
+
+def bench_clean_unclosed_note_ons(m, size):
+    messages = generate_messages(size, unclosed_every=50)
+    queues = []
+
+    def run():
+        # a new queue for each repetition, built before the measure
+        queues.pop().clean_unclosed_note_ons()
+    run.prepare = lambda: queues.append(fill_queue(m.MidiNoteQueue(), messages))
+    return run
+
+
+def bench_parse_rhythm(m, size):
+    queue = fill_queue(m.MidiNoteQueue(), generate_messages(size))
+    durations = m.get_durations(120)
+    return lambda: m.parse_rhythm(queue, durations)
+
+
+def bench_parse_melody(m, size):
+    queue = fill_queue(m.MidiNoteQueue(), generate_messages(size))
+    durations = m.get_durations(120)
+    return lambda: m.parse_melody(queue, 'Dm', durations)
+
+
+def bench_parse_melody_compact(m, size):
+    queue = fill_queue(m.CompactMidiNoteQueue(), generate_messages(size))
+    durations = m.get_durations(120)
+    return lambda: m.parse_melody(queue, 'Dm', durations, encoded=True)
+
+
+def _harmonic_state_benchmark(state_class, buffer_size):
+    def setup(m, size):
+        notes = [m.musical_notes[(i * 7) % 12] for i in range(size)]
+
+        def run():
+            state = getattr(m, state_class)(buffer_size)
+            for note in notes:
+                state.push_notes([note])
+                state.update_scale()
+        return run
+    return setup
+
+
+def bench_get_nearest_rhythm(m, size):
+    intervals = [0.05 + (i % 97) * 0.021 for i in range(size)]
+    durations = m.get_durations(120)
+    return lambda: [m.get_nearest_rhythm(interval, durations) for interval in intervals]
+
+
+def bench_quantize_intervals(m, size):
+    import numpy as np
+    intervals = 0.05 + (np.arange(size) % 97) * 0.021
+    table = m.DurationTable(m.get_durations(120))
+    return lambda: m.quantize_intervals(intervals, table)
+
+
+# durations of the figures of bench_clip_rhythmic_sequence in ticks (48 for each 4/4 measure),
+# computed here so that the benchmark runs also on the releases without rhythm_ticks
+_clip_figure_ticks = {'4': 12, '8': 6, '16': 3, '8t': 4, '4dot': 18, '2': 24}
+
+
+def bench_clip_rhythmic_sequence(m, size):
+    figures = ['4', '8', '8', '16', '16', '8t', '4dot', '2']
+    sequence = [figures[i % len(figures)] for i in range(size)]
+    # half of the measures of the sequence
+    measures = sum(_clip_figure_ticks[figure] for figure in sequence) // (2 * 48)
+    return lambda: m.clip_rhythmic_sequence(sequence, measures)
+
+
+"""
+Benchmarks of the suite: name, setup function (returning the function to measure) and sizes.
+The quick runs use only the sizes up to 10000.
+"""
+benchmarks = [
+    ('MidiNoteQueue.push', bench_queue_push, _sizes),
+    ('CompactMidiNoteQueue.push', bench_compact_queue_push, _sizes),
+    ('ConcurrentMidiNoteQueue.push+snapshot', bench_concurrent_queue_push, _sizes),
+    ('MidiNoteQueue.pop', bench_queue_pop, _sizes[:4]),
+    ('clean_unclosed_note_ons', bench_clean_unclosed_note_ons, _sizes[:4]),
+    ('parse_rhythm', bench_parse_rhythm, _sizes),
+    ('parse_melody', bench_parse_melody, _sizes),
+    ('parse_melody (compact, encoded)', bench_parse_melody_compact, _sizes),
+    ('get_nearest_rhythm', bench_get_nearest_rhythm, _sizes[:4]),
+    ('quantize_intervals', bench_quantize_intervals, _sizes),
+    ('clip_rhythmic_sequence', bench_clip_rhythmic_sequence, _sizes),
+] + [
+    ('{}({}).update'.format(state_class, buffer_size), _harmonic_state_benchmark(state_class, buffer_size), _sizes[:3])
+    for state_class in ['HarmonicState', 'IncrementalHarmonicState'] for buffer_size in [16, 64, 256]
+]
+
+
+def measure(function, repetitions):
+    """
+    Measures the best time in seconds of some calls of a function, after a call not measured
+    that warms up the caches.
+
+    :param function: function without arguments (with an optional prepare attribute called before each call)
+    :param repetitions: number of calls
+    :return: best time in seconds
+    """
+    times = []
+    for i in range(repetitions + 1):
+        if hasattr(function, 'prepare'):
+            function.prepare()
+        start = time.perf_counter()
+        function()
+        if i:
+            times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def measure_import(repetitions):
+    """
+    Measures the median time in seconds of the import of melodically in a new interpreter.
+
+    :param repetitions: number of runs
+    :return: median time in seconds
+    """
+    code = 'import time; _start = time.perf_counter(); import melodically; print(time.perf_counter() - _start)'
+    times = []
+    for _ in range(repetitions):
+        output = subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE,
+                                universal_newlines=True).stdout
+        times.append(float(output))
+    return statistics.median(times)
+
+
+def run_suite(quick=False, name_filter=None, repetitions=5):
+    """
+    Runs the benchmarks of the suite.
+
+    :param quick: if True, only the sizes up to 10000 are used
+    :param name_filter: if given, only the benchmarks containing it in their name are run
+    :param repetitions: number of calls of each benchmark
+    :return: dictionary mapping "name[size]" to the best time in seconds
+             (None for the benchmarks skipped because the installed release lacks their API)
+    """
+    import melodically as m
+    results = {}
+    for name, setup, sizes in benchmarks:
+        if name_filter and name_filter not in name:
+            continue
+        for size in sizes:
+            if quick and size > 10000:
+                continue
+            key = '{}[{}]'.format(name, size)
+            try:
+                results[key] = measure(setup(m, size), 1 if size >= 1000000 else repetitions)
+            except (AttributeError, TypeError) as error:
+                # missing function, class or argument in the release being measured
+                results[key] = None
+                print('{:<55} {:>14} ({})'.format(key, 'skipped', error), flush=True)
+                continue
+            print('{:<55} {:>12.6f} s'.format(key, results[key]), flush=True)
+    if not name_filter or name_filter in 'import':
+        results['import'] = measure_import(repetitions)
+        print('{:<55} {:>12.6f} s'.format('import', results['import']), flush=True)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Compares the results with a baseline.
+
+    :param results: dictionary of times in seconds (the skipped benchmarks, with None, are ignored)
+    :param baseline: dictionary of times in seconds
+    :param threshold: maximum ratio between a result and its baseline
+    :return: list of (name, ratio) of the regressions
+    """
+    regressions = []
+    print('\n{:<55} {:>10} {:>10} {:>8}'.format('benchmark', 'baseline', 'current', 'ratio'))
+    for key, seconds in results.items():
+        if seconds is None or baseline.get(key) is None:
+            continue
+        ratio = seconds / baseline[key] if baseline[key] else float('inf')
+        flag = ' REGRESSION' if ratio > threshold else ''
+        print('{:<55} {:>10.6f} {:>10.6f} {:>8.2f}{}'.format(key, baseline[key], seconds, ratio, flag))
+        if flag:
+            regressions.append((key, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark suite of melodically.')
+    parser.add_argument('--quick', action='store_true', help='use only the sizes up to 10000')
+    parser.add_argument('--filter', default=None, help='run only the benchmarks containing this text')
+    parser.add_argument('--repetitions', type=int, default=5, help='calls of each benchmark')
+    parser.add_argument('--output', default=None, help='JSON file where the results are written')
+    parser.add_argument('--baseline', default=_default_baseline, help='JSON file of the baseline')
+    parser.add_argument('--threshold', type=float, default=1.5, help='maximum ratio with the baseline')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    args = parser.parse_args()
+
+    results = run_suite(args.quick, args.filter, args.repetitions)
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    if args.save_baseline:
+        if os.path.exists(args.baseline):
+            # keeping the benchmarks not run this time
+            with open(args.baseline) as file:
+                report['results'] = dict(json.load(file)['results'],
+                                         **{key: seconds for key, seconds in results.items() if seconds is not None})
+        with open(args.baseline, 'w') as file:
+            json.dump(report, file, indent=2)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file)['results'], args.threshold)
+        if regressions:
+            print('\n{} regressions'.format(len(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
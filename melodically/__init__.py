@@ -1,6 +1,16 @@
 from melodically.midi_note_queue import *
 from melodically.harmonic_state import *
 from melodically.harmony import *
-from melodically.chords import chord_tones, chord_to_midi
+from melodically.chords import chord_tones, chord_to_midi, get_chord_tones, get_chord, spell_chord, \
+    get_chord_masks, get_melodic_classes, clear_chord_caches, chord_cache_size
 from melodically.rhythm import *
 from melodically.parsers import *
+from melodically.vocabulary import *
+from melodically.ngrams import *
+from melodically.generator import *
+from melodically.session_store import *
+from melodically.midi_pipeline import *
+from melodically.tables import LazyDict, get_table, lazy_import, load_tables, register_table, save_tables
+from melodically.midi_file import read_midi_file, write_midi_file
+from melodically.chord_recognition import *
+from melodically.instrumentation import *
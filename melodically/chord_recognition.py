@@ -0,0 +1,183 @@
+from collections import deque
+from melodically.chords import chord_tones, get_chord
+from melodically.harmony import pitch_class_indices
+from melodically.tables import lazy_import
+
+np = lazy_import('numpy')
+
+
+def get_chord_templates(chords=None):
+    """
+    Builds the matrix of the chord templates used by the chord recognition:
+    the row of each chord has the same value on its chord tones and 0 elsewhere,
+    normalized so that the score of a chord is the cosine similarity (up to the norm of the profile)
+    between the chord and a pitch class profile.
+
+    :param chords: list of chord symbols (all the chords of chord_tones if None)
+    :return: (list of chord symbols, numpy array of size [len(chords) x 12])
+    """
+    chords = list(chord_tones.keys()) if chords is None else list(chords)
+    templates = np.zeros((len(chords), 12), dtype=np.float64)
+    for i, chord in enumerate(chords):
+        templates[i, [pitch_class_indices[note] for note in get_chord(chord)['c']]] = 1
+    templates = templates / np.sqrt(np.maximum(templates.sum(axis=1, keepdims=True), 1))
+    return chords, templates
+
+
+def _queue_events(midi_queue):
+    # timestamps, midi notes and note_on flags of all the messages of a queue
+    if hasattr(midi_queue, 'get_type_codes'):
+        # columnar queue, 1 is the note_on type code
+        return midi_queue.get_timestamps(), midi_queue.get_midi_notes(), midi_queue.get_type_codes() == 1
+    container = midi_queue.get_container()
+    return (np.array([msg['timestamp'] for msg in container], dtype=np.float64),
+            np.array([msg['note'] for msg in container], dtype=np.int64),
+            np.array([msg['type'] == 'note_on' for msg in container], dtype=bool))
+
+
+def recognize_chords(midi_queue, window=2.0, hop=None, chords=None):
+    """
+    Slides a time window over the messages of a MidiNoteQueue (or CompactMidiNoteQueue),
+    and finds the chord that best matches the notes sounding in each window.
+    The pitch class profile of a window is weighted by the time each note sounds inside it,
+    and it's computed from the prefix integrals of the number of sounding notes of each pitch class;
+    all the windows are matched against all the chord templates at once.
+
+    :param midi_queue: MidiNoteQueue or CompactMidiNoteQueue object
+    :param window: duration of the windows in seconds
+    :param hop: distance in seconds between the starts of two windows (window if None)
+    :param chords: list of candidate chord symbols (all the chords of chord_tones if None)
+    :return: list of dictionaries with the start of each window (timestamp) and its chord (None if silent)
+    """
+    hop = window if hop is None else hop
+    timestamps, notes, note_on_flags = _queue_events(midi_queue)
+    if not len(timestamps):
+        return []
+
+    # sounding notes of each pitch class after each message
+    changes = np.zeros((len(timestamps), 12), dtype=np.float64)
+    changes[np.arange(len(timestamps)), np.asarray(notes) % 12] = np.where(note_on_flags, 1, -1)
+    slopes = np.cumsum(changes, axis=0)
+
+    # integral of the sounding notes from the first message to each message
+    integrals = np.zeros_like(slopes)
+    integrals[1:] = np.cumsum(slopes[:-1] * np.diff(timestamps)[:, None], axis=0)
+
+    def integrals_at(times):
+        k = np.maximum(np.searchsorted(timestamps, times, side='right') - 1, 0)
+        return integrals[k] + slopes[k] * np.maximum(times - timestamps[k], 0)[:, None]
+
+    starts = timestamps[0] + hop * np.arange(int(np.floor((timestamps[-1] - timestamps[0]) / hop)) + 1)
+    profiles = integrals_at(starts + window) - integrals_at(starts)
+
+    names, templates = get_chord_templates(chords)
+    best = np.argmax(profiles @ templates.T, axis=1).tolist()
+    silent = (profiles.sum(axis=1) <= 0).tolist()
+    return [{'timestamp': start, 'chord': None if empty else names[index]}
+            for start, index, empty in zip(starts.tolist(), best, silent)]
+
+
+class ChordRecognizer:
+    """
+    Recognizes the chord of the last seconds of a live stream of note_on/off messages.
+    The prefix integral of the sounding notes is stored only at the messages inside the window:
+    each message adds a breakpoint, and the ones older than the window are removed,
+    so the pitch class profile of the window is obtained as a difference of two integrals.
+    A recognizer can be attached to a midi queue with add_listener(recognizer.push).
+    """
+
+    def __init__(self, window=2.0, chords=None):
+        # duration of the window in seconds
+        self.window = window
+
+        # candidate chords and their templates (see get_chord_templates)
+        self.chords, self._templates = get_chord_templates(chords)
+
+        # number of sounding notes for each pitch class and for each midi note
+        self._active = np.zeros(12, dtype=np.float64)
+        self._openNotes = {}
+
+        # integral of the sounding notes until the last message
+        self._integral = np.zeros(12, dtype=np.float64)
+        self._lastTimestamp = None
+
+        # breakpoints: timestamp, integral and sounding notes at each message of the window
+        self._times = deque()
+        self._integrals = deque()
+        self._slopes = deque()
+
+    def _drop_old_breakpoints(self, start):
+        # keeping only the last breakpoint before the start of the window
+        while len(self._times) > 1 and self._times[1] <= start:
+            self._times.popleft()
+            self._integrals.popleft()
+            self._slopes.popleft()
+
+    def push(self, msg_type, note, timestamp):
+        """
+        Adds a note_on/off message to the window.
+        The note_offs that don't close a note_on are ignored.
+
+        :param msg_type: 'note_on' or 'note_off'
+        :param note: midi note value
+        :param timestamp: timestamp of the message
+        """
+        if msg_type == 'note_on':
+            self._openNotes[note] = self._openNotes.get(note, 0) + 1
+            change = 1
+        elif msg_type == 'note_off' and self._openNotes.get(note):
+            self._openNotes[note] = self._openNotes[note] - 1
+            change = -1
+        else:
+            return
+
+        if self._lastTimestamp is not None:
+            self._integral = self._integral + self._active * (timestamp - self._lastTimestamp)
+        self._lastTimestamp = timestamp
+        self._active = self._active.copy()
+        self._active[note % 12] = self._active[note % 12] + change
+
+        self._times.append(timestamp)
+        self._integrals.append(self._integral)
+        self._slopes.append(self._active)
+        self._drop_old_breakpoints(timestamp - self.window)
+
+    def get_profile(self, timestamp=None):
+        """
+        Gets the duration-weighted pitch class profile of the window ending at a certain time.
+
+        :param timestamp: end of the window (the last message if None), not before the last message
+        :return: numpy array of 12 durations in seconds
+        """
+        if self._lastTimestamp is None:
+            return np.zeros(12, dtype=np.float64)
+        timestamp = self._lastTimestamp if timestamp is None else timestamp
+        start = timestamp - self.window
+        self._drop_old_breakpoints(start)
+        end_integral = self._integral + self._active * (timestamp - self._lastTimestamp)
+        start_integral = self._integrals[0] + self._slopes[0] * max(start - self._times[0], 0)
+        return end_integral - start_integral
+
+    def recognize(self, timestamp=None):
+        """
+        Finds the chord that best matches the window ending at a certain time.
+
+        :param timestamp: end of the window (the last message if None), not before the last message
+        :return: chord symbol (None if no note sounds in the window)
+        """
+        profile = self.get_profile(timestamp)
+        if profile.sum() <= 0:
+            return None
+        return self.chords[int(np.argmax(self._templates @ profile))]
+
+    def reset(self):
+        """
+        Removes all the messages from the window.
+        """
+        self._active = np.zeros(12, dtype=np.float64)
+        self._openNotes.clear()
+        self._integral = np.zeros(12, dtype=np.float64)
+        self._lastTimestamp = None
+        self._times.clear()
+        self._integrals.clear()
+        self._slopes.clear()
@@ -1,12 +1,8 @@
-from melodically.harmony import musical_notes, std_to_midi, midi_to_std, mode_signatures
-import numpy as np
-
-"""
-Dictionary containing, for each chord, 
-another dictionary that indicates 
-the color tones (c) and the chord tones (l).
-"""
-chord_tones = {}
+import re
+from functools import lru_cache
+from melodically.harmony import musical_notes, std_to_midi, midi_to_std, mode_signatures, pitch_class_mask, \
+    pitch_class_indices
+from melodically.tables import LazyDict
 
 
 def get_chord_tones(chord_dict):
@@ -29,9 +25,9 @@ def get_chord_tones(chord_dict):
             color_tones_indices = [i for i in range(7) if i not in chord_tones_indices]
 
             # applying a cumulative sum to the diatonic scale intervals
-            # circular shift used to switch from major, minor and dominant (np.roll)
+            # circular shift used to switch from major, minor and dominant
             # [2, 2, 1, 2, 2, 2, 1] => [0, 2, 4, 5, 7, 9, 11]
-            m0 = list(np.roll(mode_signatures[0], -1 * shift))
+            m0 = mode_signatures[0][shift:] + mode_signatures[0][:shift]
             diatonic_scale_absolute_intervals = [sum(m0[0:i]) for i, value in enumerate(m0)]
 
             # getting two lists of notes in std notation for c and l
@@ -60,8 +56,246 @@ def get_chord_tones(chord_dict):
     return chord_dict
 
 
-# adding major, minor and dominant chords to the dictionary
-chord_tones = get_chord_tones(chord_tones)
+"""
+Dictionary containing, for each chord, 
+another dictionary that indicates 
+the color tones (c) and the chord tones (l).
+The major, minor, dominant and diminished chords are added
+the first time the dictionary is accessed.
+"""
+chord_tones = LazyDict('chord_tones', lambda: get_chord_tones({}), lambda: mode_signatures[0])
+
+
+"""
+Maximum number of chords kept in the caches of spell_chord,
+get_chord_masks and get_melodic_classes
+"""
+chord_cache_size = 4096
+
+# root, body and optional bass of a chord symbol (ex: F#m7b5/C)
+_chord_symbol_pattern = re.compile(r'^([A-G][#b]?)(.*?)(?:/([A-G][#b]?))?$')
+
+# enharmonic roots without an entry in pitch_class_indices
+_enharmonic_notes = {'Cb': 'B', 'Fb': 'E', 'E#': 'F', 'B#': 'C'}
+
+# chord qualities, longest first: (token, third, fifth, seventh used by the extensions 7, 9, 11, 13)
+_chord_qualities = [
+    ('minmaj', 3, 7, 11), ('mmaj', 3, 7, 11), ('mMaj', 3, 7, 11), ('mM', 3, 7, 11), ('-maj', 3, 7, 11),
+    ('maj', 4, 7, 11), ('Maj', 4, 7, 11), ('ma', 4, 7, 11), ('M', 4, 7, 11), ('^', 4, 7, 11),
+    ('min', 3, 7, 10), ('mi', 3, 7, 10), ('m', 3, 7, 10), ('-', 3, 7, 10),
+    ('dim', 3, 6, 9), ('o', 3, 6, 9), ('aug', 4, 8, 10), ('+', 4, 8, 10),
+]
+
+# extensions: (token, intervals added to the root, third and fifth)
+_chord_extensions = [
+    ('6/9', [9, 2]), ('69', [9, 2]), ('13', [None, 2, 9]), ('11', [None, 2, 5]), ('9', [None, 2]),
+    ('7', [None]), ('6', [9]),
+]
+
+# intervals of the scale degrees used by add, sus and the alterations
+_degree_intervals = {'2': 2, '4': 5, '5': 7, '6': 9, '9': 2, '11': 5, '13': 9}
+
+# modifiers following the extension (ex: add9, sus4, b9, #11, no3, 5 for the power chords)
+_chord_modifier_pattern = re.compile(r'(add|sus|no)?([b#]?)(13|11|9|6|5|4|3|2)|(sus|alt)')
+
+# scales (intervals from the root) used to obtain the color tones of each family of chords
+_chord_scales = {
+    'ionian': [0, 2, 4, 5, 7, 9, 11],
+    'mixolydian': [0, 2, 4, 5, 7, 9, 10],
+    'aeolian': [0, 2, 3, 5, 7, 8, 10],
+    'dorian': [0, 2, 3, 5, 7, 9, 10],
+    'melodic_minor': [0, 2, 3, 5, 7, 9, 11],
+    'locrian': [0, 1, 3, 5, 6, 8, 10],
+    'diminished': [0, 2, 3, 5, 6, 8, 9, 11],
+    'whole_tone': [0, 2, 4, 6, 8, 10],
+}
+
+
+def _note_pitch_class(note, chord):
+    # pitch class of the root or of the bass of a chord symbol
+    pitch_class = pitch_class_indices.get(_enharmonic_notes.get(note, note))
+    if pitch_class is None:
+        raise ValueError('{} is not a valid chord symbol'.format(chord))
+    return pitch_class
+
+
+@lru_cache(maxsize=chord_cache_size)
+def spell_chord(chord):
+    """
+    Parses a chord symbol (ex: Cmaj9, F#m7b5, Bb13#11, C7alt, Am/G) into its chord tones (c)
+    and color tones (l), with the same format of the values of chord_tones.
+    The chord tones are the notes of the chord (extensions, alterations and bass included),
+    the color tones are the other notes of the scale commonly associated with the chord.
+    The results are kept in a LRU cache (see spell_chord.cache_info for hits and misses),
+    and must not be modified.
+
+    :param chord: chord symbol
+    :return: dictionary with the lists of chord tones (c) and color tones (l) in std notation
+    """
+    match = _chord_symbol_pattern.match(chord.strip())
+    if not match:
+        raise ValueError('{} is not a valid chord symbol'.format(chord))
+    root = _note_pitch_class(match.group(1), chord)
+    body = re.sub(r'[(),\s]', '', match.group(2))
+
+    # quality of the chord
+    third, fifth, seventh = 4, 7, 10
+    quality = ''
+    for token, token_third, token_fifth, token_seventh in _chord_qualities:
+        # a quality is never followed by dd: ma in madd9 is m followed by add
+        if body.startswith(token) and not body.startswith('dd', len(token)):
+            quality = token
+            third, fifth, seventh = token_third, token_fifth, token_seventh
+            body = body[len(token):]
+            break
+    intervals = [0, third, fifth]
+
+    # extension
+    for token, extension in _chord_extensions:
+        if body.startswith(token):
+            intervals.extend(seventh if i is None else i for i in extension)
+            body = body[len(token):]
+            break
+
+    # add, sus and alterations
+    altered = {}  # natural interval of the scale -> altered interval
+    position = 0
+    while position < len(body):
+        modifier = _chord_modifier_pattern.match(body, position)
+        if not modifier:
+            raise ValueError('{} is not a valid chord symbol'.format(chord))
+        position = modifier.end()
+        kind, accidental, degree, word = modifier.groups()
+        if word == 'alt':
+            altered.update({2: 1, 5: 6, 9: 8})
+            intervals.extend([1, 3, 8])
+            continue
+        if word == 'sus' or kind == 'sus':
+            # sus without a degree is a sus4
+            interval = _degree_intervals[degree or '4']
+            intervals = [i for i in intervals if i != third] + [interval]
+            third = None
+            continue
+        if degree == '3':
+            # the third can only be omitted (the scale still follows the quality of the chord)
+            if kind != 'no' or accidental:
+                raise ValueError('{} is not a valid chord symbol'.format(chord))
+            intervals = [i for i in intervals if i != third]
+            continue
+        if degree == '5' and not kind and not accidental:
+            # power chord: root and fifth
+            intervals = [i for i in intervals if i != third]
+            third = None
+            continue
+        natural = _degree_intervals[degree]
+        interval = natural + {'b': -1, '#': 1, '': 0}[accidental]
+        if kind == 'no':
+            intervals = [i for i in intervals if i != interval]
+            continue
+        if accidental:
+            if degree == '5':
+                intervals = [i for i in intervals if i != fifth]
+                fifth = interval
+            altered[natural] = interval
+        intervals.append(interval)
+    intervals = sorted(set(i % 12 for i in intervals))
+
+    # choosing the scale
+    if quality in ('dim', 'o') and 9 in intervals and fifth == 6:
+        scale = 'diminished'
+    elif third == 3 and fifth == 6:
+        scale = 'locrian'
+    elif third == 4 and fifth == 8:
+        scale = 'whole_tone'
+    elif third == 3:
+        if 11 in intervals:
+            scale = 'melodic_minor'
+        elif 9 in intervals:
+            scale = 'dorian'
+        else:
+            scale = 'aeolian'
+    elif seventh == 10 and 10 in intervals:
+        scale = 'mixolydian'
+    else:
+        scale = 'ionian'
+    scale_intervals = set(_chord_scales[scale])
+    for natural, interval in altered.items():
+        scale_intervals.discard(natural)
+        scale_intervals.add(interval)
+
+    # slash chords: the bass is added to the chord tones
+    chord_pitch_classes = [(root + i) % 12 for i in intervals]
+    if match.group(3):
+        bass = _note_pitch_class(match.group(3), chord)
+        if bass not in chord_pitch_classes:
+            chord_pitch_classes.append(bass)
+    color_pitch_classes = [(root + i) % 12 for i in sorted(scale_intervals)]
+    return {
+        'c': [midi_to_std(p) for p in chord_pitch_classes],
+        'l': [midi_to_std(p) for p in color_pitch_classes if p not in chord_pitch_classes]
+    }
+
+
+def get_chord(chord):
+    """
+    Gets the chord tones and the color tones of a chord, from the chord_tones
+    dictionary if the chord is present, using spell_chord otherwise.
+    The root and the bass are looked up in std notation (ex: Bbdim as A#dim),
+    so that the enharmonic symbols of a chord have the same tones.
+
+    :param chord: chord symbol
+    :return: dictionary with the lists of chord tones (c) and color tones (l) in std notation
+    """
+    tones = chord_tones.get(chord)
+    if tones is not None:
+        return tones
+    match = _chord_symbol_pattern.match(chord.strip())
+    if match:
+        key = musical_notes[_note_pitch_class(match.group(1), chord)] + match.group(2)
+        if match.group(3):
+            key = key + '/' + musical_notes[_note_pitch_class(match.group(3), chord)]
+        tones = chord_tones.get(key)
+        if tones is not None:
+            return tones
+    return spell_chord(chord)
+
+
+@lru_cache(maxsize=chord_cache_size)
+def get_chord_masks(chord):
+    """
+    Gets the 12-bit masks (see pitch_class_mask) of the chord tones
+    and of the color tones of a chord (see get_chord).
+    The masks are kept in a LRU cache.
+
+    :param chord: chord symbol
+    :return: (chord tones mask, color tones mask)
+    """
+    tones = get_chord(chord)
+    return pitch_class_mask(tones['c']), pitch_class_mask(tones['l'])
+
+
+@lru_cache(maxsize=chord_cache_size)
+def get_melodic_classes(chord):
+    """
+    Gets the abstract melody symbol (c, l or x) of each pitch class for a certain chord,
+    as a string of 12 characters indexed by pitch class.
+    The strings are kept in a LRU cache.
+
+    :param chord: chord symbol
+    :return: string of 12 melodic symbols
+    """
+    chord_mask, color_mask = get_chord_masks(chord)
+    return ''.join('c' if chord_mask >> i & 1 else 'l' if color_mask >> i & 1 else 'x' for i in range(12))
+
+
+def clear_chord_caches():
+    """
+    Empties the caches of spell_chord, get_chord_masks and get_melodic_classes
+    (needed after modifying a chord already used inside chord_tones).
+    """
+    spell_chord.cache_clear()
+    get_chord_masks.cache_clear()
+    get_melodic_classes.cache_clear()
 
 
 def chord_to_midi(chord, octave=3):
@@ -77,7 +311,7 @@ def chord_to_midi(chord, octave=3):
     :param octave: octave of all the notes or of the single notes in case a list is passed
     :return: a list of midi note values of the chord tones of the chord
     """
-    notes = chord_tones[chord]['c']
+    notes = get_chord(chord)['c']
     if isinstance(octave, list):  # if octave is a list contains multiple values for each note
         midi_notes = [std_to_midi(n, o) for n, o in zip(notes, octave)]
     else:
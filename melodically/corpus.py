@@ -0,0 +1,134 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from melodically.midi_file import read_midi_file
+from melodically.midi_note_queue import MidiNoteQueue
+from melodically.harmony import detect_modes, modes_chords_dict
+from melodically.parsers import parse_melody
+from melodically.rhythm import get_durations
+
+
+def find_midi_files(directory):
+    """
+    Finds all the Standard MIDI Files (.mid or .midi) inside a directory and its subdirectories.
+
+    :param directory: path of the directory
+    :return: sorted list of file paths
+    """
+    paths = []
+    for root, _, files in os.walk(directory):
+        paths.extend(os.path.join(root, f) for f in files if f.lower().endswith(('.mid', '.midi')))
+    return sorted(paths)
+
+
+def analyze_midi_files(paths, bpm=None):
+    """
+    Analyzes each track of a list of Standard MIDI Files, detecting its mode
+    and parsing its melody on the tonic chord of the mode.
+
+    :param paths: list of file paths
+    :param bpm: bpm used for the rhythmic parsing (if None, the tempo of each file is used)
+    :return: list of dictionaries, one for each track containing notes
+    """
+    tracks = []
+    for path in paths:
+        try:
+            messages, file_bpm = read_midi_file(path)
+        except (ValueError, OSError):
+            continue  # unreadable file
+        durations = get_durations(bpm or file_bpm)
+        for track_index, track in enumerate(messages):
+            midi_queue = MidiNoteQueue()
+            for msg in track:
+                midi_queue.push(msg['type'], msg['note'], msg['timestamp'])
+            midi_queue.clean_unclosed_note_ons()
+            notes = midi_queue.get_notes()
+            if notes:
+                tracks.append({
+                    'path': path,
+                    'track': track_index,
+                    'notes': notes,
+                    'queue': midi_queue,
+                    'durations': durations
+                })
+
+    # detecting the modes of all the tracks at once
+    for track, mode in zip(tracks, detect_modes([track['notes'] for track in tracks])):
+        chord = modes_chords_dict[mode['root']][mode['mode_index']][0]  # tonic chord
+        track.update(mode)
+        track['chord'] = chord
+        track['symbols'] = parse_melody(track.pop('queue'), chord, track.pop('durations'), encoded=True)
+        track['n_notes'] = len(track.pop('notes'))
+    return tracks
+
+
+def _analyze_chunk(args):
+    paths, bpm = args
+    return analyze_midi_files(paths, bpm)
+
+
+def analyze_corpus(directory, output_path, processes=None, chunk_size=16, bpm=None):
+    """
+    Analyzes all the Standard MIDI Files inside a directory, distributing chunks of
+    files across processes, and saves the results in a columnar .npz file with the fields:
+
+    path, track: file path and track index of each analyzed track
+    root, mode_signature_index, mode_index: mode detected for each track
+    chord: tonic chord of the mode, used to parse the melody
+    offsets: the symbols of the track i are symbols[offsets[i]:offsets[i + 1]]
+    symbols: melody symbols of all the tracks, as uint16 codes (see melody_symbols and decode_symbols)
+
+    :param directory: path of the directory containing the files
+    :param output_path: path of the output file
+    :param processes: number of processes (all the cores if None)
+    :param chunk_size: number of files analyzed by each task
+    :param bpm: bpm used for the rhythmic parsing (if None, the tempo of each file is used)
+    :return: dictionary with the number of files, tracks, notes and the throughput in notes per second
+    """
+    start = time.perf_counter()
+    paths = find_midi_files(directory)
+    chunks = [(paths[i:i + chunk_size], bpm) for i in range(0, len(paths), chunk_size)]
+    with ProcessPoolExecutor(processes) as executor:
+        tracks = [track for result in executor.map(_analyze_chunk, chunks) for track in result]
+
+    lengths = [len(track['symbols']) for track in tracks]
+    np.savez(
+        output_path,
+        path=np.array([track['path'] for track in tracks], dtype=str),
+        track=np.array([track['track'] for track in tracks], dtype=np.int32),
+        root=np.array([track['root'] for track in tracks], dtype=str),
+        mode_signature_index=np.array([track['mode_signature_index'] for track in tracks], dtype=np.int32),
+        mode_index=np.array([track['mode_index'] for track in tracks], dtype=np.int32),
+        chord=np.array([track['chord'] for track in tracks], dtype=str),
+        offsets=np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+        symbols=np.concatenate([np.zeros(0, dtype=np.uint16)] + [track['symbols'] for track in tracks])
+    )
+
+    elapsed = time.perf_counter() - start
+    notes = sum(track['n_notes'] for track in tracks)
+    return {
+        'files': len(paths),
+        'tracks': len(tracks),
+        'notes': notes,
+        'seconds': elapsed,
+        'notes_per_second': notes / elapsed if elapsed else 0.0
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parses a directory of midi files into melody symbols and modes.')
+    parser.add_argument('directory', help='directory containing the midi files')
+    parser.add_argument('output', help='output .npz file')
+    parser.add_argument('--processes', type=int, default=None, help='number of processes')
+    parser.add_argument('--chunk-size', type=int, default=16, help='number of files for each task')
+    parser.add_argument('--bpm', type=float, default=None, help='bpm used instead of the tempo of the files')
+    args = parser.parse_args()
+    stats = analyze_corpus(args.directory, args.output, args.processes, args.chunk_size, args.bpm)
+    print('{files} files, {tracks} tracks, {notes} notes in {seconds:.2f} s '
+          '({notes_per_second:.0f} notes/s)'.format(**stats))
+
+
+if __name__ == '__main__':
+    main()
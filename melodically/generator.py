@@ -0,0 +1,192 @@
+from melodically.chords import get_chord
+from melodically.harmony import pitch_class_indices
+from melodically.rhythm import as_duration_table, rhythm_ticks, measure_ticks
+from melodically.tables import lazy_import
+from melodically.vocabulary import melodic_classes, rhythm_figures, rest_codes_start, figure_codes_start
+
+np = lazy_import('numpy')
+
+
+def get_tone_tables(chords):
+    """
+    Precomputes the pitch classes of the chord tones (c), color tones (l) and random tones (x)
+    of a list of chords, used to realize the abstract melody symbols.
+    A chord without color or random tones uses its chord tones instead.
+
+    :param chords: list of chord symbols
+    :return: (int64 array [len(chords) x 3 x 12] of pitch classes padded with -1, int64 array [len(chords) x 3] of lengths)
+    """
+    tones = np.full((len(chords), len(melodic_classes), 12), -1, dtype=np.int64)
+    lengths = np.zeros((len(chords), len(melodic_classes)), dtype=np.int64)
+    for i, chord in enumerate(chords):
+        chord_dict = get_chord(chord)
+        chord_tones = [pitch_class_indices[note] for note in chord_dict['c']]
+        color_tones = [pitch_class_indices[note] for note in chord_dict['l']]
+        random_tones = [p for p in range(12) if p not in chord_tones and p not in color_tones]
+        for j, pitch_classes in enumerate([chord_tones, color_tones or chord_tones, random_tones or chord_tones]):
+            tones[i, j, :len(pitch_classes)] = pitch_classes
+            lengths[i, j] = len(pitch_classes)
+    return tones, lengths
+
+
+class MarkovMelodyGenerator:
+    """
+    Generates melodies from the n-gram statistics of a NGramCounter of melody_symbols codes.
+    The n-grams are used as a transition table: the cumulative counts of the n-grams sharing
+    the same context (the first n - 1 codes) are the cumulative probabilities of the next code,
+    so that many chains are sampled at once with a binary search.
+    The symbols are then realized as midi notes on a chord progression and scheduled in time.
+    """
+
+    def __init__(self, counter):
+        keys, counts = counter.get_arrays()
+        if not len(keys):
+            raise ValueError('the n-gram counter is empty')
+        self.n = counter.n
+        self.vocabularySize = counter.vocabularySize
+        keys = np.asarray(keys, dtype=np.int64)
+
+        # number of possible contexts, used to shift a new code into a context
+        self._contextSize = self.vocabularySize ** (self.n - 1)
+
+        # cumulative counts of the n-grams, sorted by key (and so grouped by context)
+        self._cumulative = np.cumsum(np.asarray(counts, dtype=np.float64))
+
+        # last code of each n-gram
+        self._nextCodes = keys % self.vocabularySize
+
+        # context (first n - 1 codes) of each n-gram, used to start the chains
+        self._keyContexts = keys // self.vocabularySize
+
+        # distinct contexts and the range of their n-grams
+        self._contexts, starts = np.unique(self._keyContexts, return_index=True)
+        ends = np.append(starts[1:], len(keys))
+        self._rowLow = np.where(starts > 0, self._cumulative[starts - 1], 0)
+        self._rowHigh = self._cumulative[ends - 1]
+
+    def sample(self, n_symbols, n_chains=1, seed=None):
+        """
+        Samples chains of codes from the transition table.
+        Each chain starts with the first n - 1 codes of a random n-gram; when a context
+        has never been followed by a code, the next code is taken from a random n-gram.
+
+        :param n_symbols: number of codes of each chain
+        :param n_chains: number of chains
+        :param seed: seed of the random generator (or a numpy Generator)
+        :return: uint16 numpy array [n_chains x n_symbols] of codes
+        """
+        rng = np.random.default_rng(seed)
+        total = self._cumulative[-1]
+        result = np.zeros((n_chains, n_symbols), dtype=np.uint16)
+
+        # starting n-grams
+        starts = np.searchsorted(self._cumulative, rng.random(n_chains) * total, side='right')
+        context = self._keyContexts[starts]
+        for j in range(min(self.n - 1, n_symbols)):
+            result[:, j] = context // self.vocabularySize ** (self.n - 2 - j) % self.vocabularySize
+
+        for j in range(self.n - 1, n_symbols):
+            rows = np.minimum(np.searchsorted(self._contexts, context), len(self._contexts) - 1)
+            found = self._contexts[rows] == context
+            low = np.where(found, self._rowLow[rows], 0)
+            high = np.where(found, self._rowHigh[rows], total)
+            targets = low + rng.random(n_chains) * (high - low)
+            indices = np.minimum(np.searchsorted(self._cumulative, targets, side='right'), len(self._cumulative) - 1)
+            codes = self._nextCodes[indices]
+            result[:, j] = codes
+            context = (context * self.vocabularySize + codes) % self._contextSize
+        return result
+
+    @staticmethod
+    def realize(codes, chords, seed=None, low=48, high=84, start=60):
+        """
+        Realizes chains of codes as midi notes: each note takes a random pitch class
+        of its melodic class (chord, color or random tone) on the chord of its measure, in the octave
+        nearest to the previous note of the chain, and kept between low and high.
+        The codes of the notes without melodic class (as returned by parse_rhythm) are realized as chord tones.
+
+        :param codes: array [n_chains x n_symbols] (or [n_symbols]) of melody_symbols codes
+        :param chords: chord symbol, or list of chord symbols, one for each 4/4 measure (repeated cyclically)
+        :param seed: seed of the random generator (or a numpy Generator)
+        :param low: lowest midi note
+        :param high: highest midi note
+        :param start: midi note used as previous note of the first one
+        :return: int64 numpy array of the same shape of codes, with the midi notes (-1 for the rests)
+        """
+        rng = np.random.default_rng(seed)
+        codes = np.asarray(codes, dtype=np.int64)
+        shape = codes.shape
+        codes = codes.reshape(-1, shape[-1]) if codes.ndim else codes.reshape(1, 1)
+        chords = [chords] if isinstance(chords, str) else list(chords)
+        tones, lengths = get_tone_tables(chords)
+
+        n_figures = len(rhythm_figures)
+        figure_ticks = np.array([rhythm_ticks[f] for f in rhythm_figures], dtype=np.int64)
+        is_rest = (codes >= rest_codes_start) & (codes < figure_codes_start)
+        classes = np.where(codes < rest_codes_start, codes // n_figures, 0)
+        ticks = figure_ticks[codes % n_figures]
+        onsets = np.cumsum(ticks, axis=1) - ticks
+        chord_indices = onsets // measure_ticks % len(chords)
+
+        pitches = np.full(codes.shape, -1, dtype=np.int64)
+        previous = np.full(len(codes), start, dtype=np.int64)
+        for j in range(codes.shape[1]):
+            chord_index = chord_indices[:, j]
+            choices = (rng.random(len(codes)) * lengths[chord_index, classes[:, j]]).astype(np.int64)
+            pitch_classes = tones[chord_index, classes[:, j], choices]
+            # nearest note with the chosen pitch class
+            pitch = previous + (pitch_classes - previous + 6) % 12 - 6
+            pitch = np.where(pitch < low, pitch + 12, np.where(pitch > high, pitch - 12, pitch))
+            pitches[:, j] = np.where(is_rest[:, j], -1, pitch)
+            previous = np.where(is_rest[:, j], previous, pitch)
+        return pitches.reshape(shape)
+
+    @staticmethod
+    def schedule(codes, pitches, rhythmical_durations, start=0.0):
+        """
+        Converts realized chains in note_on/note_off messages, with the durations of
+        a dictionary returned by get_durations (or a DurationTable).
+
+        :param codes: array [n_chains x n_symbols] (or [n_symbols]) of melody_symbols codes
+        :param pitches: midi notes returned by realize
+        :param rhythmical_durations: dictionary returned by get_durations (or DurationTable)
+        :param start: timestamp of the first symbol
+        :return: list of midi messages with timestamp for each chain (a single list for one-dimensional codes)
+        """
+        duration_table = as_duration_table(rhythmical_durations)
+        seconds = dict(zip(duration_table.symbols, duration_table.values.tolist()))
+        figure_seconds = np.array([seconds[f] for f in rhythm_figures], dtype=np.float64)
+
+        codes = np.asarray(codes, dtype=np.int64)
+        single = codes.ndim == 1
+        codes = codes.reshape(-1, codes.shape[-1])
+        pitches = np.asarray(pitches, dtype=np.int64).reshape(codes.shape)
+        durations = figure_seconds[codes % len(rhythm_figures)]
+        # the note_off of a symbol and the note_on of the next one have the same timestamp
+        ends = start + np.cumsum(durations, axis=1)
+        onsets = np.concatenate([np.full((len(codes), 1), start), ends[:, :-1]], axis=1)
+
+        result = []
+        for chain_onsets, chain_ends, chain_pitches in zip(onsets.tolist(), ends.tolist(), pitches.tolist()):
+            messages = []
+            for onset, end, pitch in zip(chain_onsets, chain_ends, chain_pitches):
+                if pitch >= 0:
+                    messages.append({'type': 'note_on', 'note': pitch, 'timestamp': onset})
+                    messages.append({'type': 'note_off', 'note': pitch, 'timestamp': end})
+            result.append(messages)
+        return result[0] if single else result
+
+    def generate(self, n_symbols, chords, rhythmical_durations, seed=None, start=0.0):
+        """
+        Samples, realizes and schedules a single melody.
+
+        :param n_symbols: number of symbols of the melody
+        :param chords: chord symbol, or list of chord symbols, one for each 4/4 measure
+        :param rhythmical_durations: dictionary returned by get_durations (or DurationTable)
+        :param seed: seed of the random generator
+        :param start: timestamp of the first symbol
+        :return: list of midi messages with timestamp
+        """
+        rng = np.random.default_rng(seed)
+        codes = self.sample(n_symbols, 1, rng)[0]
+        return self.schedule(codes, self.realize(codes, chords, rng), rhythmical_durations, start)
@@ -1,4 +1,9 @@
-from melodically.harmony import midi_to_std, get_root, harmonic_affinities, modes_dict
+import time
+from melodically.harmony import midi_to_std, detect_modes, modes_dict, musical_notes, get_mode_weights, \
+    pitch_class_indices, pitch_class_histogram, search_histogram_modes, _affinity_scale, _select_modes
+from melodically.tables import lazy_import
+
+np = lazy_import('numpy')
 
 
 class HarmonicState:
@@ -31,27 +36,48 @@ class HarmonicState:
         while len(self.noteBuffer) > self.bufferSize:
             self.noteBuffer.pop(0)  # removing old notes
 
+    def push_clusters(self, clusters):
+        """
+        Pushes the notes of chord-onset clusters (see MidiNoteQueue.get_clusters) inside the buffer.
+
+        :param clusters: list of clusters, each one with the list of its midi notes
+        """
+        self.push_notes([midi_to_std(note) for cluster in clusters for note in cluster['notes']])
+
     def update_scale(self):
         """
         Updates the currentMode attribute based on the notes in the buffer,
-        applying the harmonic_affinities function to them.
+        applying the harmonic_affinities function to them
+        (through its vectorized version detect_modes).
 
         :return: currentMode
         """
-        notes_std = [n for n in self.noteBuffer]
-        if notes_std:
-            root = get_root(notes_std)
-            modes_affinities = harmonic_affinities(root, notes_std)
-            mode_signature_index = modes_affinities.index(max(modes_affinities))
-            tmp = modes_affinities[mode_signature_index]  # sequence with the lowest distance
-            mode_index = tmp.index(max(tmp))
-
-            self.currentMode['root'] = root
-            self.currentMode['mode_signature_index'] = mode_signature_index
-            self.currentMode['mode_index'] = mode_index
+        mode = detect_modes([self.noteBuffer])[0]
+        if mode:
+            self.currentMode.update(mode)
 
         return self.currentMode
 
+    def get_histogram(self):
+        """
+        Counts the occurrences of each pitch class in the buffer.
+
+        :return: numpy array of 12 counts
+        """
+        return pitch_class_histogram(self.noteBuffer)
+
+    def search_modes(self, k=5, signatures=None):
+        """
+        Finds the k most affine modes of the notes in the buffer, searching the modes of all the roots
+        instead of only the ones of the most common note (see search_histogram_modes).
+        The currentMode attribute is not changed.
+
+        :param k: number of modes (all the candidates if None)
+        :param signatures: list of mode signatures (extended_mode_signatures if None)
+        :return: list of k mode dictionaries (root, mode_signature_index, mode_index, notes, affinity and confidence)
+        """
+        return search_histogram_modes(self.get_histogram(), k, signatures)[0]
+
     def get_mode_notes(self):
         """
         Gets the current notes of the current modal scale.
@@ -62,3 +88,261 @@ class HarmonicState:
         tmp = modes_dict[self.currentMode['root']]
         tmp = tmp[self.currentMode['mode_signature_index']]
         return tmp[self.currentMode['mode_index']]
+
+
+class IncrementalHarmonicState(HarmonicState):
+    """
+    A HarmonicState that stores the notes in a fixed size ring buffer and keeps
+    the running pitch class counts and the running affinity scores of every mode,
+    so that pushing a note and querying the current mode take a constant time,
+    independently from the size of the buffer.
+    """
+
+    def __init__(self, buffer_size=16):
+        # max size of the buffer (needed before the base initialization fills noteBuffer)
+        self.bufferSize = buffer_size
+
+        # ring buffer containing the pitch classes of the input notes
+        self._ring = [0] * buffer_size
+
+        # index of the oldest note inside the ring buffer
+        self._head = 0
+
+        # number of notes inside the ring buffer
+        self._size = 0
+
+        # occurrences of each pitch class inside the buffer
+        self._counts = np.zeros(12, dtype=np.int64)
+
+        # running integer affinity scores of each mode of each root
+        mode_weights = get_mode_weights()
+        self._scores = np.zeros(mode_weights.shape[:3], dtype=np.int64)
+
+        # affinity weights indexed by pitch class first (contiguous for each update)
+        self._pitchClassWeights = np.ascontiguousarray(np.moveaxis(mode_weights, 3, 0))
+
+        super().__init__(buffer_size)
+
+    @property
+    def noteBuffer(self):
+        """
+        List of the notes inside the buffer, from the oldest to the newest.
+        """
+        indices = [(self._head + i) % self.bufferSize for i in range(self._size)]
+        return [musical_notes[self._ring[i]] for i in indices]
+
+    @noteBuffer.setter
+    def noteBuffer(self, notes):
+        self._head = 0
+        self._size = 0
+        self._counts[:] = 0
+        self._scores[:] = 0
+        self.push_notes(notes)
+
+    def get_histogram(self):
+        """
+        Gets the running counts of the pitch classes in the buffer.
+
+        :return: numpy array of 12 counts
+        """
+        return self._counts.copy()
+
+    def push_note(self, note):
+        """
+        Pushes a single note inside the buffer, discarding the oldest one if the buffer is full.
+
+        :param note: note in std notation
+        """
+        if self.bufferSize == 0:
+            return
+        pitch_class = pitch_class_indices[note]
+        if self._size == self.bufferSize:
+            # removing the oldest note
+            old_pitch_class = self._ring[self._head]
+            self._counts[old_pitch_class] -= 1
+            self._scores -= self._pitchClassWeights[old_pitch_class]
+            self._ring[self._head] = pitch_class
+            self._head = (self._head + 1) % self.bufferSize
+        else:
+            self._ring[(self._head + self._size) % self.bufferSize] = pitch_class
+            self._size = self._size + 1
+        self._counts[pitch_class] += 1
+        self._scores += self._pitchClassWeights[pitch_class]
+
+    def push_notes(self, new_notes):
+        """
+        Pushes new note inside the buffer.
+        If the buffer overflows, the older notes are discarded.
+
+        :param new_notes: list of new notes
+        """
+        # only the last notes can remain inside the buffer
+        for note in new_notes[-self.bufferSize:]:
+            self.push_note(note)
+
+    def update_scale(self):
+        """
+        Updates the currentMode attribute using the running affinity scores.
+
+        :return: currentMode
+        """
+        if self._size:
+            root = int(np.argmax(self._counts))
+            scores = self._scores[root].tolist()
+            # lexicographic comparison of the affinity lists, as in HarmonicState
+            mode_signature_index = scores.index(max(scores))
+            mode_index = scores[mode_signature_index].index(max(scores[mode_signature_index]))
+
+            self.currentMode['root'] = musical_notes[root]
+            self.currentMode['mode_signature_index'] = mode_signature_index
+            self.currentMode['mode_index'] = mode_index
+
+        return self.currentMode
+
+
+class DecayingHarmonicState(HarmonicState):
+    """
+    A HarmonicState without a buffer of notes: each note adds 1 to the weight of its pitch class,
+    and the 12 weights decay exponentially with the elapsed time (decay='time') or with
+    the number of pushed notes (decay='notes'), so that the old notes fade out gradually
+    instead of dropping out of a buffer all at once. Pushing a note costs O(12),
+    and the state has a constant size, independently from the length of the memory.
+
+    With a positive hysteresis, a new mode replaces the current one only when its affinity
+    (as computed by harmonic_affinities on the weights) exceeds the affinity of the current mode
+    by more than the hysteresis, so that the mode doesn't flicker between close candidates.
+    """
+
+    def __init__(self, half_life=4.0, decay='time', hysteresis=0.0):
+        if decay not in ('time', 'notes'):
+            raise ValueError("decay must be 'time' or 'notes'")
+        if not half_life > 0:
+            raise ValueError('half_life must be positive')
+        if not hysteresis >= 0:
+            raise ValueError('hysteresis must not be negative')
+
+        # time in seconds (or number of notes) after which the weight of a note is halved
+        self.halfLife = half_life
+
+        # 'time' or 'notes'
+        self.decay = decay
+
+        # minimum affinity gain needed to change the current mode
+        self.hysteresis = hysteresis
+
+        # decayed pitch class histogram
+        self._weights = np.zeros(12, dtype=np.float64)
+
+        # timestamp of the last decay of the weights
+        self._lastTimestamp = None
+
+        # False until the first mode is detected
+        self._detected = False
+
+        # the state has a weight for each pitch class
+        super().__init__(12)
+
+    @property
+    def noteBuffer(self):
+        """
+        List of the notes whose pitch class still weighs at least half a note.
+        """
+        return [musical_notes[i] for i in np.flatnonzero(self._weights >= 0.5).tolist()]
+
+    @noteBuffer.setter
+    def noteBuffer(self, notes):
+        self._weights[:] = 0
+        self._lastTimestamp = None
+        self._detected = False
+        self.push_notes(notes)
+
+    def get_histogram(self):
+        """
+        Gets the decayed weights of the pitch classes
+        (the histograms of many states can be passed at once to detect_histogram_modes).
+
+        :return: numpy array of 12 weights
+        """
+        return self._weights.copy()
+
+    def advance(self, timestamp=None):
+        """
+        Decays the weights up to a certain time (only with decay='time'),
+        ex: before updating the mode after a silence.
+
+        :param timestamp: current timestamp, if none is provided, it's calculated during the method execution
+        """
+        if self.decay != 'time':
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        if self._lastTimestamp is not None and timestamp > self._lastTimestamp:
+            self._weights *= 0.5 ** ((timestamp - self._lastTimestamp) / self.halfLife)
+        if self._lastTimestamp is None or timestamp > self._lastTimestamp:
+            self._lastTimestamp = timestamp
+
+    def push_note(self, note, timestamp=None):
+        """
+        Pushes a single note, decaying the weights of the previous ones.
+
+        :param note: note in std notation
+        :param timestamp: timestamp of the note (only with decay='time'), if none is provided,
+                          it's calculated during the method execution
+        """
+        if self.decay == 'time':
+            self.advance(timestamp)
+        else:
+            self._weights *= 0.5 ** (1 / self.halfLife)
+        self._weights[pitch_class_indices[note]] += 1
+
+    def push_notes(self, new_notes, timestamp=None):
+        """
+        Pushes new notes, all with the same timestamp.
+
+        :param new_notes: list of new notes
+        :param timestamp: timestamp of the notes (only with decay='time')
+        """
+        for note in new_notes:
+            self.push_note(note, timestamp)
+
+    def push_clusters(self, clusters):
+        """
+        Pushes the notes of chord-onset clusters (see MidiNoteQueue.get_clusters),
+        each one at the timestamp of its cluster.
+
+        :param clusters: list of clusters, each one with the list of its midi notes and its timestamp
+        """
+        for cluster in clusters:
+            self.push_notes([midi_to_std(note) for note in cluster['notes']], cluster['timestamp'])
+
+    def update_scale(self):
+        """
+        Updates the currentMode attribute using the affinities of the modes
+        computed on the decayed weights, with the same criterion of HarmonicState.
+
+        :return: currentMode
+        """
+        total = self._weights.sum()
+        if total <= 0:
+            return self.currentMode
+
+        # affinity scores of the modes of the most weighted root, [len(mode_signatures) x 7]
+        mode_weights = get_mode_weights()
+        root = int(np.argmax(self._weights))
+        scores = mode_weights[root] @ self._weights
+        signatures, modes = _select_modes(scores[None])
+        mode_signature_index, mode_index = int(signatures[0]), int(modes[0])
+
+        if self._detected and self.hysteresis > 0:
+            current = mode_weights[pitch_class_indices[self.currentMode['root']],
+                                   self.currentMode['mode_signature_index'],
+                                   self.currentMode['mode_index']] @ self._weights
+            gain = (scores[mode_signature_index, mode_index] - current) / (total * _affinity_scale)
+            if gain <= self.hysteresis:
+                return self.currentMode
+
+        self._detected = True
+        self.currentMode['root'] = musical_notes[root]
+        self.currentMode['mode_signature_index'] = mode_signature_index
+        self.currentMode['mode_index'] = mode_index
+        return self.currentMode
@@ -1,5 +1,8 @@
-import numpy as np
 from collections import Counter
+from functools import lru_cache
+from melodically.tables import LazyDict, get_table, lazy_import, register_table
+
+np = lazy_import('numpy')
 
 """
 Musical notes.
@@ -14,6 +17,13 @@ Musical notes with the flat notation
 """
 musical_notes_b = ['C', 'Db', 'D', 'Eb', 'E', 'F', 'Gb', 'G', 'Ab', 'A', 'Bb', 'B']
 
+"""
+Dictionary mapping every note in std notation (sharp or flat) to its pitch class,
+an integer from 0 (C) to 11 (B)
+"""
+pitch_class_indices = {note: i for i, note in enumerate(musical_notes)}
+pitch_class_indices.update({note: i for i, note in enumerate(musical_notes_b)})
+
 """
 This data structure contains all the
 possible semitone sequences to construct
@@ -24,6 +34,17 @@ mode_signatures = [
     # [2, 2, 1, 3, 1, 2, 1],
 ]
 
+"""
+Mode signatures used by the full mode search (see search_modes): the signatures of
+mode_signatures followed by the harmonic minor, melodic minor and harmonic major scales
+(the indices of the signatures of mode_signatures are the same in both lists)
+"""
+extended_mode_signatures = mode_signatures + [
+    [2, 1, 2, 2, 1, 3, 1],  # harmonic minor
+    [2, 1, 2, 2, 2, 2, 1],  # melodic minor
+    [2, 2, 1, 2, 1, 3, 1],  # harmonic major
+]
+
 """
 This data structure contains all the
 possible chords sequences to construct
@@ -51,20 +72,35 @@ def std_to_midi(musical_note, octave=-1):
     :return: midi note number
     """
     octave_offset = (octave + 1) * 12
-    if musical_note in musical_notes:
-        return musical_notes.index(musical_note) + octave_offset
-    else:
-        return musical_notes_b.index(musical_note) + octave_offset
+    try:
+        return pitch_class_indices[musical_note] + octave_offset
+    except KeyError:
+        raise ValueError('{} is not a valid note'.format(musical_note))
+
+
+def pitch_class_mask(notes_std):
+    """
+    Encodes a set of notes as a 12-bit mask, where the bit i is set
+    if the pitch class i is present.
+
+    :param notes_std: list of notes in std notation
+    :return: integer mask
+    """
+    mask = 0
+    for note in notes_std:
+        mask = mask | (1 << pitch_class_indices[note])
+    return mask
 
 
 def get_root(notes):
     """
     returns the most common value in the list of notes
+    (the ties are solved choosing the lowest pitch class, as detect_modes and HarmonicState)
 
     :param notes: notes in standard notation
     :return: single note in standard notation
     """
-    return max(set(notes), key=notes.count)
+    return musical_notes[int(np.argmax(pitch_class_histogram(notes)))]
 
 
 def get_all_modes(root):
@@ -74,20 +110,25 @@ def get_all_modes(root):
     :param root: note in std notation
     :return: multi dimensional list of size [len(mode_signatures)x7x7] containing the modes
     """
+    root_index = pitch_class_indices[root]
     modes_note_std = []
     for i in range(len(mode_signatures)):  # iterating for different modes families
         modes_note_std.append([])
-        current_sequence = np.array(mode_signatures[i])
         for j in range(7):  # iterating for each mode in the family
-            modes_note_std[i].append([root])
-            last_note_index = musical_notes.index(root)
-            for k in range(6):  # iterating for each note in the scale
-                last_note_index = (last_note_index + current_sequence[k]) % 12
-                modes_note_std[i][j].append(musical_notes[last_note_index])
-            current_sequence = np.roll(current_sequence, -1)  # circular shift of the note sequence
+            pitch_classes = _mode_pitch_classes(root_index, mode_signatures[i], j)
+            modes_note_std[i].append([musical_notes[p] for p in pitch_classes])
     return modes_note_std
 
 
+def _mode_pitch_classes(root_index, signature, mode_index):
+    # pitch classes of the degrees of a mode of a signature, starting from the root
+    current_sequence = signature[mode_index:] + signature[:mode_index]  # circular shift
+    pitch_classes = [root_index]
+    for k in range(6):  # iterating for each note in the scale
+        pitch_classes.append((pitch_classes[-1] + current_sequence[k]) % 12)
+    return pitch_classes
+
+
 def get_all_chords(root, scales):
     """
     given a root, calculates all the chords for all the modes
@@ -97,25 +138,68 @@ def get_all_chords(root, scales):
     :return: multi dimensional list of size [len(mode_signatures)x7x7] containing the chords for each mode
     """
     modes_chords = []
-    chord_sequence_np = np.array(chord_signatures)
     for i in range(7):  # iterating for each mode
         note_sequence = scales[0][i]
-        modes_chords.append([x + y for x, y in zip(note_sequence, chord_sequence_np.tolist())])
-        chord_sequence_np = np.roll(chord_sequence_np, -1)
+        chord_sequence = chord_signatures[i:] + chord_signatures[:i]  # circular shift
+        modes_chords.append([x + y for x, y in zip(note_sequence, chord_sequence)])
     return modes_chords
 
 
 """
 Dictionary containing all the notes as keys and
-the respective modes as value
+the respective modes as value (built the first time it's accessed)
 """
-modes_dict = {root: get_all_modes(root) for root in musical_notes}
+modes_dict = LazyDict('modes_dict', lambda: {root: get_all_modes(root) for root in musical_notes},
+                      lambda: mode_signatures)
 
 """
 Dictionary containing all the notes as keys and
-the respective chords for each mode as value
+the respective chords for each mode as value (built the first time it's accessed)
 """
-modes_chords_dict = {root: get_all_chords(root, modes_dict[root]) for root in musical_notes}
+modes_chords_dict = LazyDict('modes_chords_dict',
+                             lambda: {root: get_all_chords(root, modes_dict[root]) for root in musical_notes},
+                             lambda: (mode_signatures, chord_signatures))
+
+
+def _build_mode_masks():
+    return np.array([[[pitch_class_mask(mode) for mode in family] for family in modes_dict[root]]
+                     for root in musical_notes], dtype=np.uint16)
+
+
+register_table('mode_masks', _build_mode_masks, lambda: mode_signatures)
+
+
+def get_mode_masks():
+    """
+    Gets the 12-bit masks of the modes of each root (see pitch_class_mask).
+    The array is built the first time it's needed.
+
+    :return: numpy array of size [12 x len(mode_signatures) x 7]
+    """
+    return get_table('mode_masks')
+
+
+"""
+Affinity points used for each degree of a modal scale
+"""
+affinity_positive_weights = [1, 0.5, 3, 0.2, 0.4, 2, 0.1]
+
+"""
+Affinity points subtracted from the notes out of scale
+"""
+affinity_negative_weight = 2
+
+"""
+Points used for each degree of a mode by the full mode search (see search_modes).
+The affinity_positive_weights compare the modes of a single root, so they favour the third
+and the sixth degree; to compare the roots too, the tonic and the fifth weigh more
+(the points are the Krumhansl-Kessler profile of the major key rounded to a decimal, for all the signatures)
+"""
+search_degree_weights = [6.4, 3.5, 4.4, 4.1, 5.2, 3.7, 2.9]
+
+# factor used to turn the affinity points into integers,
+# so that the vectorized scores are computed without rounding errors
+_affinity_scale = 10
 
 
 def harmonic_affinities(root, notes_std):
@@ -129,14 +213,13 @@ def harmonic_affinities(root, notes_std):
     :return: multidimensional list containing harmonic distances between notes_std and the modes of root
     """
 
-    # affinity points used for each degree of a modal scale
-    positive_weights = [1, 0.5, 3, 0.2, 0.4, 2, 0.1]
-
-    # affinity points subtracted from the notes out of scale
-    negative_weight = 2
+    positive_weights = affinity_positive_weights
+    negative_weight = affinity_negative_weight
 
     # counting the occurrences of the input notes
     counter = Counter(notes_std)
+    root_index = pitch_class_indices[root]
+    mode_masks = get_mode_masks()
 
     # building the multidimensional affinity list
     affinities = []
@@ -148,9 +231,226 @@ def harmonic_affinities(root, notes_std):
             for k in range(7):
                 # calculating the positive weights
                 aff = aff + counter[curr_mode[k]] * positive_weights[k]
-            not_in_the_mode = [note for note in notes_std if note not in curr_mode]
-            aff = aff - len(not_in_the_mode) * negative_weight
+            # counting the notes out of the mode with a bit test on its mask
+            mode_mask = int(mode_masks[root_index, i, j])
+            not_in_the_mode = sum(count for note, count in counter.items()
+                                  if not (mode_mask >> pitch_class_indices[note]) & 1)
+            aff = aff - not_in_the_mode * negative_weight
             aff = aff / len(notes_std)  # normalizing
             affinities[i].append(aff)
 
     return affinities
+
+
+def _build_signature_weights(signatures, degree_weights):
+    positive_weights = np.rint(np.array(degree_weights) * _affinity_scale).astype(np.int64)
+    negative_weight = int(round(affinity_negative_weight * _affinity_scale))
+    weights = np.full((12, len(signatures), 7, 12), -negative_weight, dtype=np.int64)
+    for r in range(12):
+        for i, signature in enumerate(signatures):
+            if len(signature) != 7 or sum(signature) != 12:
+                raise ValueError('{} is not a signature of a 7 notes scale'.format(signature))
+            for j in range(7):
+                for k, pitch_class in enumerate(_mode_pitch_classes(r, signature, j)):
+                    weights[r, i, j, pitch_class] = positive_weights[k]
+    return weights
+
+
+register_table('mode_weights', lambda: _build_signature_weights(mode_signatures, affinity_positive_weights),
+               lambda: (mode_signatures, affinity_positive_weights, affinity_negative_weight, _affinity_scale))
+register_table('search_weights', lambda: _build_signature_weights(extended_mode_signatures, search_degree_weights),
+               lambda: (extended_mode_signatures, search_degree_weights, affinity_negative_weight, _affinity_scale))
+
+
+def get_mode_weights():
+    """
+    Gets the weight tensor used by the vectorized mode detection.
+    The element [r, i, j, p] contains the affinity points that a note with pitch class p
+    gives to the mode j of the mode signature i built on the root r
+    (scaled to integers by _affinity_scale).
+    The tensor is built the first time it's needed.
+
+    :return: numpy array of size [12 x len(mode_signatures) x 7 x 12]
+    """
+    return get_table('mode_weights')
+
+
+@lru_cache(maxsize=16)
+def _custom_search_weights(signatures):
+    return _build_signature_weights([list(signature) for signature in signatures], search_degree_weights)
+
+
+def get_search_weights(signatures=None):
+    """
+    Gets the weight tensor used by the full mode search: as in get_mode_weights, the element [r, i, j, p]
+    contains the points that a note with pitch class p gives to the mode j of the signature i built on
+    the root r, using search_degree_weights for the degrees of the mode.
+    The tensor of extended_mode_signatures is built the first time it's needed,
+    the ones of the other lists of signatures are cached.
+
+    :param signatures: list of signatures, each one a list of 7 intervals in semitones
+                       (extended_mode_signatures if None)
+    :return: numpy array of size [12 x len(signatures) x 7 x 12]
+    """
+    if signatures is None:
+        return get_table('search_weights')
+    return _custom_search_weights(tuple(tuple(signature) for signature in signatures))
+
+
+def pitch_class_histogram(notes_std):
+    """
+    Counts the occurrences of each pitch class in a list of notes.
+
+    :param notes_std: list of notes in std notation (sharp or flat)
+    :return: numpy array of 12 integer counts
+    """
+    indices = [pitch_class_indices[note] for note in notes_std]
+    return np.bincount(indices, minlength=12).astype(np.int64)
+
+
+def _mode_scores(histograms):
+    # integer affinity scores of shape [N x 12 x len(mode_signatures) x 7]
+    mode_weights = get_mode_weights()
+    scores = histograms @ mode_weights.reshape(-1, 12).T
+    return scores.reshape((len(histograms),) + mode_weights.shape[:3])
+
+
+def batch_harmonic_affinities(histograms):
+    """
+    Vectorized version of harmonic_affinities, that computes the affinities
+    of all the modes of all the 12 roots for many pitch class histograms at once.
+
+    :param histograms: array of size [N x 12] of pitch class counts
+    :return: numpy array of size [N x 12 x len(mode_signatures) x 7] containing the affinities
+    """
+    histograms = np.atleast_2d(np.asarray(histograms, dtype=np.int64))
+    totals = np.maximum(histograms.sum(axis=1), 1) * _affinity_scale
+    return _mode_scores(histograms) / totals[:, None, None, None]
+
+
+def _select_modes(scores):
+    # signature and mode index chosen among the modes of a root, scores of size [N x len(mode_signatures) x 7];
+    # the signature is chosen comparing the affinity lists lexicographically,
+    # as done by max() on the nested lists returned by harmonic_affinities
+    candidates = np.ones(scores.shape[:2], dtype=bool)
+    lowest = np.iinfo(np.int64).min if scores.dtype.kind == 'i' else -np.inf
+    for j in range(7):
+        column = np.where(candidates, scores[:, :, j], lowest)
+        maximum = column.max(axis=1, keepdims=True)
+        if scores.dtype.kind == 'i':
+            candidates &= column == maximum
+        else:
+            # float scores (decayed histograms) equal up to the rounding errors
+            candidates &= column >= maximum - 1e-9 * np.abs(maximum)
+    signatures = np.argmax(candidates, axis=1)
+    modes = np.argmax(scores[np.arange(len(scores)), signatures], axis=1)
+    return signatures, modes
+
+
+def detect_histogram_modes(histograms):
+    """
+    Finds the most affine modal scale for each pitch class histogram, with the
+    same criterion used by HarmonicState (see detect_modes).
+    The histograms can contain real weights, as the ones of DecayingHarmonicState.
+
+    :param histograms: array of size [N x 12] of pitch class counts or weights
+    :return: list of N mode dictionaries (None for the empty histograms)
+    """
+    histograms = np.asarray(histograms)
+    if histograms.dtype.kind != 'f':
+        histograms = histograms.astype(np.int64)
+    histograms = histograms.reshape(-1, 12)
+    roots = np.argmax(histograms, axis=1)
+    scores = _mode_scores(histograms)[np.arange(len(histograms)), roots]
+    signatures, modes = _select_modes(scores)
+
+    result = []
+    for histogram, root, signature, mode in zip(histograms, roots, signatures, modes):
+        if histogram.any():
+            result.append({
+                'root': musical_notes[root],
+                'mode_signature_index': int(signature),
+                'mode_index': int(mode)
+            })
+        else:
+            result.append(None)
+    return result
+
+
+def detect_modes(note_buffers):
+    """
+    Finds the most affine modal scale for each buffer of notes, with the
+    same criterion used by HarmonicState: the root is the most common note
+    and the mode is chosen among the modes of that root using harmonic_affinities.
+
+    :param note_buffers: list of N lists of notes in std notation
+    :return: list of N mode dictionaries (None for the empty buffers)
+    """
+    histograms = np.array([pitch_class_histogram(notes) for notes in note_buffers], dtype=np.int64)
+    return detect_histogram_modes(histograms)
+
+
+def search_histogram_modes(histograms, k=5, signatures=None, temperature=0.5):
+    """
+    Scores every mode of every signature on every root for each pitch class histogram,
+    instead of considering only the modes of the most common note as detect_modes does,
+    and returns the k most affine modes. All the candidates are scored at once,
+    with a single product between the histograms and the weight tensor (see get_search_weights).
+    The confidence of a mode is the softmax of the affinities of all the candidates.
+
+    :param histograms: array of size [N x 12] of pitch class counts or weights
+    :param k: number of modes returned for each histogram (all the candidates if None)
+    :param signatures: list of mode signatures (extended_mode_signatures if None)
+    :param temperature: positive temperature of the softmax, lower values give more peaked confidences
+    :return: list of N lists of k mode dictionaries (root, mode_signature_index, mode_index, notes,
+             affinity and confidence), sorted by affinity (empty lists for the empty histograms)
+    """
+    if k is not None and k < 1:
+        raise ValueError('k must be at least 1 (or None for all the modes)')
+    if not temperature > 0:
+        raise ValueError('temperature must be positive')
+    if signatures is None:
+        signatures = extended_mode_signatures
+    weights = get_search_weights(signatures)
+    histograms = np.asarray(histograms, dtype=np.float64).reshape(-1, 12)
+    totals = histograms.sum(axis=1)
+
+    # affinities of all the candidates, [N x (12 * len(signatures) * 7)]
+    affinities = histograms @ weights.reshape(-1, 12).T / (np.maximum(totals, 1e-12) * _affinity_scale)[:, None]
+    exponentials = np.exp((affinities - affinities.max(axis=1, keepdims=True)) / temperature)
+    confidences = exponentials / exponentials.sum(axis=1, keepdims=True)
+    best = np.argsort(-affinities, axis=1, kind='stable')[:, :k]
+
+    result = []
+    for n in range(len(histograms)):
+        modes = []
+        if totals[n] > 0:
+            for candidate in best[n].tolist():
+                root, rest = divmod(candidate, len(signatures) * 7)
+                signature_index, mode_index = divmod(rest, 7)
+                modes.append({
+                    'root': musical_notes[root],
+                    'mode_signature_index': signature_index,
+                    'mode_index': mode_index,
+                    'notes': [musical_notes[p] for p in _mode_pitch_classes(root, signatures[signature_index],
+                                                                          mode_index)],
+                    'affinity': float(affinities[n, candidate]),
+                    'confidence': float(confidences[n, candidate])
+                })
+        result.append(modes)
+    return result
+
+
+def search_modes(note_buffers, k=5, signatures=None, temperature=0.5):
+    """
+    Finds the k most affine modes of each buffer of notes, searching all the roots
+    (see search_histogram_modes).
+
+    :param note_buffers: list of N lists of notes in std notation
+    :param k: number of modes returned for each buffer (all the candidates if None)
+    :param signatures: list of mode signatures (extended_mode_signatures if None)
+    :param temperature: positive temperature of the softmax used for the confidences
+    :return: list of N lists of k mode dictionaries, sorted by affinity
+    """
+    histograms = np.array([pitch_class_histogram(notes) for notes in note_buffers], dtype=np.int64)
+    return search_histogram_modes(histograms, k, signatures, temperature)
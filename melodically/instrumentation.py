@@ -0,0 +1,331 @@
+import functools
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from melodically.harmonic_state import HarmonicState, IncrementalHarmonicState, DecayingHarmonicState
+from melodically.midi_note_queue import MidiNoteQueue, CompactMidiNoteQueue
+
+"""
+Upper bounds in seconds of the buckets of the latency histograms (from 1 microsecond to about 8 seconds)
+"""
+latency_buckets = [1e-6 * 2 ** i for i in range(24)]
+
+# registry collecting the metrics, None when the instrumentation is disabled
+_registry = None
+
+# original methods replaced while the instrumentation is enabled: (class, name, function)
+_originals = []
+
+
+def queue_size(midi_queue):
+    """
+    Gets the number of messages of a MidiNoteQueue or CompactMidiNoteQueue, without copies.
+
+    :param midi_queue: MidiNoteQueue or CompactMidiNoteQueue object
+    :return: number of messages
+    """
+    if isinstance(midi_queue, CompactMidiNoteQueue):
+        return len(midi_queue)
+    return len(midi_queue.get_container())
+
+
+def _buffer_size(harmonic_state):
+    if isinstance(harmonic_state, IncrementalHarmonicState):
+        return harmonic_state._size
+    return len(harmonic_state.noteBuffer)
+
+
+class Histogram:
+    """
+    Histogram of latencies in seconds, with fixed buckets.
+    """
+
+    def __init__(self, buckets=latency_buckets):
+        # upper bounds of the buckets
+        self.buckets = list(buckets)
+
+        # observations of each bucket, the last one is for the values over the last bound
+        self.counts = [0] * (len(self.buckets) + 1)
+
+        # sum of the observed values
+        self.sum = 0.0
+
+        # number of observed values
+        self.count = 0
+
+    def observe(self, value):
+        """
+        Adds a value to the histogram.
+
+        :param value: latency in seconds
+        """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_cumulative_counts(self):
+        """
+        Gets the number of observations lower or equal to each bound (the last one is +Inf).
+
+        :return: list of (bound, count)
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + [float('inf')], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class MetricsRegistry:
+    """
+    Collects the metrics of the instrumented functions and methods:
+    latency histograms, counters and gauges. Each metric has a name and a source
+    (the instrumented class or function, ex: MidiNoteQueue or parse_melody).
+    The registry is filled only while the instrumentation is enabled (see instrument).
+    """
+
+    def __init__(self, buckets=latency_buckets):
+        self._lock = threading.Lock()
+
+        # upper bounds of the buckets of the latency histograms
+        self._buckets = buckets
+
+        # counters and gauges: name -> source -> value
+        self.counters = {}
+        self.gauges = {}
+
+        # latency histograms: source -> Histogram
+        self.latencies = {}
+
+    def increment(self, name, source, value=1):
+        """
+        Increments a counter.
+
+        :param name: name of the counter (ex: events_pushed)
+        :param source: instrumented class or function
+        :param value: increment
+        """
+        with self._lock:
+            counters = self.counters.setdefault(name, {})
+            counters[source] = counters.get(source, 0) + value
+
+    def set_gauge(self, name, source, value):
+        """
+        Sets the value of a gauge.
+
+        :param name: name of the gauge (ex: queue_size)
+        :param source: instrumented class or function
+        :param value: new value
+        """
+        with self._lock:
+            self.gauges.setdefault(name, {})[source] = value
+
+    def observe(self, source, seconds):
+        """
+        Adds a latency to the histogram of a function.
+
+        :param source: instrumented function
+        :param seconds: latency in seconds
+        """
+        with self._lock:
+            histogram = self.latencies.get(source)
+            if histogram is None:
+                histogram = self.latencies[source] = Histogram(self._buckets)
+            histogram.observe(seconds)
+
+    def reset(self):
+        """
+        Removes all the collected metrics.
+        """
+        with self._lock:
+            self.counters = {}
+            self.gauges = {}
+            self.latencies = {}
+
+    def snapshot(self):
+        """
+        Gets a copy of the collected metrics.
+
+        :return: dictionary with counters and gauges (name -> source -> value) and latencies
+                 (source -> dictionary with count, sum and the cumulative counts of the buckets)
+        """
+        with self._lock:
+            return {
+                'counters': {name: dict(values) for name, values in self.counters.items()},
+                'gauges': {name: dict(values) for name, values in self.gauges.items()},
+                'latencies': {source: {'count': histogram.count, 'sum': histogram.sum,
+                                       'buckets': histogram.get_cumulative_counts()}
+                              for source, histogram in self.latencies.items()}
+            }
+
+    def to_prometheus(self, prefix='melodically'):
+        """
+        Formats the collected metrics in the Prometheus text exposition format.
+
+        :param prefix: prefix of the metric names
+        :return: string
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name, values in sorted(snapshot['counters'].items()):
+            lines.append('# TYPE {}_{}_total counter'.format(prefix, name))
+            for source, value in sorted(values.items()):
+                lines.append('{}_{}_total{{source="{}"}} {}'.format(prefix, name, source, value))
+        for name, values in sorted(snapshot['gauges'].items()):
+            lines.append('# TYPE {}_{} gauge'.format(prefix, name))
+            for source, value in sorted(values.items()):
+                lines.append('{}_{}{{source="{}"}} {}'.format(prefix, name, source, value))
+        if snapshot['latencies']:
+            lines.append('# TYPE {}_latency_seconds histogram'.format(prefix))
+        for source, histogram in sorted(snapshot['latencies'].items()):
+            for bound, count in histogram['buckets']:
+                lines.append('{}_latency_seconds_bucket{{source="{}",le="{}"}} {}'.format(
+                    prefix, source, '+Inf' if bound == float('inf') else repr(bound), count))
+            lines.append('{}_latency_seconds_sum{{source="{}"}} {!r}'.format(prefix, source, histogram['sum']))
+            lines.append('{}_latency_seconds_count{{source="{}"}} {}'.format(prefix, source, histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, target, prefix='melodically'):
+        """
+        Writes the metrics in the Prometheus text format to a file (replaced atomically,
+        as expected by the textfile collectors), a connected socket or a writable stream.
+
+        :param target: path of the file, socket or stream
+        :param prefix: prefix of the metric names
+        """
+        text = self.to_prometheus(prefix)
+        if isinstance(target, (str, bytes, os.PathLike)):
+            temporary_path = '{}.{}.tmp'.format(os.fsdecode(target), os.getpid())
+            with open(temporary_path, 'w') as file:
+                file.write(text)
+            os.replace(temporary_path, target)
+        elif hasattr(target, 'sendall'):
+            target.sendall(text.encode())
+        else:
+            target.write(text)
+
+
+def instrumented(source, gauge=None, size=None):
+    """
+    Decorator measuring the latency of a function while the instrumentation is enabled.
+    When it's disabled, the only overhead is the check of a global variable.
+
+    :param source: name of the function in the metrics
+    :param gauge: optional name of a gauge set before each call
+    :param size: function of the first argument of the call returning the value of the gauge
+    :return: decorator
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            registry = _registry
+            if registry is None:
+                return function(*args, **kwargs)
+            if gauge is not None:
+                registry.set_gauge(gauge, source, size(args[0]))
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                registry.observe(source, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def _instrument_push(push, source, size):
+    # push counting the accepted and dropped messages, as seen from the size of the queue
+    @functools.wraps(push)
+    def instrumented_push(self, msg_type, note, timestamp=None):
+        registry = _registry
+        previous_size = size(self)
+        start = time.perf_counter()
+        push(self, msg_type, note, timestamp)
+        registry.observe(source + '.push', time.perf_counter() - start)
+        new_size = size(self)
+        if new_size > previous_size:
+            registry.increment('events_pushed', source)
+        elif msg_type == 'note_on':
+            registry.increment('events_dropped_interval', source)
+        elif msg_type == 'note_off':
+            registry.increment('events_dropped_unmatched', source)
+        else:
+            registry.increment('events_ignored', source)
+        registry.set_gauge('queue_size', source, new_size)
+    return instrumented_push
+
+
+def _instrument_update_scale(update_scale, source):
+    @functools.wraps(update_scale)
+    def instrumented_update_scale(self):
+        registry = _registry
+        registry.set_gauge('buffer_size', source, _buffer_size(self))
+        start = time.perf_counter()
+        try:
+            return update_scale(self)
+        finally:
+            registry.observe(source + '.update_scale', time.perf_counter() - start)
+    return instrumented_update_scale
+
+
+def enable_instrumentation(registry=None):
+    """
+    Enables the instrumentation of the queues (push), of the harmonic states (update_scale)
+    and of the parsers (parse_rhythm, parse_melody). The methods called for every message
+    are replaced only while the instrumentation is enabled, so that they have no overhead otherwise.
+
+    :param registry: MetricsRegistry collecting the metrics (a new one if None)
+    :return: the registry
+    """
+    global _registry
+    if _registry is not None:
+        raise RuntimeError('the instrumentation is already enabled')
+    registry = MetricsRegistry() if registry is None else registry
+    for cls, size in [(MidiNoteQueue, queue_size), (CompactMidiNoteQueue, len)]:
+        _originals.append((cls, 'push', cls.__dict__['push']))
+        cls.push = _instrument_push(cls.__dict__['push'], cls.__name__, size)
+    for cls in [HarmonicState, IncrementalHarmonicState, DecayingHarmonicState]:
+        _originals.append((cls, 'update_scale', cls.__dict__['update_scale']))
+        cls.update_scale = _instrument_update_scale(cls.__dict__['update_scale'], cls.__name__)
+    _registry = registry
+    return registry
+
+
+def disable_instrumentation():
+    """
+    Disables the instrumentation, restoring the original methods.
+
+    :return: the registry used while enabled (None if the instrumentation wasn't enabled)
+    """
+    global _registry
+    while _originals:
+        cls, name, function = _originals.pop()
+        setattr(cls, name, function)
+    registry, _registry = _registry, None
+    return registry
+
+
+def get_registry():
+    """
+    Gets the registry of the enabled instrumentation.
+
+    :return: MetricsRegistry, or None if the instrumentation is disabled
+    """
+    return _registry
+
+
+@contextmanager
+def instrument(registry=None):
+    """
+    Context manager enabling the instrumentation inside its block.
+
+    :param registry: MetricsRegistry collecting the metrics (a new one if None)
+    :return: the registry
+    """
+    registry = enable_instrumentation(registry)
+    try:
+        yield registry
+    finally:
+        disable_instrumentation()
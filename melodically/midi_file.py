@@ -0,0 +1,181 @@
+import struct
+from melodically.tables import lazy_import
+
+np = lazy_import('numpy')
+
+# default tempo of a Standard MIDI File in microseconds per quarter note (120 bpm)
+_default_tempo = 500000
+
+
+# channel of the General MIDI percussion (channel 10, counted from 0)
+_drum_channel = 9
+
+
+def _read_variable_length(data, position):
+    # reads a variable length quantity, returning the value and the next position
+    value = 0
+    while True:
+        if position >= len(data):
+            raise ValueError('truncated track chunk')
+        byte = data[position]
+        position = position + 1
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            return value, position
+
+
+def _read_track(data, drums=False):
+    # list of (tick, msg_type, note) and list of (tick, tempo) of a track chunk,
+    # the truncated events raise ValueError
+    messages = []
+    tempos = []
+    position = 0
+    tick = 0
+    status = 0
+    while position < len(data):
+        delta, position = _read_variable_length(data, position)
+        tick = tick + delta
+        if position >= len(data):
+            raise ValueError('truncated track chunk')
+        if data[position] & 0x80:
+            status = data[position]
+            position = position + 1
+        elif not status:
+            raise ValueError('running status without a previous status')
+        # otherwise the running status is used
+
+        if status == 0xFF:
+            # meta event
+            if position >= len(data):
+                raise ValueError('truncated track chunk')
+            meta_type = data[position]
+            length, position = _read_variable_length(data, position + 1)
+            if position + length > len(data):
+                raise ValueError('truncated track chunk')
+            if meta_type == 0x51 and length == 3:
+                tempos.append((tick, int.from_bytes(data[position:position + 3], 'big')))
+            elif meta_type == 0x2F:
+                break  # end of track
+            position = position + length
+        elif status in (0xF0, 0xF7):
+            # system exclusive event
+            length, position = _read_variable_length(data, position)
+            if position + length > len(data):
+                raise ValueError('truncated track chunk')
+            position = position + length
+        else:
+            kind = status & 0xF0
+            size = 1 if kind in (0xC0, 0xD0) else 2
+            if position + size > len(data):
+                raise ValueError('truncated track chunk')
+            if size == 1:
+                position = position + 1
+                continue
+            note, velocity = data[position], data[position + 1]
+            position = position + 2
+            if not drums and status & 0x0F == _drum_channel:
+                continue  # percussion, without pitch
+            if kind == 0x90 and velocity > 0:
+                messages.append((tick, 'note_on', note))
+            elif kind == 0x80 or kind == 0x90:
+                messages.append((tick, 'note_off', note))
+    return messages, tempos
+
+
+def read_midi_file(path, drums=False):
+    """
+    Reads the note_on/off messages of each track of a Standard MIDI File.
+    The timestamps are expressed in seconds from the beginning of the file,
+    following the tempo changes. A truncated or malformed file raises ValueError.
+
+    :param path: path of the midi file
+    :param drums: if True, the notes of the General MIDI percussion channel (10) are kept
+    :return: (list of tracks, each one a list of midi messages with timestamp, bpm of the first tempo)
+    """
+    with open(path, 'rb') as file:
+        data = file.read()
+    if data[:4] != b'MThd':
+        raise ValueError('{} is not a Standard MIDI File'.format(path))
+    if len(data) < 14:
+        raise ValueError('{} has a truncated header'.format(path))
+    header_length, _, n_tracks, division = struct.unpack('>IHHH', data[4:14])
+    if header_length < 6 or division == 0:
+        raise ValueError('{} has an invalid header'.format(path))
+
+    # reading the track chunks
+    tracks = []
+    tempos = []
+    position = 8 + header_length
+    while position < len(data) and len(tracks) < n_tracks:
+        if position + 8 > len(data):
+            raise ValueError('{} has a truncated chunk'.format(path))
+        chunk_type = data[position:position + 4]
+        chunk_length = struct.unpack('>I', data[position + 4:position + 8])[0]
+        if position + 8 + chunk_length > len(data):
+            raise ValueError('{} has a truncated chunk'.format(path))
+        chunk = data[position + 8:position + 8 + chunk_length]
+        position = position + 8 + chunk_length
+        if chunk_type == b'MTrk':
+            messages, track_tempos = _read_track(chunk, drums)
+            tracks.append(messages)
+            tempos.extend(track_tempos)
+
+    # tempo map used to convert the ticks in seconds
+    tempos.sort()
+    if not tempos or tempos[0][0] > 0:
+        tempos.insert(0, (0, _default_tempo))
+    tempo_ticks = np.array([t for t, _ in tempos], dtype=np.float64)
+    if division & 0x8000:
+        # SMPTE division: ticks per frame and frames per second
+        seconds_per_tick = np.full(len(tempos), 1 / ((256 - (division >> 8)) * (division & 0xFF)))
+    else:
+        seconds_per_tick = np.array([tempo / 1e6 / division for _, tempo in tempos])
+    tempo_seconds = np.concatenate([[0], np.cumsum(np.diff(tempo_ticks) * seconds_per_tick[:-1])])
+
+    result = []
+    for messages in tracks:
+        ticks = np.array([tick for tick, _, _ in messages], dtype=np.float64)
+        segments = np.searchsorted(tempo_ticks, ticks, side='right') - 1
+        seconds = tempo_seconds[segments] + (ticks - tempo_ticks[segments]) * seconds_per_tick[segments]
+        result.append([{'type': msg_type, 'note': note, 'timestamp': timestamp}
+                       for (_, msg_type, note), timestamp in zip(messages, seconds.tolist())])
+    return result, 60e6 / tempos[0][1]
+
+
+def write_midi_file(path, tracks, bpm=120, ticks_per_beat=480):
+    """
+    Writes a format 1 Standard MIDI File, containing a track for each list of messages.
+
+    :param path: path of the midi file
+    :param tracks: list of tracks, each one a list of midi messages with timestamp in seconds
+    :param bpm: tempo of the file
+    :param ticks_per_beat: resolution of the file
+    """
+    ticks_per_second = ticks_per_beat * bpm / 60
+    tempo = int(round(60e6 / bpm))
+    chunks = [b'MThd' + struct.pack('>IHHH', 6, 1, len(tracks) + 1, ticks_per_beat)]
+
+    # tempo track
+    tempo_track = b'\x00\xff\x51\x03' + tempo.to_bytes(3, 'big') + b'\x00\xff\x2f\x00'
+    chunks.append(b'MTrk' + struct.pack('>I', len(tempo_track)) + tempo_track)
+
+    for messages in tracks:
+        track = bytearray()
+        last_tick = 0
+        for msg in sorted(messages, key=lambda m: m['timestamp']):
+            tick = int(round(msg['timestamp'] * ticks_per_second))
+            delta = tick - last_tick
+            last_tick = tick
+            # variable length quantity
+            quantity = [delta & 0x7F]
+            delta = delta >> 7
+            while delta:
+                quantity.insert(0, (delta & 0x7F) | 0x80)
+                delta = delta >> 7
+            track.extend(quantity)
+            track.extend([0x90 if msg['type'] == 'note_on' else 0x80, msg['note'], 64])
+        track.extend(b'\x00\xff\x2f\x00')
+        chunks.append(b'MTrk' + struct.pack('>I', len(track)) + bytes(track))
+
+    with open(path, 'wb') as file:
+        file.write(b''.join(chunks))
@@ -1,5 +1,9 @@
 import time
-from melodically.harmony import midi_to_std
+from collections import deque
+from melodically.harmony import midi_to_std, musical_notes
+from melodically.tables import lazy_import
+
+np = lazy_import('numpy')
 
 
 class MidiNoteQueue:
@@ -7,14 +11,27 @@ class MidiNoteQueue:
     A midi queue containing note_on/off midi messages and timestamps
     (the data structure returned by the get_timestamp_msg function).
     This queue is used by the rhythmic parser algorithm.
+
+    In polyphonic mode, the note_ons close to each other are all kept: they are grouped
+    into chord-onset clusters (see get_clusters), and the parsers use the top voice
+    of the clusters as melody (see get_melody_container).
     """
 
-    def __init__(self):
+    def __init__(self, polyphonic=False, cluster_window=0.06):
         # container used to implement the queue
         self._container = []
 
+        # True if the note_ons close to each other are kept
+        self.polyphonic = polyphonic
+
+        # maximum distance in seconds between the first and the last note_on of a cluster
+        self._clusterWindow = cluster_window
+
+        # polyphonic mode: note_on messages not closed yet, for each midi note
+        self._activeVoices = {}
+
         # timestamp of the last note_on message
-        self._lastTimestamp = 0
+        self._lastTimestamp = float('-inf')
 
         # list of midi values of the note_on messages that are not closed yet
         self._openNoteOnList = []
@@ -22,10 +39,35 @@ class MidiNoteQueue:
         # threshold in seconds to discard notes that are too close
         self._minimumInterval = 0.06
 
+        # functions called with (msg_type, note, timestamp) for each message accepted by the queue
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """
+        Adds a function called with (msg_type, note, timestamp) every time
+        a message is accepted by the queue (ex: TempoTracker.push).
+
+        :param listener: function to call
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """
+        Removes a function added with add_listener.
+
+        :param listener: function to remove
+        """
+        self._listeners.remove(listener)
+
+    def _notify(self, msg_type, note, timestamp):
+        for listener in self._listeners:
+            listener(msg_type, note, timestamp)
+
     def push(self, msg_type, note, timestamp=None):
         """
         Pushes a note_on/off message in the queue.
-        If the note_on message is too close with the last note_on, the new entry is discarded.
+        If the note_on message is too close with the last note_on, the new entry is discarded
+        (only in monophonic mode).
         If a note_off message doesn't close a note_on message, the new entry is discarded.
 
         :param msg_type: 'note_on' or 'note_off'
@@ -34,11 +76,14 @@ class MidiNoteQueue:
         """
 
         # getting the timestamp if none is provided
-        if not timestamp:
+        if timestamp is None:
             timestamp = time.time()
 
+        if self.polyphonic:
+            self._push_polyphonic(msg_type, note, timestamp)
+
         # note_on case
-        if msg_type == 'note_on':
+        elif msg_type == 'note_on':
             # checking if the pushed note_on is too close with the last one
             if timestamp - self._lastTimestamp > self._minimumInterval:
                 self._lastTimestamp = timestamp
@@ -48,6 +93,7 @@ class MidiNoteQueue:
                     'note': note,
                     'timestamp': timestamp
                 })
+                self._notify(msg_type, note, timestamp)
 
         # note_off case
         elif msg_type == 'note_off':
@@ -59,9 +105,27 @@ class MidiNoteQueue:
                     'note': note,
                     'timestamp': timestamp
                 })
+                self._notify(msg_type, note, timestamp)
 
         # all other types of midi messages are excluded automatically
 
+    def _push_polyphonic(self, msg_type, note, timestamp):
+        # every note_on is kept, and the active voice table pairs each note_off with its note_on
+        if msg_type == 'note_on':
+            msg = {'type': msg_type, 'note': note, 'timestamp': timestamp}
+            self._lastTimestamp = timestamp
+            self._activeVoices.setdefault(note, deque()).append(msg)
+            self._container.append(msg)
+            self._notify(msg_type, note, timestamp)
+        elif msg_type == 'note_off':
+            voices = self._activeVoices.get(note)
+            if voices:
+                voices.popleft()
+                if not voices:
+                    del self._activeVoices[note]
+                self._container.append({'type': msg_type, 'note': note, 'timestamp': timestamp})
+                self._notify(msg_type, note, timestamp)
+
     def pop(self):
         """
         Pops a midi message from the front of the queue.
@@ -70,6 +134,61 @@ class MidiNoteQueue:
         """
         return self._container.pop(0)
 
+    def _scan_clusters(self):
+        # groups the note_ons of the container into clusters (lists of indices),
+        # and pairs them with their note_offs (index of the note_on -> note_off message)
+        clusters = []
+        note_offs = {}
+        voices = {}
+        cluster_start = 0
+        for i, msg in enumerate(self._container):
+            if msg['type'] == 'note_on':
+                voices.setdefault(msg['note'], deque()).append(i)
+                if clusters and msg['timestamp'] - cluster_start <= self._clusterWindow:
+                    clusters[-1].append(i)
+                else:
+                    clusters.append([i])
+                    cluster_start = msg['timestamp']
+            elif voices.get(msg['note']):
+                note_offs[voices[msg['note']].popleft()] = msg
+        return clusters, note_offs
+
+    def get_clusters(self):
+        """
+        Groups the note_on messages into chord-onset clusters: a cluster contains the notes
+        starting within cluster_window seconds from its first note.
+
+        :return: list of clusters, dictionaries with the timestamp of the first note_on and the list of midi notes
+        """
+        return [{
+            'timestamp': self._container[cluster[0]]['timestamp'],
+            'notes': [self._container[i]['note'] for i in cluster]
+        } for cluster in self._scan_clusters()[0]]
+
+    def get_melody_container(self):
+        """
+        Gets the melody of the queue as a list of monophonic midi messages: for each cluster,
+        the highest closed note is kept, and its note_off is anticipated if it overlaps the next one.
+
+        :return: list of midi messages with timestamp
+        """
+        clusters, note_offs = self._scan_clusters()
+        melody = []
+        for cluster in clusters:
+            closed = [i for i in cluster if i in note_offs]
+            if closed:
+                melody.append(max(closed, key=lambda i: self._container[i]['note']))
+
+        result = []
+        for k, i in enumerate(melody):
+            note_on = self._container[i]
+            offset = note_offs[i]['timestamp']
+            if k + 1 < len(melody):
+                offset = min(offset, self._container[melody[k + 1]]['timestamp'])
+            result.append(note_on)
+            result.append({'type': 'note_off', 'note': note_on['note'], 'timestamp': offset})
+        return result
+
     def get_container(self):
         """
         Getter for the container used for the queue.
@@ -96,6 +215,11 @@ class MidiNoteQueue:
         """
         Removes from the queue the unclosed note_on messages.
         """
+        if self.polyphonic:
+            open_messages = {id(msg) for voices in self._activeVoices.values() for msg in voices}
+            self._container[:] = [msg for msg in self._container if id(msg) not in open_messages]
+            self._activeVoices.clear()
+            return
         for open_note in self._openNoteOnList:
             index = len(self._container) - 1  # the index the we're checking
             # searching for the most recent note_on with note == open_note
@@ -109,5 +233,412 @@ class MidiNoteQueue:
         Removes all the elements from the queue.
         """
         self._container.clear()
-        self._lastTimestamp = 0
+        self._lastTimestamp = float('-inf')
         self._openNoteOnList = []
+        self._activeVoices.clear()
+
+
+"""
+Message types stored by the CompactMidiNoteQueue, the position
+in the list is the type code (0 marks a removed event)
+"""
+midi_event_types = [None, 'note_on', 'note_off']
+
+
+class CompactMidiNoteQueue:
+    """
+    A MidiNoteQueue that stores the events in preallocated typed arrays
+    (uint8 note, uint8 type code, float64 timestamp) instead of a list of dictionaries.
+    Push, pop and the removal of the unclosed note_ons take a constant time,
+    and the note and timestamp columns can be accessed as numpy arrays without copies.
+    """
+
+    def __init__(self, capacity=1024):
+        # columns used to store the events
+        self._notes = np.zeros(capacity, dtype=np.uint8)
+        self._types = np.zeros(capacity, dtype=np.uint8)
+        self._timestamps = np.zeros(capacity, dtype=np.float64)
+
+        # the events are stored between the head (included) and the tail (excluded)
+        self._head = 0
+        self._tail = 0
+
+        # number of the removed events still stored between head and tail
+        self._removed = 0
+
+        # absolute position of the first element of the columns,
+        # used to keep valid the positions of the open note_ons when the columns are moved
+        self._offset = 0
+
+        # timestamp of the last note_on message
+        self._lastTimestamp = float('-inf')
+
+        # absolute positions of the note_on messages that are not closed yet, for each midi note
+        self._openNoteOns = [deque() for _ in range(128)]
+
+        # midi notes that have at least an open note_on
+        self._openNotes = set()
+
+        # threshold in seconds to discard notes that are too close
+        self._minimumInterval = 0.06
+
+        # functions called with (msg_type, note, timestamp) for each message accepted by the queue
+        self._listeners = []
+
+    def __len__(self):
+        return self._tail - self._head - self._removed
+
+    def _reserve(self):
+        # makes space for a new event at the tail of the columns
+        if self._tail < len(self._timestamps):
+            return
+        size = self._tail - self._head
+        if (size + 1) * 2 > len(self._timestamps):
+            # growing the columns
+            capacity = max(len(self._timestamps) * 2, 16)
+            self._notes = np.resize(self._notes, capacity)
+            self._types = np.resize(self._types, capacity)
+            self._timestamps = np.resize(self._timestamps, capacity)
+        # moving the events at the front of the columns
+        for column in (self._notes, self._types, self._timestamps):
+            column[:size] = column[self._head:self._tail]
+        self._offset = self._offset + self._head
+        self._head = 0
+        self._tail = size
+
+    def _append(self, type_code, note, timestamp):
+        self._reserve()
+        self._notes[self._tail] = note
+        self._types[self._tail] = type_code
+        self._timestamps[self._tail] = timestamp
+        self._tail = self._tail + 1
+
+    def add_listener(self, listener):
+        """
+        Adds a function called with (msg_type, note, timestamp) every time
+        a message is accepted by the queue (ex: TempoTracker.push).
+
+        :param listener: function to call
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """
+        Removes a function added with add_listener.
+
+        :param listener: function to remove
+        """
+        self._listeners.remove(listener)
+
+    def _notify(self, msg_type, note, timestamp):
+        for listener in self._listeners:
+            listener(msg_type, note, timestamp)
+
+    def push(self, msg_type, note, timestamp=None):
+        """
+        Pushes a note_on/off message in the queue.
+        If the note_on message is too close with the last note_on, the new entry is discarded.
+        If a note_off message doesn't close a note_on message, the new entry is discarded.
+
+        :param msg_type: 'note_on' or 'note_off'
+        :param note: midi note value
+        :param timestamp: optional timestamp value, if none is provided, it's calculated during the method execution
+        """
+
+        # getting the timestamp if none is provided
+        if timestamp is None:
+            timestamp = time.time()
+
+        # note_on case
+        if msg_type == 'note_on':
+            # checking if the pushed note_on is too close with the last one
+            if timestamp - self._lastTimestamp > self._minimumInterval:
+                self._lastTimestamp = timestamp
+                self._append(1, note, timestamp)
+                self._openNoteOns[note].append(self._offset + self._tail - 1)
+                self._openNotes.add(note)
+                self._notify(msg_type, note, timestamp)
+
+        # note_off case
+        elif msg_type == 'note_off':
+            # checking if the note_off closes a note on
+            open_note_ons = self._openNoteOns[note]
+            if open_note_ons:
+                open_note_ons.popleft()
+                if not open_note_ons:
+                    self._openNotes.discard(note)
+                self._append(2, note, timestamp)
+                self._notify(msg_type, note, timestamp)
+
+        # all other types of midi messages are excluded automatically
+
+    def _skip_removed(self):
+        # moves the head after the removed events
+        while self._head < self._tail and self._types[self._head] == 0:
+            self._head = self._head + 1
+            self._removed = self._removed - 1
+
+    def pop(self):
+        """
+        Pops a midi message from the front of the queue.
+
+        :return: midi message with timestamp
+        """
+        self._skip_removed()
+        if self._head == self._tail:
+            raise IndexError('pop from empty queue')
+        msg = {
+            'type': midi_event_types[self._types[self._head]],
+            'note': int(self._notes[self._head]),
+            'timestamp': float(self._timestamps[self._head])
+        }
+        self._head = self._head + 1
+        self._skip_removed()
+        return msg
+
+    def _compact(self):
+        # removes the events marked as removed from the columns
+        if not self._removed:
+            return
+        kept = self._types[self._head:self._tail] != 0
+        new_positions = np.cumsum(kept) - 1
+        for note in self._openNotes:
+            # the note_ons already popped from the queue are kept open with a negative position
+            self._openNoteOns[note] = deque(
+                int(new_positions[p - self._offset - self._head]) if p - self._offset >= self._head else -1
+                for p in self._openNoteOns[note]
+            )
+        size = int(kept.sum())
+        for column in (self._notes, self._types, self._timestamps):
+            column[:size] = column[self._head:self._tail][kept]
+        self._offset = 0
+        self._head = 0
+        self._tail = size
+        self._removed = 0
+
+    def _view(self, column):
+        self._compact()
+        view = column[self._head:self._tail]
+        view.flags.writeable = False
+        return view
+
+    def get_timestamps(self):
+        """
+        Gets a read-only numpy view of the timestamps of the messages in the queue.
+
+        :return: float64 numpy array
+        """
+        return self._view(self._timestamps)
+
+    def get_midi_notes(self):
+        """
+        Gets a read-only numpy view of the midi notes of the messages in the queue.
+
+        :return: uint8 numpy array
+        """
+        return self._view(self._notes)
+
+    def get_type_codes(self):
+        """
+        Gets a read-only numpy view of the type codes of the messages in the queue
+        (1 for note_on, 2 for note_off, see midi_event_types).
+
+        :return: uint8 numpy array
+        """
+        return self._view(self._types)
+
+    def get_container(self):
+        """
+        Builds the list of midi messages contained in the queue,
+        with the same format used by MidiNoteQueue.
+
+        :return: list of midi messages with timestamp
+        """
+        return [{'type': midi_event_types[t], 'note': n, 'timestamp': ts}
+                for t, n, ts in zip(self.get_type_codes().tolist(),
+                                    self.get_midi_notes().tolist(),
+                                    self.get_timestamps().tolist())]
+
+    def get_notes(self):
+        """
+        Gets a list of notes in standard notation from the note on messages.
+
+        :return: list of notes in standard notation
+        """
+        note_ons = self.get_midi_notes()[self.get_type_codes() == 1]
+        return [musical_notes[n] for n in (note_ons % 12).tolist()]
+
+    def clean_unclosed_note_ons(self):
+        """
+        Removes from the queue the unclosed note_on messages.
+        """
+        for note in self._openNotes:
+            for position in self._openNoteOns[note]:
+                index = position - self._offset
+                # note_ons already popped from the queue are ignored
+                if index >= self._head:
+                    self._types[index] = 0
+                    self._removed = self._removed + 1
+            self._openNoteOns[note].clear()
+        self._openNotes.clear()
+        self._skip_removed()
+
+    def clear(self):
+        """
+        Removes all the elements from the queue.
+        """
+        for note in self._openNotes:
+            self._openNoteOns[note].clear()
+        self._openNotes.clear()
+        self._head = 0
+        self._tail = 0
+        self._removed = 0
+        self._offset = 0
+        self._lastTimestamp = float('-inf')
+
+
+class ConcurrentMidiNoteQueue:
+    """
+    A midi queue that can be filled from the callback thread of a midi backend
+    while the messages are parsed on another thread.
+    The producer thread pushes the raw messages into a preallocated single-producer/single-consumer
+    ring buffer: a push never waits, it only writes a slot and then publishes it moving the tail index.
+    The consumer thread drains the published messages in a single step (see snapshot and drain)
+    and pushes them into a MidiNoteQueue (or CompactMidiNoteQueue) that is accessed only by the consumer,
+    so that the filtering of the messages, the parsers and clear never race with the producer.
+    There must be a single producer thread and a single consumer thread.
+    """
+
+    def __init__(self, midi_queue=None, capacity=4096):
+        # queue filled with the drained messages, used only by the consumer thread
+        self._queue = MidiNoteQueue() if midi_queue is None else midi_queue
+
+        # ring buffer of (msg_type, note, timestamp), the capacity is a power of 2
+        capacity = 1 << max(capacity - 1, 1).bit_length()
+        self._ring = [None] * capacity
+        self._mask = capacity - 1
+
+        # number of messages published by the producer (written only by the producer)
+        self._tail = 0
+
+        # number of messages drained by the consumer (written only by the consumer)
+        self._head = 0
+
+        # messages discarded by the producer because the ring was full (written only by the producer)
+        self.droppedMessages = 0
+
+        # drained messages held back by snapshot_closed from the first note still open (used only by the consumer)
+        self._pending = []
+
+    def __len__(self):
+        # messages waiting to be drained
+        return self._tail - self._head
+
+    def push(self, msg_type, note, timestamp=None):
+        """
+        Pushes a midi message into the ring buffer, without waiting.
+        To be called only by the producer thread.
+
+        :param msg_type: 'note_on' or 'note_off'
+        :param note: midi note value
+        :param timestamp: optional timestamp value, if none is provided, it's taken at the push
+        :return: False if the ring buffer is full and the message is discarded
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        tail = self._tail
+        if tail - self._head > self._mask:
+            self.droppedMessages = self.droppedMessages + 1
+            return False
+        self._ring[tail & self._mask] = (msg_type, note, timestamp)
+        # the message is published only after the slot has been written
+        self._tail = tail + 1
+        return True
+
+    def drain(self):
+        """
+        Removes from the ring buffer all the messages published so far.
+        To be called only by the consumer thread.
+
+        :return: list of (msg_type, note, timestamp), in push order
+        """
+        head = self._head
+        tail = self._tail
+        if head == tail:
+            return []
+        start = head & self._mask
+        end = tail & self._mask
+        if start < end:
+            messages = self._ring[start:end]
+        else:
+            messages = self._ring[start:] + self._ring[:end]
+        self._head = tail
+        return messages
+
+    def snapshot(self):
+        """
+        Drains the ring buffer into the consumer queue, that can then be read
+        (ex: get_notes, or a final parse_melody at the end of the capture).
+        The messages pushed after the call remain in the ring buffer.
+        The parsers remove the note_ons still open, whose note_offs are then discarded:
+        to parse and clear the queue while the capture continues, use snapshot_closed.
+        To be called only by the consumer thread.
+
+        :return: the MidiNoteQueue (or CompactMidiNoteQueue) of the consumer
+        """
+        messages = self._pending + self.drain()
+        self._pending = []
+        push = self._queue.push
+        for msg_type, note, timestamp in messages:
+            push(msg_type, note, timestamp)
+        return self._queue
+
+    def snapshot_closed(self):
+        """
+        Drains the ring buffer as snapshot, but pushes into the consumer queue only the messages
+        before the first note still open: the queue contains only closed notes, and can be parsed
+        and cleared without losing the notes held during the parsing
+        (ex: parse_melody(concurrent_queue.snapshot_closed(), chord, durations), then clear on the returned queue).
+        The held messages are pushed by the next calls, once their notes are closed.
+        To be called only by the consumer thread.
+
+        :return: the MidiNoteQueue (or CompactMidiNoteQueue) of the consumer
+        """
+        pending = self._pending
+        pending.extend(self.drain())
+
+        # number of messages after which no note is open
+        open_notes = {}
+        closed = 0
+        for i, (msg_type, note, _) in enumerate(pending):
+            if msg_type == 'note_on':
+                open_notes[note] = open_notes.get(note, 0) + 1
+            elif msg_type == 'note_off' and open_notes.get(note):
+                open_notes[note] = open_notes[note] - 1
+                if not open_notes[note]:
+                    del open_notes[note]
+            if not open_notes:
+                closed = i + 1
+
+        push = self._queue.push
+        for msg_type, note, timestamp in pending[:closed]:
+            push(msg_type, note, timestamp)
+        del pending[:closed]
+        return self._queue
+
+    def get_queue(self):
+        """
+        Getter for the queue of the consumer, without draining the ring buffer.
+
+        :return: MidiNoteQueue or CompactMidiNoteQueue
+        """
+        return self._queue
+
+    def clear(self):
+        """
+        Removes the messages drained so far and the ones waiting in the ring buffer.
+        To be called only by the consumer thread.
+        """
+        self._head = self._tail
+        self._pending = []
+        self._queue.clear()
@@ -0,0 +1,252 @@
+import time
+from collections import namedtuple
+from melodically.midi_note_queue import MidiNoteQueue
+from melodically.harmonic_state import IncrementalHarmonicState
+from melodically.parsers import StreamingMelodyParser
+from melodically.harmony import midi_to_std
+from melodically.tables import lazy_import
+
+asyncio = lazy_import('asyncio')
+
+"""
+Midi message flowing through a MidiPipeline.
+
+source: name of the source that produced the message
+type: 'note_on' or 'note_off'
+note: midi note value
+timestamp: monotonic time of arrival in seconds
+"""
+MidiEvent = namedtuple('MidiEvent', ['source', 'type', 'note', 'timestamp'])
+
+
+class VirtualMidiPort:
+    """
+    An in-process midi port, that can be used as a source of a MidiPipeline.
+    The messages sent to the port are delivered in order, and send waits
+    when the port is full.
+    """
+
+    def __init__(self, maxsize=256):
+        self._maxsize = maxsize
+        self._queue = None
+
+    def _get_queue(self):
+        # the queue is created inside the running event loop
+        if self._queue is None:
+            self._queue = asyncio.Queue(self._maxsize)
+        return self._queue
+
+    async def send(self, msg_type, note):
+        """
+        Sends a note_on/off message to the port.
+
+        :param msg_type: 'note_on' or 'note_off'
+        :param note: midi note value
+        """
+        await self._get_queue().put((msg_type, note))
+
+    async def close(self):
+        """
+        Closes the port, ending the iteration of its messages.
+        """
+        await self._get_queue().put(None)
+
+    def __aiter__(self):
+        return self._messages()
+
+    async def _messages(self):
+        queue = self._get_queue()
+        while True:
+            msg = await queue.get()
+            if msg is None:
+                return
+            yield msg
+
+
+async def replay_messages(messages, speed=1.0):
+    """
+    Replays a list of midi messages with timestamps (like the one returned by
+    MidiNoteQueue.get_container), waiting between them as in the original recording.
+
+    :param messages: list of midi messages with timestamp
+    :param speed: playback speed factor (0 to replay without waiting)
+    :return: asynchronous iterator of (msg_type, note) tuples
+    """
+    last_timestamp = None
+    for msg in messages:
+        if speed and last_timestamp is not None:
+            await asyncio.sleep(max(msg['timestamp'] - last_timestamp, 0) / speed)
+        last_timestamp = msg['timestamp']
+        yield msg['type'], msg['note']
+
+
+async def read_stream_messages(reader):
+    """
+    Reads midi messages from an asyncio.StreamReader (for example a socket),
+    one message per line in the form "note_on 60".
+    The lines that are not valid messages are ignored.
+
+    :param reader: asyncio.StreamReader object
+    :return: asynchronous iterator of (msg_type, note) tuples
+    """
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        fields = line.decode(errors='ignore').split()
+        if len(fields) == 2 and fields[0] in ('note_on', 'note_off') and fields[1].isdigit():
+            yield fields[0], int(fields[1])
+
+
+class MidiPipeline:
+    """
+    Collects midi messages from many asynchronous sources, timestamps them with a
+    monotonic clock and delivers them to many asynchronous consumers.
+    All the queues are bounded: a slow consumer slows down the delivery,
+    that in turn slows down the sources (backpressure).
+    """
+
+    def __init__(self, maxsize=1024, clock=time.monotonic):
+        # max size of the input queue and of the queue of each consumer
+        self.maxsize = maxsize
+
+        # function returning the current time in seconds
+        self.clock = clock
+
+        # (name, asynchronous iterable of messages) for each source
+        self._sources = []
+
+        # (callable, max queue size) for each consumer
+        self._consumers = []
+
+    def add_source(self, name, messages):
+        """
+        Adds a source of midi messages.
+
+        :param name: name of the source, reported in each MidiEvent
+        :param messages: asynchronous iterable of (msg_type, note) tuples
+        """
+        self._sources.append((name, messages))
+
+    def add_consumer(self, consumer, maxsize=None):
+        """
+        Adds a consumer, called with every MidiEvent in arrival order.
+
+        :param consumer: function or coroutine function receiving a MidiEvent
+        :param maxsize: optional max size of the consumer queue
+        """
+        self._consumers.append((consumer, maxsize or self.maxsize))
+
+    async def _produce(self, events):
+        async def produce_source(name, messages):
+            async for msg_type, note in messages:
+                await events.put(MidiEvent(name, msg_type, note, self.clock()))
+
+        await asyncio.gather(*[produce_source(name, messages) for name, messages in self._sources])
+        await events.put(None)  # end of the messages
+
+    async def _dispatch(self, events, queues):
+        while True:
+            event = await events.get()
+            for queue in queues:
+                await queue.put(event)
+            if event is None:
+                return
+
+    @staticmethod
+    async def _consume(consumer, queue):
+        while True:
+            event = await queue.get()
+            if event is None:
+                return
+            result = consumer(event)
+            if asyncio.iscoroutine(result):
+                await result
+
+    async def run(self):
+        """
+        Runs the pipeline until all the sources are exhausted
+        and all the consumers have processed their messages.
+        """
+        events = asyncio.Queue(self.maxsize)
+        queues = [asyncio.Queue(maxsize) for _, maxsize in self._consumers]
+        tasks = [asyncio.ensure_future(self._produce(events)),
+                 asyncio.ensure_future(self._dispatch(events, queues))]
+        tasks += [asyncio.ensure_future(self._consume(consumer, queue))
+                  for (consumer, _), queue in zip(self._consumers, queues)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # stopping the other tasks if one of them fails
+            for task in tasks:
+                task.cancel()
+
+
+class NoteQueueConsumer:
+    """
+    Pipeline consumer that pushes the messages of each source in its own MidiNoteQueue.
+    """
+
+    def __init__(self, queue_factory=MidiNoteQueue):
+        # function used to create the queue of a new source
+        self.queueFactory = queue_factory
+
+        # MidiNoteQueue of each source
+        self.queues = {}
+
+    def __call__(self, event):
+        if event.source not in self.queues:
+            self.queues[event.source] = self.queueFactory()
+        self.queues[event.source].push(event.type, event.note, event.timestamp)
+
+
+class HarmonicStateConsumer:
+    """
+    Pipeline consumer that updates an IncrementalHarmonicState for each source
+    with the notes of the note_on messages.
+    """
+
+    def __init__(self, buffer_size=16):
+        # buffer size of the harmonic states
+        self.bufferSize = buffer_size
+
+        # IncrementalHarmonicState of each source
+        self.states = {}
+
+    def __call__(self, event):
+        if event.type == 'note_on':
+            if event.source not in self.states:
+                self.states[event.source] = IncrementalHarmonicState(self.bufferSize)
+            self.states[event.source].push_note(midi_to_std(event.note))
+
+
+class MelodyParserConsumer:
+    """
+    Pipeline consumer that parses the messages of each source with a StreamingMelodyParser.
+    The completed symbols are passed to a callback, or collected in the symbols dictionary.
+    """
+
+    def __init__(self, chord, rhythmical_durations, callback=None):
+        # chord and durations used by the new parsers
+        self.chord = chord
+        self.rhythmicalDurations = rhythmical_durations
+
+        # optional function called with the source name and the list of completed symbols
+        self.callback = callback
+
+        # StreamingMelodyParser of each source
+        self.parsers = {}
+
+        # symbols completed for each source (used when no callback is provided)
+        self.symbols = {}
+
+    def __call__(self, event):
+        if event.source not in self.parsers:
+            self.parsers[event.source] = StreamingMelodyParser(self.chord, self.rhythmicalDurations)
+            self.symbols[event.source] = []
+        symbols = self.parsers[event.source].push(event.type, event.note, event.timestamp)
+        if symbols:
+            if self.callback:
+                self.callback(event.source, symbols)
+            else:
+                self.symbols[event.source].extend(symbols)
@@ -0,0 +1,278 @@
+import os
+import struct
+from melodically.harmony import mode_signatures, musical_notes, pitch_class_indices
+from melodically.tables import lazy_import
+from melodically.vocabulary import melody_symbols
+
+np = lazy_import('numpy')
+
+# header of the files written by NGramCounter.save: magic, version, n, vocabulary size, number of n-grams
+_header_format = '<4sIIIQ'
+_header_magic = b'MLNG'
+_header_version = 1
+
+"""
+Number of codes used by encode_mode: a code for each mode of each signature of each root
+"""
+mode_vocabulary_size = 12 * len(mode_signatures) * 7
+
+
+def encode_mode(mode):
+    """
+    Encodes a mode dictionary (as HarmonicState.currentMode) as an integer,
+    to count the mode transitions with a NGramCounter.
+
+    :param mode: dictionary with root, mode_signature_index and mode_index
+    :return: integer code lower than mode_vocabulary_size
+    """
+    return (pitch_class_indices[mode['root']] * len(mode_signatures) + mode['mode_signature_index']) * 7 + \
+        mode['mode_index']
+
+
+def decode_mode(code):
+    """
+    Gets the mode dictionary encoded by encode_mode.
+
+    :param code: integer code
+    :return: dictionary with root, mode_signature_index and mode_index
+    """
+    code = int(code)
+    return {
+        'root': musical_notes[code // (7 * len(mode_signatures))],
+        'mode_signature_index': code // 7 % len(mode_signatures),
+        'mode_index': code % 7
+    }
+
+
+class NGramCounter:
+    """
+    Counts the n-grams of streams of integer symbols (ex: the codes of melody_symbols
+    returned by the encoded parsers, or the modes encoded by encode_mode).
+    Each n-gram is packed in a single int64 key (the codes as digits in base vocabularySize),
+    and the counts are stored in two arrays sorted by key. The new n-grams are buffered
+    and merged into the arrays only when the counts are read.
+    """
+
+    def __init__(self, n=3, vocabulary_size=len(melody_symbols)):
+        if vocabulary_size ** n >= 2 ** 63:
+            raise ValueError('{}-grams of {} symbols do not fit in int64 keys'.format(n, vocabulary_size))
+        self.n = n
+        self.vocabularySize = vocabulary_size
+
+        # sorted keys of the n-grams and their counts
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._counts = np.zeros(0, dtype=np.int64)
+
+        # keys (and counts) not merged yet
+        self._pending = []
+
+        # last n - 1 codes pushed with push, to continue the n-grams across the calls
+        self._context = []
+
+        # powers of the vocabulary size used to pack the keys
+        self._weights = vocabulary_size ** np.arange(n - 1, -1, -1, dtype=np.int64)
+
+    def __len__(self):
+        self._flush()
+        return len(self._keys)
+
+    def _flush(self):
+        # merging the pending keys into the sorted arrays
+        if not self._pending:
+            return
+        keys = np.concatenate([self._keys] + [keys for keys, _ in self._pending])
+        counts = np.concatenate([self._counts] + [counts for _, counts in self._pending])
+        self._pending = []
+        self._keys, inverse = np.unique(keys, return_inverse=True)
+        self._counts = np.bincount(inverse.ravel(), weights=counts, minlength=len(self._keys)).astype(np.int64)
+
+    def _add_keys(self, keys, counts=None):
+        if len(keys):
+            self._pending.append((keys, np.ones(len(keys), dtype=np.int64) if counts is None else counts))
+
+    def encode(self, ngram):
+        """
+        Packs an n-gram in its int64 key.
+
+        :param ngram: sequence of n codes
+        :return: integer key
+        """
+        key = 0
+        for code in ngram:
+            code = int(code)
+            if not 0 <= code < self.vocabularySize:
+                raise ValueError('the codes must be between 0 and {}'.format(self.vocabularySize - 1))
+            key = key * self.vocabularySize + code
+        return key
+
+    def decode(self, key):
+        """
+        Unpacks an int64 key in its n-gram.
+
+        :param key: integer key
+        :return: tuple of n codes
+        """
+        key = int(key)
+        codes = []
+        for _ in range(self.n):
+            key, code = divmod(key, self.vocabularySize)
+            codes.append(code)
+        return tuple(codes[::-1])
+
+    def update(self, codes, offsets=None):
+        """
+        Counts the n-grams of a phrase or, if offsets is given, of many phrases
+        stored in a ragged array (as returned by parse_melody_batch).
+        The n-grams never cross the boundaries of the phrases.
+
+        :param codes: array of codes
+        :param offsets: optional offsets of the phrases (the phrase i is codes[offsets[i]:offsets[i + 1]])
+        """
+        codes = np.asarray(codes, dtype=np.int64)
+        if len(codes) and (codes.min() < 0 or codes.max() >= self.vocabularySize):
+            raise ValueError('the codes must be between 0 and {}'.format(self.vocabularySize - 1))
+        windows = len(codes) - self.n + 1
+        if windows <= 0:
+            return
+        keys = np.zeros(windows, dtype=np.int64)
+        for j in range(self.n):
+            keys = keys + codes[j:j + windows] * self._weights[j]
+        if offsets is not None:
+            # keeping only the n-grams starting and ending in the same phrase
+            offsets = np.asarray(offsets, dtype=np.int64)
+            phrases = np.searchsorted(offsets, np.arange(len(codes)), side='right')
+            keys = keys[phrases[:windows] == phrases[self.n - 1:]]
+        self._add_keys(keys)
+
+    def push(self, code):
+        """
+        Adds a single code to the current stream, counting the n-gram it completes.
+        Used for the incremental updates (ex: a new mode detected by a HarmonicState).
+
+        :param code: integer code
+        """
+        code = int(code)
+        if not 0 <= code < self.vocabularySize:
+            raise ValueError('the codes must be between 0 and {}'.format(self.vocabularySize - 1))
+        self._context.append(code)
+        if len(self._context) == self.n:
+            self._add_keys(np.array([self.encode(self._context)], dtype=np.int64))
+            self._context.pop(0)
+
+    def end_phrase(self):
+        """
+        Ends the stream of push, so that the next codes start new n-grams.
+        """
+        self._context = []
+
+    def merge(self, other):
+        """
+        Adds the counts of another counter (ex: partial counts of a worker process).
+
+        :param other: NGramCounter with the same n and vocabulary size
+        """
+        if (other.n, other.vocabularySize) != (self.n, self.vocabularySize):
+            raise ValueError('the counters have different n or vocabulary size')
+        other._flush()
+        self._add_keys(np.array(other._keys), np.array(other._counts))
+
+    def get_count(self, ngram):
+        """
+        Gets the count of an n-gram.
+
+        :param ngram: sequence of n codes
+        :return: number of occurrences
+        """
+        self._flush()
+        key = self.encode(ngram)
+        index = np.searchsorted(self._keys, key)
+        return int(self._counts[index]) if index < len(self._keys) and self._keys[index] == key else 0
+
+    def get_transitions(self, context):
+        """
+        Gets the codes that follow a context of n - 1 codes, with their counts.
+
+        :param context: sequence of n - 1 codes
+        :return: (array of next codes, array of counts)
+        """
+        self._flush()
+        start = self.encode(context) * self.vocabularySize
+        first, last = np.searchsorted(self._keys, [start, start + self.vocabularySize])
+        return self._keys[first:last] - start, np.array(self._counts[first:last])
+
+    def get_arrays(self):
+        """
+        Gets the sorted keys and their counts.
+
+        :return: (int64 array of keys, int64 array of counts)
+        """
+        self._flush()
+        return self._keys, self._counts
+
+    def most_common(self, k=None):
+        """
+        Gets the most common n-grams, the ties are ordered by key.
+
+        :param k: number of n-grams (all if None)
+        :return: list of (tuple of codes, count)
+        """
+        self._flush()
+        order = np.argsort(-self._counts, kind='stable')[:k]
+        return [(self.decode(key), count) for key, count in zip(self._keys[order].tolist(),
+                                                                self._counts[order].tolist())]
+
+    def prune(self, k):
+        """
+        Keeps only the k most common n-grams (the ties are solved keeping the lower keys).
+
+        :param k: number of n-grams to keep
+        """
+        self._flush()
+        kept = np.sort(np.argsort(-self._counts, kind='stable')[:k])
+        self._keys = self._keys[kept]
+        self._counts = self._counts[kept]
+
+    def save(self, path):
+        """
+        Saves the counts in a binary file (a header followed by the keys and the counts
+        as little endian int64), that can be loaded with memory mapping.
+
+        :param path: path of the file
+        """
+        self._flush()
+        with open(path, 'wb') as file:
+            file.write(struct.pack(_header_format, _header_magic, _header_version,
+                                   self.n, self.vocabularySize, len(self._keys)))
+            file.write(self._keys.astype('<i8').tobytes())
+            file.write(self._counts.astype('<i8').tobytes())
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Loads the counts saved with save.
+        With memory mapping, the arrays are read from the file only when accessed;
+        the updates of the loaded counter don't modify the file.
+
+        :param path: path of the file
+        :param mmap: if False, the arrays are read in memory
+        :return: NGramCounter object
+        """
+        header_size = struct.calcsize(_header_format)
+        with open(path, 'rb') as file:
+            header = file.read(header_size)
+        if len(header) < header_size:
+            raise ValueError('{} is not a n-gram file (truncated header)'.format(path))
+        magic, version, n, vocabulary_size, size = struct.unpack(_header_format, header)
+        if magic != _header_magic or version != _header_version:
+            raise ValueError('{} is not a n-gram file'.format(path))
+        if os.path.getsize(path) < header_size + 16 * size:
+            raise ValueError('{} is truncated'.format(path))
+
+        counter = cls(n, vocabulary_size)
+        if size:
+            if mmap:
+                arrays = np.memmap(path, dtype='<i8', mode='r', offset=header_size, shape=(2, size))
+            else:
+                arrays = np.fromfile(path, dtype='<i8', offset=header_size).reshape(2, size)
+            counter._keys, counter._counts = arrays[0], arrays[1]
+        return counter
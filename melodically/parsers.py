@@ -1,5 +1,29 @@
-from melodically.rhythm import get_nearest_rhythm
-from melodically.chords import chord_tones
+import time
+from melodically.rhythm import as_duration_table, quantize_intervals
+from melodically.vocabulary import rhythm_figures, melodic_classes, rest_codes_start, figure_codes_start, \
+    decode_symbols
+from melodically.chords import get_chord_masks, get_melodic_classes
+from melodically.harmony import pitch_class_indices
+from melodically.instrumentation import instrumented, queue_size
+from melodically.tables import lazy_import
+
+np = lazy_import('numpy')
+
+"""
+Data type of the note spans returned by get_note_spans.
+
+onset: timestamp of the note_on
+offset: timestamp of the note_off closing the note
+pitch: midi note value
+rest: silence after the note_off, when the note_off directly
+follows its note_on and it's not the last message (0 otherwise)
+"""
+note_span_dtype = [
+    ('onset', 'f8'),
+    ('offset', 'f8'),
+    ('pitch', 'u1'),
+    ('rest', 'f8'),
+]
 
 
 def parse_musical_note(musical_note, chord):
@@ -19,15 +43,96 @@ def parse_musical_note(musical_note, chord):
     :param chord: chord notation
     :return: abstract melody_parser note
     """
-    if musical_note in chord_tones[chord]['c']:
+    chord_mask, color_mask = get_chord_masks(chord)
+    pitch_class = pitch_class_indices.get(musical_note)
+    if pitch_class is None:
+        return 'x'
+    elif chord_mask >> pitch_class & 1:
         return 'c'
-    elif musical_note in chord_tones[chord]['l']:
+    elif color_mask >> pitch_class & 1:
         return 'l'
     else:
         return 'x'
 
 
-def parse_rhythm(midi_queue, rhythmical_durations):
+def get_note_spans(midi_queue):
+    """
+    Pairs each note_on message of a MidiNoteQueue (or CompactMidiNoteQueue) with the
+    first subsequent note_off of the same note, in a single pass over the messages.
+    The note_ons that are never closed are discarded.
+    For a polyphonic MidiNoteQueue, the spans of its melody (see get_melody_container) are returned.
+
+    :param midi_queue: MidiNoteQueue or CompactMidiNoteQueue object
+    :return: numpy array of note_span_dtype, ordered by note_on
+    """
+    if hasattr(midi_queue, 'get_type_codes'):
+        # columnar queue, 1 is the note_on type code
+        note_on_flags = (midi_queue.get_type_codes() == 1).tolist()
+        notes = midi_queue.get_midi_notes().tolist()
+        timestamps = midi_queue.get_timestamps().tolist()
+    else:
+        if getattr(midi_queue, 'polyphonic', False):
+            container = midi_queue.get_melody_container()
+        else:
+            container = midi_queue.get_container()
+        note_on_flags = [msg['type'] == 'note_on' for msg in container]
+        notes = [msg['note'] for msg in container]
+        timestamps = [msg['timestamp'] for msg in container]
+
+    onsets = []
+    offsets = []
+    pitches = []
+    rests = []
+    pending = {}  # for each note, the indices of the spans waiting for a note_off
+    last_index = len(timestamps) - 1
+    for k in range(len(timestamps)):
+        note = notes[k]
+        if note_on_flags[k]:
+            pending.setdefault(note, []).append(len(onsets))
+            onsets.append(timestamps[k])
+            offsets.append(np.nan)
+            pitches.append(note)
+            rests.append(0.0)
+        elif note in pending:
+            # the note_off closes all the open note_ons of the same note
+            for span_index in pending.pop(note):
+                offsets[span_index] = timestamps[k]
+            if k < last_index and note_on_flags[k - 1] and notes[k - 1] == note:
+                # no other messages between the note_on and the note_off
+                rests[-1] = timestamps[k + 1] - timestamps[k]
+
+    spans = np.empty(len(onsets), dtype=note_span_dtype)
+    spans['onset'] = onsets
+    spans['offset'] = offsets
+    spans['pitch'] = pitches
+    spans['rest'] = rests
+    return spans[~np.isnan(spans['offset'])]
+
+
+def _parse_spans(spans, rhythmical_durations):
+    # list of rhythmic symbols and list of span indices (None for the rests)
+    duration_table = as_duration_table(rhythmical_durations)
+    symbols = []
+    span_indices = []
+
+    # getting the closest rhythmic figures of all the notes at once
+    rhythm_indices = quantize_intervals(spans['offset'] - spans['onset'], duration_table).tolist()
+    rests = spans['rest'].tolist()
+    for i in range(len(rhythm_indices)):
+        rhythm = duration_table.symbols[rhythm_indices[i]]
+        symbols.append(rhythm)
+        span_indices.append(i)
+
+        # computing also the rest
+        if rests[i] >= 0.08:
+            # rhythmic figure for the rest
+            symbols.append('r' + rhythm)
+            span_indices.append(None)
+    return symbols, span_indices
+
+
+@instrumented('parse_rhythm', 'queue_size', queue_size)
+def parse_rhythm(midi_queue, rhythmical_durations, encoded=False):
     """
     Given a MidiNoteQueue object and a rhytmical_duration dictionary,
     parses the note messages contained into the MidiNoteQueue into
@@ -52,49 +157,235 @@ def parse_rhythm(midi_queue, rhythmical_durations):
     ============================
 
     :param midi_queue: MidiNoteQueue object
-    :param rhythmical_durations: dictionary of harmonic durations
+    :param rhythmical_durations: dictionary of harmonic durations (or DurationTable)
+    :param encoded: if True, the symbols are returned as a uint16 array of codes (see melody_symbols)
     :return: list of duration symbols
     """
-    result = []  # this list will contain the rhythmical symbols
+    if encoded:
+        return _parse_melody_jobs([(midi_queue, None, rhythmical_durations)])[0]
     midi_queue.clean_unclosed_note_ons()
-    midi_queue_container = midi_queue.get_container()
-    for i in range(len(midi_queue_container)):
-        if midi_queue_container[i]['type'] == 'note_on':
-            j = i + 1
-            # finding the corresponding subsequent note_off
-            while not (midi_queue_container[j]['type'] == 'note_off' and midi_queue_container[j]['note'] ==
-                       midi_queue_container[i]['note']):
-                j = j + 1
-            # from here on j is the index of the note_off
-            interval = midi_queue_container[j]['timestamp'] - midi_queue_container[i]['timestamp']
-
-            # getting the closest rhythmic figure and adding it to the result
-            rhythm = get_nearest_rhythm(interval, rhythmical_durations)
-            result.append(rhythm)
-
-            # computing also the rest
-            if i == j - 1 and j < len(midi_queue_container) - 1:
-                # no other note_ons between the current note_on and note_off
-                rest_interval = midi_queue_container[j + 1]['timestamp'] - midi_queue_container[j]['timestamp']
-                if rest_interval >= 0.08:
-                    # rhythmic figure for the rest
-                    rest_rhythm = get_nearest_rhythm(interval, rhythmical_durations)
-                    result.append('r' + rest_rhythm)
-
+    result, _ = _parse_spans(get_note_spans(midi_queue), rhythmical_durations)
     return result
 
 
-def parse_melody(midi_queue, chord, rhythmical_durations):
-    rhythmic_symbols = parse_rhythm(midi_queue, rhythmical_durations)
-    notes = midi_queue.get_notes()
-    note_count = 0
+@instrumented('parse_melody', 'queue_size', queue_size)
+def parse_melody(midi_queue, chord, rhythmical_durations, encoded=False):
+    if encoded:
+        # uint16 array of codes of melody_symbols
+        return _parse_melody_jobs([(midi_queue, chord, rhythmical_durations)])[0]
+    midi_queue.clean_unclosed_note_ons()
+    spans = get_note_spans(midi_queue)
+    rhythmic_symbols, span_indices = _parse_spans(spans, rhythmical_durations)
+    melodic_classes = get_melodic_classes(chord)
+    pitch_classes = (spans['pitch'] % 12).tolist()
     result = []
-    for i in range(len(rhythmic_symbols)):
-        symbol = rhythmic_symbols[i]
-        if 'r' not in symbol:
+    for symbol, span_index in zip(rhythmic_symbols, span_indices):
+        if span_index is not None:
             # note detected
-            symbol = parse_musical_note(notes[note_count], chord) + symbol
-            note_count = note_count + 1
+            symbol = melodic_classes[pitch_classes[span_index]] + symbol
         result.append(symbol)
 
     return result
+
+
+def _parse_melody_jobs(jobs):
+    # parses a list of (midi_queue, chord, rhythmical_durations) jobs into (codes, offsets),
+    # with chord None the notes are encoded as rhythmic figures only (as in parse_rhythm)
+    figures = rhythm_figures
+    n_figures = len(figures)
+
+    # the duration tables and the melodic classes are compiled once for each distinct object
+    tables = {}
+    class_rows = {}
+    job_spans = []
+    job_tables = []
+    job_classes = []
+    for midi_queue, chord, rhythmical_durations in jobs:
+        table_key = id(rhythmical_durations)
+        if table_key not in tables:
+            duration_table = as_duration_table(rhythmical_durations)
+            try:
+                figure_codes = np.array([figures.index(s) for s in duration_table.symbols], dtype=np.int64)
+            except ValueError:
+                raise ValueError('{} contains unknown rhythmic figures'.format(duration_table.symbols))
+            tables[table_key] = (len(tables), duration_table, figure_codes, rhythmical_durations)
+        if chord not in class_rows:
+            if chord is None:
+                class_rows[chord] = [figure_codes_start // n_figures] * 12
+            else:
+                class_rows[chord] = [melodic_classes.index(m) for m in get_melodic_classes(chord)]
+        midi_queue.clean_unclosed_note_ons()
+        job_spans.append(get_note_spans(midi_queue))
+        job_tables.append(tables[table_key][0])
+        job_classes.append(class_rows[chord])
+
+    # all the spans in flat arrays
+    counts = np.array([len(spans) for spans in job_spans], dtype=np.int64)
+    spans = np.concatenate(job_spans) if job_spans else np.empty(0, dtype=note_span_dtype)
+    span_jobs = np.repeat(np.arange(len(jobs)), counts)
+    span_tables = np.array(job_tables, dtype=np.int64)[span_jobs]
+
+    # quantizing the spans of each duration table at once
+    figure_codes = np.zeros(len(spans), dtype=np.int64)
+    intervals = spans['offset'] - spans['onset']
+    for table_index, duration_table, table_figures, _ in tables.values():
+        selected = span_tables == table_index
+        figure_codes[selected] = table_figures[quantize_intervals(intervals[selected], duration_table)]
+
+    # melodic class of each span from the table of its chord
+    classes = np.array(job_classes, dtype=np.int64).reshape(-1, 12)
+    span_classes = classes[span_jobs, spans['pitch'] % 12]
+    note_codes = span_classes * n_figures + figure_codes
+
+    # each span produces its note and, optionally, a rest with the same figure
+    has_rest = spans['rest'] >= 0.08
+    sizes = 1 + has_rest
+    positions = np.cumsum(sizes) - sizes
+    codes = np.empty(int(sizes.sum()), dtype=np.uint16)
+    codes[positions] = note_codes
+    codes[positions[has_rest] + 1] = rest_codes_start + figure_codes[has_rest]
+
+    job_sizes = np.bincount(span_jobs, weights=sizes, minlength=len(jobs)).astype(np.int64)
+    offsets = np.concatenate([[0], np.cumsum(job_sizes)]).astype(np.int64)
+    return codes, offsets
+
+
+def parse_melody_batch(jobs, executor=None, chunk_size=64):
+    """
+    Parses many melodies at once, with the same result of calling parse_melody on each job.
+    The duration tables and the chord tables are compiled once for the whole batch,
+    and all the note spans are quantized and classified in flat arrays.
+    The symbols are returned as codes of melody_symbols: the symbols of the job i
+    are codes[offsets[i]:offsets[i + 1]].
+    As parse_melody, it removes the unclosed note_ons from the queues, with any executor.
+
+    :param jobs: list of (midi_queue, chord, rhythmical_durations) tuples
+    :param executor: optional concurrent.futures executor used to parse chunks of jobs in parallel
+    :param chunk_size: number of jobs of each chunk sent to the executor
+    :return: (uint16 numpy array of symbol codes, int64 numpy array of len(jobs) + 1 offsets)
+    """
+    jobs = list(jobs)
+    if executor is None or len(jobs) <= chunk_size:
+        return _parse_melody_jobs(jobs)
+
+    # cleaning the queues of the caller, since a process pool parses pickled copies
+    for midi_queue, _, _ in jobs:
+        midi_queue.clean_unclosed_note_ons()
+
+    chunks = [jobs[i:i + chunk_size] for i in range(0, len(jobs), chunk_size)]
+    results = list(executor.map(_parse_melody_jobs, chunks))
+    codes = np.concatenate([chunk_codes for chunk_codes, _ in results])
+    chunk_starts = np.cumsum([0] + [len(chunk_codes) for chunk_codes, _ in results[:-1]])
+    offsets = np.concatenate([[0]] + [chunk_offsets[1:] + start
+                                      for (_, chunk_offsets), start in zip(results, chunk_starts)])
+    return codes, offsets.astype(np.int64)
+
+
+def decode_melody_batch(codes, offsets):
+    """
+    Converts the result of parse_melody_batch in lists of symbols.
+
+    :param codes: array of symbol codes
+    :param offsets: array of offsets
+    :return: list of lists of melody symbols, one for each job
+    """
+    symbols = decode_symbols(codes)
+    offsets = np.asarray(offsets).tolist()
+    return [symbols[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+
+class StreamingMelodyParser:
+    """
+    Parses note_on/note_off messages into melody symbols one message at a time,
+    without storing the past messages.
+    The symbol of a note is returned as soon as its note_off is pushed, and the symbol
+    of a rest as soon as the note_on that ends it is pushed; differently from parse_melody,
+    the rhythmic figure of a rest is obtained from the duration of the silence.
+    """
+
+    def __init__(self, chord, rhythmical_durations):
+        # chord used to parse the notes
+        self.chord = chord
+
+        # compiled rhythmical durations used to quantize notes and rests
+        self.durationTable = as_duration_table(rhythmical_durations)
+
+        # timestamps of the note_on messages that are not closed yet, for each midi note
+        self._openNotes = {}
+
+        # timestamp of the last note_on message
+        self._lastTimestamp = float('-inf')
+
+        # timestamp of the note_off that started the current silence (None while a note is playing)
+        self._restStart = None
+
+        # threshold in seconds to discard notes that are too close
+        self._minimumInterval = 0.06
+
+        # minimum duration in seconds of a silence to be parsed as a rest
+        self._minimumRest = 0.08
+
+    def set_chord(self, chord):
+        """
+        Changes the chord used to parse the following notes.
+
+        :param chord: chord notation
+        """
+        self.chord = chord
+
+    def set_durations(self, rhythmical_durations):
+        """
+        Changes the rhythmical durations (for example after a bpm change).
+
+        :param rhythmical_durations: dictionary returned by the get_durations (or DurationTable)
+        """
+        self.durationTable = as_duration_table(rhythmical_durations)
+
+    def _rhythm(self, interval):
+        return self.durationTable.symbols[int(quantize_intervals(interval, self.durationTable))]
+
+    def push(self, msg_type, note, timestamp=None):
+        """
+        Pushes a note_on/off message, following the same rules of MidiNoteQueue.push,
+        and returns the symbols completed by it.
+
+        :param msg_type: 'note_on' or 'note_off'
+        :param note: midi note value
+        :param timestamp: optional timestamp value, if none is provided, it's calculated during the method execution
+        :return: list of the completed melody symbols (empty if none is completed)
+        """
+        result = []
+
+        # getting the timestamp if none is provided
+        if timestamp is None:
+            timestamp = time.time()
+
+        # note_on case
+        if msg_type == 'note_on':
+            # checking if the pushed note_on is too close with the last one
+            if timestamp - self._lastTimestamp > self._minimumInterval:
+                self._lastTimestamp = timestamp
+                if self._restStart is not None and timestamp - self._restStart >= self._minimumRest:
+                    result.append('r' + self._rhythm(timestamp - self._restStart))
+                self._restStart = None
+                self._openNotes.setdefault(note, []).append(timestamp)
+
+        # note_off case
+        elif msg_type == 'note_off':
+            # checking if the note_off closes a note on
+            if note in self._openNotes:
+                melodic_symbol = get_melodic_classes(self.chord)[note % 12]
+                for onset in self._openNotes.pop(note):
+                    result.append(melodic_symbol + self._rhythm(timestamp - onset))
+                if not self._openNotes:
+                    self._restStart = timestamp
+
+        return result
+
+    def reset(self):
+        """
+        Discards the open notes and the current rest.
+        """
+        self._openNotes.clear()
+        self._lastTimestamp = float('-inf')
+        self._restStart = None
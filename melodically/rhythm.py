@@ -1,3 +1,10 @@
+from bisect import bisect_left, bisect_right
+from itertools import accumulate, chain
+from melodically.tables import LazyDict, lazy_import
+
+np = lazy_import('numpy')
+
+
 def get_durations(bpm):
     """
     Function that generate a dictionary containing
@@ -20,38 +27,256 @@ def get_durations(bpm):
     }
 
 
+class DurationTable:
+    """
+    Precompiled version of a dictionary of rhythmical durations (returned by get_durations),
+    that allows to quantize many intervals at once with quantize_intervals.
+    """
+
+    def __init__(self, rhythmical_durations):
+        # rhythmic symbols, in the same order of the dictionary
+        self.symbols = list(rhythmical_durations.keys())
+
+        # durations in seconds, in the same order of the symbols
+        self.values = np.array(list(rhythmical_durations.values()), dtype=np.float64)
+
+        # durations sorted in ascending order, and their indices in the symbol list
+        self._order = np.argsort(self.values, kind='stable')
+        self._sortedValues = self.values[self._order]
+
+
+def as_duration_table(rhythmical_durations):
+    """
+    Returns a DurationTable, compiling the rhythmical durations if a dictionary is passed.
+
+    :param rhythmical_durations: dictionary returned by the get_durations or DurationTable
+    :return: DurationTable object
+    """
+    if isinstance(rhythmical_durations, DurationTable):
+        return rhythmical_durations
+    return DurationTable(rhythmical_durations)
+
+
+def quantize_intervals(intervals, duration_table):
+    """
+    Given an array of intervals in seconds, gets the index of the rhythmical
+    duration that has the lower distance with each of them.
+    The ties are solved as in get_nearest_rhythm, choosing the symbol that comes first.
+
+    :param intervals: array of durations in seconds
+    :param duration_table: DurationTable object
+    :return: numpy array of indices of duration_table.symbols
+    """
+    intervals = np.asarray(intervals, dtype=np.float64)
+    order = duration_table._order
+    sorted_values = duration_table._sortedValues
+    if len(sorted_values) < 2:
+        return np.zeros(intervals.shape, dtype=np.intp)
+
+    # the nearest duration is one of the two sorted durations around the interval
+    right = np.clip(np.searchsorted(sorted_values, intervals), 1, len(sorted_values) - 1)
+    left = right - 1
+    left_distances = np.abs(intervals - sorted_values[left])
+    right_distances = np.abs(intervals - sorted_values[right])
+    take_right = (right_distances < left_distances) | \
+                 ((right_distances == left_distances) & (order[right] < order[left]))
+    return np.where(take_right, order[right], order[left])
+
+
 def get_nearest_rhythm(interval, rhythmical_durations):
     """
     Given a certain interval in seconds, gets the rhythmical duration
     that has the lower distance with it.
 
     :param interval: duration in seconds
-    :param rhythmical_durations: dictionary returned by the get_durations
-    :return:
+    :param rhythmical_durations: dictionary returned by the get_durations (or DurationTable)
+    :return: rhythmic symbol
+    """
+    if isinstance(rhythmical_durations, DurationTable):
+        return rhythmical_durations.symbols[int(quantize_intervals(interval, rhythmical_durations))]
+
+    # scalar path for the dictionaries, that avoids compiling a DurationTable for a single interval
+    # (min returns the first of the symbols with the same distance, as quantize_intervals)
+    return min(rhythmical_durations, key=lambda symbol: abs(interval - rhythmical_durations[symbol]))
+
+
+"""
+Durations in beats of the figures used by the TempoTracker to interpret the intervals
+(the dotted and triplet figures are excluded, since they make the tempo ambiguous)
+"""
+tempo_tracking_beats = [0.25, 0.5, 1, 2, 4]
+
+
+class TempoTracker:
     """
+    Online tempo estimation from the inter-onset intervals of the note_on messages.
+    Each interval is matched with the nearest figure of tempo_tracking_beats, and
+    the beat period implied by the figure is smoothed into the estimate.
+    The durations dictionary and the DurationTable of the tracker are updated in place,
+    so they can be passed once to the parsers and always follow the current tempo.
+    A tracker can be attached to a midi queue with add_listener(tracker.push).
+    """
+
+    def __init__(self, bpm=120, min_bpm=40, max_bpm=240, smoothing=0.25, tolerance=0.2):
+        # current beat period in seconds and its limits
+        self.beatPeriod = 60 / bpm
+        self.minBeatPeriod = 60 / max_bpm
+        self.maxBeatPeriod = 60 / min_bpm
+
+        # weight of a new observation in the estimate
+        self.smoothing = smoothing
+
+        # maximum relative distance between the implied beat period and the current one
+        self.tolerance = tolerance
+
+        # quantization grid, updated in place when the tempo changes
+        self.durations = get_durations(bpm)
+        self.durationTable = DurationTable(self.durations)
+
+        # durations of the figures in beats (in the order of the symbols and sorted)
+        self._ratios = self.durationTable.values / self.beatPeriod
+        self._sortedRatios = self.durationTable._sortedValues / self.beatPeriod
+        self._ratioItems = list(zip(self.durationTable.symbols, self._ratios.tolist()))
+
+        # timestamp of the last onset
+        self._lastOnset = None
+
+    @property
+    def bpm(self):
+        """
+        Current tempo estimate in beats per minute.
+        """
+        return 60 / self.beatPeriod
+
+    def set_bpm(self, bpm):
+        """
+        Sets the tempo, updating the quantization grid.
 
-    # the keys and the values obtained from the methods "values" and "keys"
-    # of a dictionary are correctly ordered, so we can calculate
-    # the distances from the keys, get the index of the argmin
-    # and use it to get the correct key
+        :param bpm: beats per minute
+        """
+        self._set_beat_period(60 / bpm)
 
-    # values of the rhythmical_durations dictionary
-    rhythmical_durations_values = list(rhythmical_durations.values())
+    def _set_beat_period(self, beat_period):
+        self.beatPeriod = beat_period
+        for symbol, ratio in self._ratioItems:
+            self.durations[symbol] = ratio * beat_period
+        np.multiply(self._ratios, beat_period, out=self.durationTable.values)
+        np.multiply(self._sortedRatios, beat_period, out=self.durationTable._sortedValues)
 
-    # keys of the rhythmical_durations dictionary
-    rhythmical_durations_keys = list(rhythmical_durations.keys())
+    def update(self, interval):
+        """
+        Updates the tempo estimate with an inter-onset interval.
+        The intervals too far from every figure of the grid
+        (or out of the limits of the tempo) are ignored.
 
-    # list comprehension used to map the distance function to the values
-    distances = [abs(interval - x) for x in rhythmical_durations_values]
+        :param interval: interval in seconds between two onsets
+        :return: True if the estimate was updated
+        """
+        if interval <= 0:
+            return False
+        beats = interval / self.beatPeriod
+        ratios = tempo_tracking_beats
 
-    # argmin of the distance (an index)
-    result_index = distances.index(min(distances))
+        # nearest figure in logarithmic distance
+        index = bisect_left(ratios, beats)
+        if index == len(ratios) or (index > 0 and beats * beats < ratios[index - 1] * ratios[index]):
+            index = index - 1
+        implied = interval / ratios[index]
+        if abs(implied / self.beatPeriod - 1) > self.tolerance:
+            return False
+        if not self.minBeatPeriod <= implied <= self.maxBeatPeriod:
+            return False
+        self._set_beat_period(self.beatPeriod + self.smoothing * (implied - self.beatPeriod))
+        return True
 
-    # using the index to get the correct rhythmical duration key
-    return rhythmical_durations_keys[result_index]
+    def push_onset(self, timestamp):
+        """
+        Updates the tempo estimate with a new onset.
 
+        :param timestamp: timestamp of the onset in seconds
+        :return: True if the estimate was updated
+        """
+        last_onset = self._lastOnset
+        self._lastOnset = timestamp
+        if last_onset is None:
+            return False
+        return self.update(timestamp - last_onset)
 
-normalized_durations = get_durations(60)
+    def push(self, msg_type, note, timestamp):
+        """
+        Listener for the midi queues: updates the estimate with the note_on messages.
+
+        :param msg_type: 'note_on' or 'note_off'
+        :param note: midi note value
+        :param timestamp: timestamp of the message
+        """
+        if msg_type == 'note_on':
+            self.push_onset(timestamp)
+
+    def quantize(self, interval):
+        """
+        Gets the rhythmical figure nearest to an interval, using the current tempo.
+
+        :param interval: duration in seconds
+        :return: rhythmic symbol
+        """
+        return get_nearest_rhythm(interval, self.durationTable)
+
+    def reset(self, bpm=None):
+        """
+        Forgets the last onset, optionally setting a new tempo.
+
+        :param bpm: new tempo in beats per minute
+        """
+        self._lastOnset = None
+        if bpm is not None:
+            self.set_bpm(bpm)
+
+
+normalized_durations = LazyDict('normalized_durations', lambda: get_durations(60))
+
+
+"""
+Duration of each rhythmical figure in integer ticks (48 ticks for each 4/4 measure),
+used to sum the rhythmic sequences without rounding errors
+"""
+rhythm_ticks = {
+    '1': 48,
+    '2': 24,
+    '4': 12,
+    '4dot': 18,
+    '4t': 8,
+    '8': 6,
+    '8t': 4,
+    '16': 3,
+    '16t': 2,
+}
+
+"""
+Number of ticks of a 4/4 measure
+"""
+measure_ticks = 48
+
+
+def symbol_ticks(symbol):
+    """
+    Gets the duration in ticks of a rhythmical symbol (rests included).
+
+    :param symbol: rhythmical symbol
+    :return: duration in ticks
+    """
+    return rhythm_ticks[symbol.replace('r', '')]
+
+
+def rhythmic_prefix_sums(rhythmic_sequence):
+    """
+    Computes the prefix sums of the durations in ticks of a rhythmic sequence:
+    the element i is the onset of the symbol i, the last element the total duration.
+
+    :param rhythmic_sequence: list of rhythmical symbols
+    :return: list of len(rhythmic_sequence) + 1 integers
+    """
+    return list(accumulate(chain([0], (symbol_ticks(symbol) for symbol in rhythmic_sequence))))
 
 
 # TODO: check README if correct
@@ -63,20 +288,93 @@ def sequence_fits_measures(rhythmic_sequence, measures):
     :param measures: number of measures
     :return: True if the sequence fits the measures
     """
-    rhythmic_sequence_values = [normalized_durations[key.replace('r', '')] for key in rhythmic_sequence]
-    return sum(rhythmic_sequence_values) <= 4 * measures
+    return sum(symbol_ticks(symbol) for symbol in rhythmic_sequence) <= measure_ticks * measures
 
 
-def clip_rhythmic_sequence(rhythmic_sequence, measures):
+def clip_rhythmic_sequence(rhythmic_sequence, measures, prefix_sums=None):
     """
     Returns a new list of rhythmical symbols
     that fits in a certain number of measures
 
     :param rhythmic_sequence: list of rhythmical symbols
     :param measures: number of measures
+    :param prefix_sums: optional prefix sums of the sequence (see rhythmic_prefix_sums), to clip it many times
     :return: new list of rhythmical symbols that fits int the number of measures
     """
-    result = rhythmic_sequence.copy()
-    while not sequence_fits_measures(result, measures):
-        del result[-1]
-    return result
+    if prefix_sums is None:
+        prefix_sums = rhythmic_prefix_sums(rhythmic_sequence)
+    # the longest prefix whose duration doesn't exceed the measures
+    return rhythmic_sequence[:bisect_right(prefix_sums, measure_ticks * measures) - 1]
+
+
+def split_measures(rhythmic_sequence):
+    """
+    Splits a rhythmic sequence into 4/4 measures in a single pass.
+    Each symbol is assigned to the measure where it starts, so a symbol crossing
+    a bar line is kept whole in the first measure.
+
+    :param rhythmic_sequence: list of rhythmical symbols
+    :return: list of measures, each one a list of rhythmical symbols
+    """
+    measures = []
+    position = 0
+    for symbol in rhythmic_sequence:
+        if len(measures) <= position // measure_ticks:
+            measures.append([])
+        measures[position // measure_ticks].append(symbol)
+        position = position + symbol_ticks(symbol)
+    return measures
+
+
+def fit_rhythmic_sequence(rhythmic_sequence, measures):
+    """
+    Re-quantizes a rhythmic sequence so that it fills exactly a number of 4/4 measures,
+    changing the figures as little as possible (dynamic programming on the total duration).
+    The cost of a change is the difference in ticks between the figures; among the solutions
+    with the same cost, the one changing less symbols is chosen. Rests stay rests.
+
+    :param rhythmic_sequence: list of rhythmical symbols
+    :param measures: number of measures (a fraction of measure is allowed if it's a whole number of ticks)
+    :return: new list of rhythmical symbols, None if no re-quantization fills the measures
+    """
+    target = measure_ticks * measures
+    if target < 0:
+        raise ValueError('the number of measures must not be negative')
+    if target != int(target):
+        raise ValueError('{} measures are not a whole number of ticks ({} for each measure)'.format(
+            measures, measure_ticks))
+    target = int(target)
+    figures = list(rhythm_ticks.keys())
+    ticks = np.array(list(rhythm_ticks.values()), dtype=np.int64)
+    n = len(rhythmic_sequence)
+    unreachable = np.iinfo(np.int64).max // 2
+
+    # costs[t]: minimum cost of the symbols seen so far with a total of t ticks
+    costs = np.full(target + 1, unreachable, dtype=np.int64)
+    costs[0] = 0
+    choices = np.zeros((n, target + 1), dtype=np.int8)
+    for i, symbol in enumerate(rhythmic_sequence):
+        original = symbol_ticks(symbol)
+        # the difference in ticks dominates the number of changes
+        change_costs = np.abs(ticks - original) * (n + 1) + (ticks != original)
+        new_costs = np.full(target + 1, unreachable, dtype=np.int64)
+        for f, figure_ticks in enumerate(ticks.tolist()):
+            if figure_ticks > target:
+                continue
+            candidates = costs[:target + 1 - figure_ticks] + change_costs[f]
+            better = candidates < new_costs[figure_ticks:]
+            new_costs[figure_ticks:][better] = candidates[better]
+            choices[i, figure_ticks:][better] = f
+        costs = new_costs
+    if costs[target] >= unreachable:
+        return None
+
+    # rebuilding the sequence backwards
+    result = []
+    total = target
+    for i in range(n - 1, -1, -1):
+        figure = figures[choices[i, total]]
+        symbol = rhythmic_sequence[i]
+        result.append(symbol.replace(symbol.replace('r', ''), figure))
+        total = total - rhythm_ticks[figure]
+    return result[::-1]
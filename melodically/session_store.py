@@ -0,0 +1,222 @@
+import os
+import struct
+from melodically.harmony import musical_notes
+from melodically.midi_note_queue import midi_event_types
+from melodically.tables import lazy_import
+
+np = lazy_import('numpy')
+
+# header of the session files: magic, version, size of a record
+_header_format = '<4sII4x'
+_header_magic = b'MLSS'
+_header_version = 1
+
+# a record: float64 timestamp, uint8 midi note, uint8 type code (see midi_event_types), padding
+_record_format = '<dBB6x'
+
+# an entry of the time index: timestamp and position of a record
+_index_format = '<dq'
+
+"""
+Extension of the time index file written next to each session file
+"""
+session_index_extension = '.index'
+
+
+def session_record_dtype():
+    """
+    Data type of the records of a session file.
+
+    timestamp: timestamp of the message
+    note: midi note value
+    type: type code of the message (1 for note_on, 2 for note_off, see midi_event_types)
+
+    :return: numpy dtype
+    """
+    return np.dtype({'names': ['timestamp', 'note', 'type'], 'formats': ['<f8', 'u1', 'u1'],
+                     'offsets': [0, 8, 9], 'itemsize': struct.calcsize(_record_format)})
+
+
+def _check_header(path):
+    # raises ValueError if the file doesn't start with a valid session header
+    header_size = struct.calcsize(_header_format)
+    with open(path, 'rb') as file:
+        header = file.read(header_size)
+    if len(header) < header_size:
+        raise ValueError('{} is not a session file (truncated header)'.format(path))
+    magic, version, record_size = struct.unpack(_header_format, header)
+    if magic != _header_magic or version != _header_version or record_size != struct.calcsize(_record_format):
+        raise ValueError('{} is not a session file'.format(path))
+
+
+class SessionWriter:
+    """
+    Appends note_on/note_off messages to a session file, a small header followed by
+    fixed size records. Every index_interval records, the timestamp and the position of the record
+    are appended to a time index file, used by SessionReader to find a time range
+    (the index is rebuilt when an existing session is reopened).
+    The timestamps are expected in non decreasing order, as in a live capture.
+    A writer can be attached to a midi queue with add_listener(writer.push), to store
+    the messages accepted by the queue.
+    """
+
+    def __init__(self, path, index_interval=4096):
+        # number of records between two entries of the time index
+        self.indexInterval = index_interval
+
+        record_size = struct.calcsize(_record_format)
+        header_size = struct.calcsize(_header_format)
+        if os.path.exists(path) and os.path.getsize(path):
+            # an existing session is appended to, any other non empty file is rejected
+            _check_header(path)
+            # a record truncated by a crash is overwritten
+            self._records = (os.path.getsize(path) - header_size) // record_size
+            self._file = open(path, 'r+b')
+            self._file.truncate(header_size + self._records * record_size)
+            self._file.seek(0, os.SEEK_END)
+        else:
+            self._records = 0
+            self._file = open(path, 'wb')
+            self._file.write(struct.pack(_header_format, _header_magic, _header_version, record_size))
+            self._file.flush()
+
+        # the time index is rebuilt, reading only the indexed records
+        self._indexFile = open(path + session_index_extension, 'wb')
+        if self._records:
+            records = np.memmap(path, dtype=session_record_dtype(), mode='r', offset=header_size,
+                                shape=(self._records,))
+            positions = np.arange(0, self._records, index_interval)
+            for timestamp, position in zip(records['timestamp'][positions].tolist(), positions.tolist()):
+                self._indexFile.write(struct.pack(_index_format, timestamp, position))
+            del records
+
+    def __len__(self):
+        return self._records
+
+    def push(self, msg_type, note, timestamp):
+        """
+        Appends a message to the session.
+
+        :param msg_type: 'note_on' or 'note_off' (the other messages are ignored)
+        :param note: midi note value
+        :param timestamp: timestamp of the message
+        """
+        if msg_type not in ('note_on', 'note_off'):
+            return
+        if self._records % self.indexInterval == 0:
+            self._indexFile.write(struct.pack(_index_format, timestamp, self._records))
+        self._file.write(struct.pack(_record_format, timestamp, note, midi_event_types.index(msg_type)))
+        self._records = self._records + 1
+
+    def push_queue(self, midi_queue):
+        """
+        Appends all the messages of a MidiNoteQueue (or CompactMidiNoteQueue).
+
+        :param midi_queue: MidiNoteQueue or CompactMidiNoteQueue object
+        """
+        for msg in midi_queue.get_container():
+            self.push(msg['type'], msg['note'], msg['timestamp'])
+
+    def flush(self):
+        """
+        Writes the buffered records to the files.
+        """
+        self._file.flush()
+        self._indexFile.flush()
+
+    def close(self):
+        """
+        Closes the files.
+        """
+        self._file.close()
+        self._indexFile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SessionReader:
+    """
+    Reads a session file written by SessionWriter through memory mapping:
+    the records are read from the disk only when accessed, and the time ranges
+    are returned as views of the file, without copies.
+    The reader sees the records written before its creation.
+    """
+
+    def __init__(self, path):
+        header_size = struct.calcsize(_header_format)
+        record_size = struct.calcsize(_record_format)
+        _check_header(path)
+
+        size = (os.path.getsize(path) - header_size) // record_size
+        if size:
+            self.records = np.memmap(path, dtype=session_record_dtype(), mode='r', offset=header_size, shape=(size,))
+        else:
+            self.records = np.zeros(0, dtype=session_record_dtype())
+
+        # time index: timestamp and position of a record every index_interval records
+        index_path = path + session_index_extension
+        index_dtype = np.dtype([('timestamp', '<f8'), ('position', '<i8')])
+        if os.path.exists(index_path):
+            index = np.fromfile(index_path, dtype=index_dtype)
+            self._index = index[index['position'] < size]
+        else:
+            self._index = np.zeros(0, dtype=index_dtype)
+
+    def __len__(self):
+        return len(self.records)
+
+    def _search(self, timestamp):
+        # position of the first record with a timestamp not lower than timestamp
+        timestamps = self.records['timestamp']
+        positions = self._index['position']
+        block = np.searchsorted(self._index['timestamp'], timestamp, side='left')
+        # the record is between the entries before and after the block
+        low = int(positions[block - 1]) if block > 0 else 0
+        high = int(positions[block]) if block < len(positions) else len(timestamps)
+        return low + int(np.searchsorted(timestamps[low:high], timestamp, side='left'))
+
+    def get_range(self, start=None, end=None):
+        """
+        Gets the records with start <= timestamp < end, as a view of the file.
+
+        :param start: first timestamp (beginning of the session if None)
+        :param end: end of the range (end of the session if None)
+        :return: numpy array of session_record_dtype
+        """
+        first = 0 if start is None else self._search(start)
+        last = len(self.records) if end is None else self._search(end)
+        return self.records[first:max(first, last)]
+
+    def replay(self, target, start=None, end=None):
+        """
+        Pushes the messages of a time range into an object with a push(msg_type, note, timestamp)
+        method, such as MidiNoteQueue, CompactMidiNoteQueue, StreamingMelodyParser,
+        ChordRecognizer or TempoTracker.
+
+        :param target: object receiving the messages
+        :param start: first timestamp (beginning of the session if None)
+        :param end: end of the range (end of the session if None)
+        :return: the target
+        """
+        records = self.get_range(start, end)
+        for timestamp, note, type_code in zip(records['timestamp'].tolist(), records['note'].tolist(),
+                                              records['type'].tolist()):
+            target.push(midi_event_types[type_code], note, timestamp)
+        return target
+
+    def get_notes(self, start=None, end=None):
+        """
+        Gets the notes in std notation of the note_on messages of a time range,
+        to be pushed into a HarmonicState.
+
+        :param start: first timestamp (beginning of the session if None)
+        :param end: end of the range (end of the session if None)
+        :return: list of notes in standard notation
+        """
+        records = self.get_range(start, end)
+        note_ons = records['note'][records['type'] == 1]
+        return [musical_notes[n] for n in (note_ons % 12).tolist()]
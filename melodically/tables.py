@@ -0,0 +1,191 @@
+import hashlib
+import importlib
+import json
+import os
+import warnings
+from collections.abc import MutableMapping
+
+"""
+Environment variable containing the path of a file saved with save_tables.
+When it's set, the tables are loaded from the file instead of being built.
+"""
+tables_cache_variable = 'MELODICALLY_TABLES'
+
+# version of the format of the files written by save_tables
+_tables_format_version = 2
+
+# functions used to build each table, and the tables already built or loaded
+_builders = {}
+_tables = {}
+
+# functions returning the values each table is built from, used to detect the stale tables of a file
+_inputs = {}
+
+# True after trying to load the file indicated by the environment variable
+_cache_checked = False
+
+
+class LazyModule:
+    """
+    A module imported the first time one of its attributes is accessed.
+    After the import, the attributes of the module are copied inside the object,
+    so that the following accesses have no overhead.
+    """
+
+    def __init__(self, name):
+        self._moduleName = name
+
+    def __getattr__(self, attribute):
+        module = importlib.import_module(self._moduleName)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attribute)
+
+
+def lazy_import(name):
+    """
+    Returns a LazyModule, used to postpone the import of heavy dependencies (as numpy)
+    until they are really needed.
+
+    :param name: name of the module
+    :return: LazyModule object
+    """
+    return LazyModule(name)
+
+
+np = lazy_import('numpy')
+
+
+def register_table(name, builder, inputs=None):
+    """
+    Registers a function used to build a table the first time it's needed.
+
+    :param name: name of the table
+    :param builder: function without arguments returning the table
+    :param inputs: optional function without arguments returning the values the table is built from
+                   (ex: mode_signatures), a table saved with different values is not loaded
+    """
+    _builders[name] = builder
+    if inputs is not None:
+        _inputs[name] = inputs
+
+
+def _fingerprint(name):
+    # digest of the values a table is built from
+    inputs = _inputs.get(name)
+    return hashlib.sha256(repr(inputs() if inputs else None).encode()).hexdigest()
+
+
+def get_table(name):
+    """
+    Gets a table, building it (or loading it from the cache file) the first time.
+
+    :param name: name of a registered table
+    :return: the table
+    """
+    table = _tables.get(name)
+    if table is None:
+        global _cache_checked
+        if not _cache_checked:
+            _cache_checked = True
+            path = os.environ.get(tables_cache_variable)
+            if path and os.path.exists(path):
+                try:
+                    load_tables(path)
+                except (OSError, ValueError, KeyError) as error:
+                    warnings.warn('the tables of {} are not used: {}'.format(path, error))
+            table = _tables.get(name)
+        if table is None:
+            table = _builders[name]()
+            _tables[name] = table
+    return table
+
+
+def save_tables(path):
+    """
+    Builds all the registered tables and saves them in a file (numpy npz format,
+    with the tables that aren't arrays stored as JSON), that can be loaded with
+    load_tables or indicated in the MELODICALLY_TABLES variable.
+    Each table is saved with a fingerprint of the values it's built from.
+
+    :param path: path of the file
+    """
+    tables = {name: get_table(name) for name in _builders}
+    metadata = {'version': _tables_format_version, 'fingerprints': {}, 'tables': {}}
+    arrays = {}
+    for name, table in tables.items():
+        metadata['fingerprints'][name] = _fingerprint(name)
+        if isinstance(table, np.ndarray):
+            arrays['array_' + name] = table
+        else:
+            metadata['tables'][name] = table
+    arrays['metadata'] = np.array(json.dumps(metadata))
+    with open(path, 'wb') as file:
+        np.savez(file, **arrays)
+
+
+def load_tables(path):
+    """
+    Loads the tables saved with save_tables, replacing the ones not built yet.
+    The tables saved with a different fingerprint (built from different values,
+    ex: after a change of mode_signatures) are ignored, and built again when needed.
+
+    :param path: path of the file
+    :return: list of the names of the valid tables of the file
+    """
+    with np.load(path, allow_pickle=False) as data:
+        if 'metadata' not in data.files:
+            raise ValueError('{} is not a tables file'.format(path))
+        metadata = json.loads(str(data['metadata']))
+        if metadata.get('version') != _tables_format_version:
+            raise ValueError('{} was saved with a different version of the tables format'.format(path))
+        loaded = []
+        for name, fingerprint in metadata['fingerprints'].items():
+            if name not in _builders or fingerprint != _fingerprint(name):
+                continue
+            array_name = 'array_' + name
+            _tables.setdefault(name, data[array_name] if array_name in data.files else metadata['tables'][name])
+            loaded.append(name)
+    return loaded
+
+
+class LazyDict(MutableMapping):
+    """
+    A dictionary backed by a registered table, that is built
+    the first time the dictionary is accessed.
+    It's a mutable mapping and not a dict instance: dict(lazy_dict) gives a copy as a dict.
+    """
+
+    def __init__(self, name, builder, inputs=None):
+        register_table(name, builder, inputs)
+        self._tableName = name
+
+    @property
+    def data(self):
+        """
+        The underlying dictionary.
+        """
+        return get_table(self._tableName)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+    def __delitem__(self, key):
+        del self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __eq__(self, other):
+        return self.data == (other.data if isinstance(other, LazyDict) else other)
+
+    def __repr__(self):
+        return repr(self.data)
@@ -0,0 +1,90 @@
+from melodically.rhythm import rhythm_ticks
+from melodically.tables import lazy_import
+
+np = lazy_import('numpy')
+
+"""
+Abstract melody symbols of the notes: chord tone (c), color tone (l) and random tone (x)
+"""
+melodic_classes = ['c', 'l', 'x']
+
+"""
+Rhythmic figures of the vocabulary, in the order of rhythm_ticks
+"""
+rhythm_figures = list(rhythm_ticks)
+
+"""
+Vocabulary of the parsed symbols, the code of a symbol is its position in the list:
+first the notes of parse_melody (melodic class and figure, grouped by melodic class),
+then the rests (figure with an "r" prefix), then the notes of parse_rhythm (figure only).
+The codes fit in a uint16.
+"""
+melody_symbols = [m + figure for m in melodic_classes for figure in rhythm_figures] + \
+                 ['r' + figure for figure in rhythm_figures] + rhythm_figures
+
+"""
+Dictionary mapping each symbol of melody_symbols to its code
+"""
+melody_symbol_codes = {symbol: code for code, symbol in enumerate(melody_symbols)}
+
+# first code of the rests and of the figures without a melodic class
+rest_codes_start = len(melodic_classes) * len(rhythm_figures)
+figure_codes_start = rest_codes_start + len(rhythm_figures)
+
+
+def encode_symbol(figure, melodic_class=None, rest=False):
+    """
+    Gets the code of a symbol from its components.
+
+    :param figure: rhythmic figure (ex: '4dot')
+    :param melodic_class: c, l or x (None for the rests and for the notes of parse_rhythm)
+    :param rest: True for a rest
+    :return: integer code
+    """
+    figure_index = rhythm_figures.index(figure)
+    if rest:
+        return rest_codes_start + figure_index
+    if melodic_class is None:
+        return figure_codes_start + figure_index
+    return melodic_classes.index(melodic_class) * len(rhythm_figures) + figure_index
+
+
+def symbol_components(code):
+    """
+    Gets the components of the symbol with a certain code.
+
+    :param code: integer code
+    :return: (rhythmic figure, melodic class or None, rest flag)
+    """
+    code = int(code)
+    if not 0 <= code < len(melody_symbols):
+        raise ValueError('{} is not a valid symbol code'.format(code))
+    figure = rhythm_figures[code % len(rhythm_figures)]
+    if code >= figure_codes_start:
+        return figure, None, False
+    if code >= rest_codes_start:
+        return figure, None, True
+    return figure, melodic_classes[code // len(rhythm_figures)], False
+
+
+def encode_symbols(symbols):
+    """
+    Converts a list of symbols (returned by parse_melody or parse_rhythm) in an array of codes.
+
+    :param symbols: list of symbols
+    :return: uint16 numpy array
+    """
+    try:
+        return np.array([melody_symbol_codes[symbol] for symbol in symbols], dtype=np.uint16)
+    except KeyError as error:
+        raise ValueError('{} is not a symbol of the vocabulary'.format(error.args[0]))
+
+
+def decode_symbols(codes):
+    """
+    Converts an array of codes in the list of the corresponding symbols.
+
+    :param codes: array (or list) of codes
+    :return: list of symbols
+    """
+    return [melody_symbols[code] for code in np.asarray(codes, dtype=np.int64).tolist()]
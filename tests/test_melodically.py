@@ -1,6 +1,15 @@
+import asyncio
+import concurrent.futures
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
 import unittest
 from melodically import *
 from mocks import *
+from melodically.corpus import analyze_corpus, analyze_midi_files
 
 
 class TestParseMidiToStd(unittest.TestCase):
@@ -53,6 +62,154 @@ class TestParseMusicalNote(unittest.TestCase):
         self.assertEqual(parse_musical_note('B#', 'CM'), 'x')
 
 
+class TestPitchClassMasks(unittest.TestCase):
+    def test_pitch_class_mask(self):
+        self.assertEqual(0b000010010001, pitch_class_mask(['C', 'E', 'G']))
+        self.assertEqual(pitch_class_mask(['A#', 'D#']), pitch_class_mask(['Bb', 'Eb']))
+
+    def test_chord_masks(self):
+        self.assertEqual((pitch_class_mask(['C', 'E', 'G', 'A#']), pitch_class_mask(['D', 'F', 'A'])),
+                         get_chord_masks('C7'))
+
+    def test_melodic_classes(self):
+        self.assertEqual('cxlxclxcxlxl', get_melodic_classes('CM'))
+
+    def test_mode_masks(self):
+        self.assertEqual(pitch_class_mask(modes_dict['D'][0][1]), get_mode_masks()[2, 0, 1])
+
+    def test_invalid_note(self):
+        self.assertRaises(ValueError, std_to_midi, 'H')
+
+
+class TestSpellChord(unittest.TestCase):
+    def test_dictionary_chords(self):
+        for chord in ['CM', 'C7', 'Cm', 'F#M', 'BbM', 'Ebm', 'G7']:
+            self.assertEqual(chord_tones[chord.replace('Bb', 'A#').replace('Eb', 'D#')], spell_chord(chord))
+
+    def test_extended_chords(self):
+        self.assertEqual({'c': ['C', 'D', 'E', 'G', 'B'], 'l': ['F', 'A']}, spell_chord('Cmaj9'))
+        self.assertEqual({'c': ['F#', 'A', 'C', 'E'], 'l': ['G', 'B', 'D']}, spell_chord('F#m7b5'))
+        self.assertEqual(['A#', 'C', 'D', 'E', 'F', 'G', 'G#'], spell_chord('Bb13#11')['c'])
+        self.assertEqual(['C', 'D#', 'F#', 'A'], spell_chord('Cdim7')['c'])
+        self.assertEqual(['C', 'F', 'G'], spell_chord('Csus4')['c'])
+        self.assertEqual(['C', 'C#', 'E', 'F#', 'G', 'A#'], spell_chord('C7(b9,#11)')['c'])
+
+    def test_minor_add(self):
+        for chord in ['Cmadd9', 'Cm(add9)', 'Cm add9']:
+            self.assertEqual({'c': ['C', 'D', 'D#', 'G'], 'l': ['F', 'G#', 'A#']}, spell_chord(chord))
+        self.assertEqual(['C', 'D#', 'F', 'G'], spell_chord('Cmadd11')['c'])
+        self.assertEqual(['C', 'E', 'G', 'B'], spell_chord('Cma7')['c'])
+        midi_queue = MidiNoteQueue()
+        for i, note in enumerate([60, 62, 64, 65]):
+            midi_queue.push('note_on', note, 1.0 + i)
+            midi_queue.push('note_off', note, 1.5 + i)
+        self.assertEqual(['c4', 'r4', 'c4', 'r4', 'x4', 'r4', 'l4'],
+                         parse_melody(midi_queue, 'Cm(add9)', get_durations(120)))
+
+    def test_power_chord_and_no3(self):
+        self.assertEqual(['C', 'G'], spell_chord('C5')['c'])
+        self.assertEqual(['A', 'E'], spell_chord('A5')['c'])
+        self.assertEqual(['C', 'G'], spell_chord('C(no3)')['c'])
+        self.assertEqual(['C', 'G', 'A#'], spell_chord('C7no3')['c'])
+        self.assertEqual({'c': ['C', 'G', 'A#'], 'l': ['D', 'D#', 'F', 'G#']}, spell_chord('Cm7(no3)'))
+        self.assertRaises(ValueError, spell_chord, 'Cadd3')
+        self.assertRaises(ValueError, spell_chord, 'Cb3')
+
+    def test_slash_chord(self):
+        self.assertEqual({'c': ['A', 'C', 'E', 'G'], 'l': ['B', 'D', 'F']}, spell_chord('Am/G'))
+        self.assertEqual(['C', 'E', 'G', 'A#'], spell_chord('C/Bb')['c'])
+
+    def test_enharmonic_roots(self):
+        self.assertEqual(spell_chord('Bmaj7'), spell_chord('Cbmaj7'))
+        self.assertEqual(spell_chord('Em'), spell_chord('Fbm'))
+        self.assertEqual(spell_chord('Fm'), spell_chord('E#m'))
+        self.assertEqual(spell_chord('C7'), spell_chord('B#7'))
+        self.assertEqual(['D', 'F#', 'A', 'B'], spell_chord('D/Cb')['c'])
+        self.assertEqual(['C', 'E', 'G', 'F'], spell_chord('C/E#')['c'])
+
+    def test_enharmonic_symbols(self):
+        # the enharmonic symbols of the chords of chord_tones use the dictionary
+        for chord, equivalent in [('A#dim', 'Bbdim'), ('C#M', 'DbM'), ('BM', 'CbM'), ('D#m', 'Ebm'), ('F7', 'E#7')]:
+            self.assertEqual(get_chord(chord), get_chord(equivalent))
+            self.assertEqual(get_melodic_classes(chord), get_melodic_classes(equivalent))
+        self.assertEqual(['A#', 'C#', 'E', 'G#'], get_chord('Bbdim')['c'])
+        midi_queue = MidiNoteQueue()
+        for i, note in enumerate([58, 64, 67, 68]):
+            midi_queue.push('note_on', note, 1.0 + i)
+            midi_queue.push('note_off', note, 1.5 + i)
+        self.assertEqual(['c4', 'r4', 'c4', 'r4', 'x4', 'r4', 'c4'],
+                         parse_melody(midi_queue, 'Bbdim', get_durations(120)))
+        self.assertEqual(parse_melody(midi_queue, 'A#dim', get_durations(120)),
+                         parse_melody(midi_queue, 'Bbdim', get_durations(120)))
+
+    def test_invalid_chord(self):
+        self.assertRaises(ValueError, spell_chord, 'H7')
+        self.assertRaises(ValueError, spell_chord, 'Cxyz')
+        self.assertRaises(ValueError, spell_chord, 'Fbb')
+        self.assertRaises(ValueError, spell_chord, 'C/H')
+
+    def test_unknown_chord_parsing(self):
+        self.assertEqual('c', parse_musical_note('D', 'Cmaj9'))
+        self.assertEqual('l', parse_musical_note('F', 'Cmaj9'))
+        self.assertEqual('x', parse_musical_note('C#', 'Cmaj9'))
+        self.assertEqual([48, 51, 55, 58], chord_to_midi('Cm7'))
+
+    def test_cache(self):
+        spell_chord('Dm11')
+        hits = spell_chord.cache_info().hits
+        spell_chord('Dm11')
+        self.assertEqual(hits + 1, spell_chord.cache_info().hits)
+        self.assertEqual(chord_cache_size, spell_chord.cache_info().maxsize)
+
+
+class TestTables(unittest.TestCase):
+    def test_lazy_dict(self):
+        calls = []
+        table = LazyDict('test_lazy_dict', lambda: calls.append(1) or {'a': 1})
+        self.assertEqual([], calls)
+        self.assertEqual(1, table['a'])
+        table['b'] = 2
+        self.assertEqual({'a': 1, 'b': 2}, dict(table))
+        self.assertEqual([1], calls)
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tables.npz')
+            save_tables(path)
+            register_table('test_save_load', lambda: 'built')
+            self.assertIn('modes_dict', load_tables(path))
+        self.assertEqual(modes_dict['C'], get_table('modes_dict')['C'])
+        self.assertEqual('built', get_table('test_save_load'))
+
+    def test_load_stale_tables(self):
+        import melodically.harmony as harmony
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tables.npz')
+            save_tables(path)
+            self.assertIn('mode_weights', load_tables(path))
+            negative_weight = harmony.affinity_negative_weight
+            harmony.affinity_negative_weight = negative_weight * 2
+            try:
+                loaded = load_tables(path)
+            finally:
+                harmony.affinity_negative_weight = negative_weight
+            self.assertNotIn('mode_weights', loaded)
+            self.assertNotIn('search_weights', loaded)
+            self.assertIn('modes_dict', loaded)
+
+    def test_load_invalid_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tables.npz')
+            with open(path, 'wb') as file:
+                file.write(b'not a tables file')
+            with self.assertRaises(ValueError):
+                load_tables(path)
+
+    def test_lazy_import(self):
+        math = lazy_import('math')
+        self.assertEqual(2, math.sqrt(4))
+
+
 class TestGetDurations(unittest.TestCase):
     def test_60bpm(self):
         rhythmic_dictionary = get_durations(60)
@@ -110,6 +267,210 @@ class TestMidiNoteQueue(unittest.TestCase):
         self.assertEqual(['A#'], midi_queue.get_notes())
 
 
+class TestPolyphonicMidiNoteQueue(unittest.TestCase):
+    def setUp(self):
+        # C major chord with a melody on top, then a single note
+        self.midi_queue = MidiNoteQueue(polyphonic=True)
+        notes = [(48, 1.0, 2.0), (52, 1.01, 2.0), (55, 1.02, 1.5), (72, 1.03, 1.4), (74, 1.5, 1.9), (67, 2.5, 3.0)]
+        events = [(on, 'note_on', note) for note, on, _ in notes] + [(off, 'note_off', note) for note, _, off in notes]
+        for timestamp, msg_type, note in sorted(events, key=lambda e: e[0]):
+            self.midi_queue.push(msg_type, note, timestamp)
+
+    def test_all_notes_kept(self):
+        self.assertEqual(6, len(self.midi_queue.get_notes()))
+
+    def test_clusters(self):
+        self.assertEqual([{'timestamp': 1.0, 'notes': [48, 52, 55, 72]},
+                          {'timestamp': 1.5, 'notes': [74]},
+                          {'timestamp': 2.5, 'notes': [67]}], self.midi_queue.get_clusters())
+
+    def test_melody(self):
+        spans = get_note_spans(self.midi_queue)
+        self.assertEqual([72, 74, 67], spans['pitch'].tolist())
+        self.assertEqual([1.4, 1.9, 3.0], spans['offset'].tolist())
+
+    def test_note_off_pairing(self):
+        midi_queue = MidiNoteQueue(polyphonic=True)
+        midi_queue.push('note_on', 60, 1.0)
+        midi_queue.push('note_on', 60, 1.01)
+        midi_queue.push('note_on', 64, 1.02)
+        midi_queue.push('note_off', 60, 1.5)
+        midi_queue.push('note_off', 62, 1.5)  # discarded
+        midi_queue.clean_unclosed_note_ons()
+        self.assertEqual([('note_on', 60, 1.0), ('note_off', 60, 1.5)],
+                         [(msg['type'], msg['note'], msg['timestamp']) for msg in midi_queue.get_container()])
+
+    def test_harmonic_state(self):
+        harmonic_state = HarmonicState(buffer_size=8)
+        harmonic_state.push_clusters(self.midi_queue.get_clusters())
+        self.assertEqual(['C', 'E', 'G', 'C', 'D', 'G'], harmonic_state.noteBuffer)
+        self.assertEqual('C', harmonic_state.update_scale()['root'])
+
+
+class TestChordRecognition(unittest.TestCase):
+    def setUp(self):
+        # CM, FM, G7, Cm chords of 1.9 seconds every 2 seconds
+        self.events = []
+        for notes, timestamp in [([48, 52, 55], 1.0), ([53, 57, 60], 3.0), ([55, 59, 62, 65], 5.0), ([48, 51, 55], 7.0)]:
+            self.events.extend((timestamp, 'note_on', note) for note in notes)
+            self.events.extend((timestamp + 1.9, 'note_off', note) for note in notes)
+        self.events.sort(key=lambda e: e[0])
+
+    def test_templates(self):
+        chords, templates = get_chord_templates(['CM', 'C7', 'Cmaj9'])
+        self.assertEqual(['CM', 'C7', 'Cmaj9'], chords)
+        self.assertEqual((3, 12), templates.shape)
+        self.assertEqual([1, 0, 0, 0, 1, 0, 0, 1, 0, 0, 0, 0], (templates[0] > 0).astype(int).tolist())
+
+    def test_recognize_chords(self):
+        midi_queue = MidiNoteQueue(polyphonic=True)
+        for timestamp, msg_type, note in self.events:
+            midi_queue.push(msg_type, note, timestamp)
+        self.assertEqual(['CM', 'FM', 'G7', 'Cm'], [w['chord'] for w in recognize_chords(midi_queue, window=2.0)])
+        self.assertEqual([], recognize_chords(MidiNoteQueue()))
+
+    def test_arpeggio(self):
+        midi_queue = CompactMidiNoteQueue()
+        for i, note in enumerate([57, 60, 64, 60, 57, 64]):
+            midi_queue.push('note_on', note, 1 + i * 0.5)
+            midi_queue.push('note_off', note, 1.4 + i * 0.5)
+        self.assertEqual(['Am'], [w['chord'] for w in recognize_chords(midi_queue, window=3.0)])
+
+    def test_silent_window(self):
+        midi_queue = MidiNoteQueue()
+        midi_queue.push('note_on', 60, 1.0)
+        midi_queue.push('note_off', 60, 1.5)
+        midi_queue.push('note_on', 64, 4.0)
+        midi_queue.push('note_off', 64, 4.5)
+        self.assertEqual([1.0, 2.0, 3.0, 4.0], [w['timestamp'] for w in recognize_chords(midi_queue, 1.0)])
+        self.assertIsNone(recognize_chords(midi_queue, 1.0)[1]['chord'])
+
+    def test_streaming_recognizer(self):
+        recognizer = ChordRecognizer(window=2.0)
+        chords = []
+        for timestamp, msg_type, note in self.events:
+            recognizer.push(msg_type, note, timestamp)
+            if msg_type == 'note_off':
+                chords.append(recognizer.recognize())
+        self.assertEqual(['CM'] * 3 + ['FM'] * 3 + ['G7'] * 4 + ['Cm'] * 3, chords)
+        # the breakpoints older than the window are removed
+        self.assertLessEqual(len(recognizer._times), 8)
+        self.assertEqual([0.0] * 12, recognizer.get_profile(20.0).tolist())
+        self.assertIsNone(recognizer.recognize(20.0))
+
+    def test_profile(self):
+        recognizer = ChordRecognizer(window=1.0)
+        recognizer.push('note_on', 60, 0.0)
+        recognizer.push('note_on', 64, 0.5)
+        recognizer.push('note_off', 60, 1.0)
+        profile = recognizer.get_profile(1.25)
+        self.assertAlmostEqual(0.75, profile[0])
+        self.assertAlmostEqual(0.75, profile[4])
+
+
+class TestCompactMidiNoteQueue(unittest.TestCase):
+    def push_all(self, queue, mock):
+        for msg in mock:
+            queue.push(msg['type'], msg['note'], msg['timestamp'])
+        return queue
+
+    def test_same_as_midi_note_queue(self):
+        for mock in [midi_note_queue_mock_1, midi_note_queue_mock_2, midi_note_queue_mock_4]:
+            queue = self.push_all(MidiNoteQueue(), mock)
+            compact_queue = self.push_all(CompactMidiNoteQueue(capacity=2), mock)
+            self.assertEqual(queue.get_container(), compact_queue.get_container())
+            queue.clean_unclosed_note_ons()
+            compact_queue.clean_unclosed_note_ons()
+            self.assertEqual(queue.get_container(), compact_queue.get_container())
+            self.assertEqual(queue.get_notes(), compact_queue.get_notes())
+
+    def test_pop(self):
+        compact_queue = self.push_all(CompactMidiNoteQueue(), midi_note_queue_mock_2)
+        compact_queue.clean_unclosed_note_ons()
+        self.assertEqual(midi_note_queue_mock_2[2], compact_queue.pop())
+        self.assertEqual(midi_note_queue_mock_2[3], compact_queue.pop())
+        self.assertEqual(0, len(compact_queue))
+
+    def test_columns(self):
+        compact_queue = self.push_all(CompactMidiNoteQueue(), midi_note_queue_mock_3)
+        self.assertEqual([65, 65, 55, 55, 75, 75], compact_queue.get_midi_notes().tolist())
+        self.assertEqual([msg['timestamp'] for msg in midi_note_queue_mock_3],
+                         compact_queue.get_timestamps().tolist())
+        self.assertFalse(compact_queue.get_timestamps().flags.writeable)
+
+    def test_clear(self):
+        compact_queue = self.push_all(CompactMidiNoteQueue(), midi_note_queue_mock_3)
+        compact_queue.clear()
+        self.assertEqual([], compact_queue.get_container())
+
+
+class TestConcurrentMidiNoteQueue(unittest.TestCase):
+    def setUp(self):
+        # frequent thread switches, to interleave producer and consumer
+        self.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+
+    def tearDown(self):
+        sys.setswitchinterval(self.switch_interval)
+
+    @staticmethod
+    def produce(concurrent_queue, n_notes, retry=True):
+        for i in range(n_notes):
+            for msg in [('note_on', 60 + i % 12, 1.0 + i), ('note_off', 60 + i % 12, 1.5 + i)]:
+                while not concurrent_queue.push(*msg) and retry:
+                    time.sleep(0)
+
+    def test_overflow(self):
+        concurrent_queue = ConcurrentMidiNoteQueue(capacity=4)
+        self.produce(concurrent_queue, 3, retry=False)
+        self.assertEqual(2, concurrent_queue.droppedMessages)
+        self.assertEqual([1.0, 1.5, 2.0, 2.5], [ts for _, _, ts in concurrent_queue.drain()])
+        self.assertEqual([], concurrent_queue.drain())
+        concurrent_queue.push('note_on', 60, 10.0)
+        self.assertEqual(1, len(concurrent_queue))
+        concurrent_queue.clear()
+        self.assertEqual(0, len(concurrent_queue))
+
+    def test_snapshot_closed(self):
+        concurrent_queue = ConcurrentMidiNoteQueue()
+        for msg in [('note_on', 60, 1.0), ('note_off', 60, 1.5), ('note_on', 62, 2.0)]:
+            concurrent_queue.push(*msg)
+        midi_queue = concurrent_queue.snapshot_closed()
+        self.assertEqual([1.0, 1.5], [msg['timestamp'] for msg in midi_queue.get_container()])
+        self.assertEqual(['c8'], parse_melody(midi_queue, 'CM', get_durations(60)))
+        midi_queue.clear()
+        concurrent_queue.push('note_off', 62, 3.0)
+        self.assertEqual(['l4'], parse_melody(concurrent_queue.snapshot_closed(), 'CM', get_durations(60)))
+
+    def test_threads_order(self):
+        # every message reaches the consumer once, in push order
+        concurrent_queue = ConcurrentMidiNoteQueue(CompactMidiNoteQueue(), capacity=64)
+        producer = threading.Thread(target=self.produce, args=(concurrent_queue, 20000))
+        drained = []
+        producer.start()
+        while producer.is_alive() or len(concurrent_queue):
+            drained.extend(concurrent_queue.drain())
+        producer.join()
+        self.assertEqual(40000, len(drained))
+        self.assertEqual([1.0 + i / 2 for i in range(40000)], [ts for _, _, ts in drained])
+
+    def test_threads_parse(self):
+        # parsing and clearing on the consumer thread while the producer pushes
+        concurrent_queue = ConcurrentMidiNoteQueue(capacity=256)
+        producer = threading.Thread(target=self.produce, args=(concurrent_queue, 5000))
+        durations = get_durations(120)
+        symbols = []
+        producer.start()
+        while producer.is_alive() or len(concurrent_queue):
+            midi_queue = concurrent_queue.snapshot_closed()
+            if len(midi_queue.get_container()) >= 200:
+                symbols.extend(parse_melody(midi_queue, 'CM', durations))
+                midi_queue.clear()
+        producer.join()
+        symbols.extend(parse_melody(concurrent_queue.snapshot(), 'CM', durations))
+        self.assertEqual(5000, sum(not symbol.startswith('r') for symbol in symbols))
+
+
 class TestGetNearestRhythm(unittest.TestCase):
     def setUp(self):
         self.durations = get_durations(60)
@@ -133,6 +494,72 @@ class TestGetNearestRhythm(unittest.TestCase):
         self.assertEqual('16', get_nearest_rhythm(1 / 4 - 0.02, self.durations))
 
 
+class TestTempoTracker(unittest.TestCase):
+    def test_steady_tempo(self):
+        tracker = TempoTracker(120)
+        for i in range(10):
+            tracker.push_onset(1 + i * 0.5)
+        self.assertAlmostEqual(120, tracker.bpm)
+
+    def test_tempo_change(self):
+        tracker = TempoTracker(120)
+        durations = tracker.durations
+        table = tracker.durationTable
+        timestamp = 1.0
+        for i in range(40):
+            tracker.push_onset(timestamp)
+            timestamp = timestamp + (0.5 if i % 3 else 0.25) * 1.1  # quarter and eighth notes at 109 bpm
+        self.assertAlmostEqual(120 / 1.1, tracker.bpm, places=1)
+        # the grid is updated in place
+        self.assertIs(durations, tracker.durations)
+        self.assertIs(table, tracker.durationTable)
+        for symbol, value in get_durations(tracker.bpm).items():
+            self.assertAlmostEqual(value, durations[symbol])
+        self.assertEqual(table.values.tolist(), list(durations.values()))
+        self.assertEqual('4', tracker.quantize(0.55))
+
+    def test_ignored_intervals(self):
+        tracker = TempoTracker(120)
+        self.assertFalse(tracker.update(0.35))  # between 8 and 4
+        self.assertFalse(tracker.update(0))
+        self.assertAlmostEqual(120, tracker.bpm)
+
+    def test_queue_listener(self):
+        tracker = TempoTracker(120)
+        for midi_queue in (MidiNoteQueue(), CompactMidiNoteQueue()):
+            tracker.reset(120)
+            midi_queue.add_listener(tracker.push)
+            for i in range(20):
+                midi_queue.push('note_on', 60, 1 + i * 0.55)
+                midi_queue.push('note_off', 60, 1 + i * 0.55 + 0.3)
+                midi_queue.push('note_off', 61, 1 + i * 0.55 + 0.3)  # discarded
+            self.assertAlmostEqual(60 / 0.55, tracker.bpm, places=0)
+            self.assertEqual(['8', 'r8'] * 19 + ['8'], parse_rhythm(midi_queue, tracker.durationTable))
+            midi_queue.remove_listener(tracker.push)
+
+
+class TestQuantizeIntervals(unittest.TestCase):
+    def setUp(self):
+        self.durations = get_durations(93)
+        self.duration_table = DurationTable(self.durations)
+
+    def test_same_as_argmin(self):
+        intervals = [0, 0.001, 0.1, 0.25, 0.33, 0.5, 0.9, 1.2, 2, 2.58, 3.5, 10]
+        symbols = list(self.durations.keys())
+        values = list(self.durations.values())
+        for interval, index in zip(intervals, quantize_intervals(intervals, self.duration_table)):
+            distances = [abs(interval - x) for x in values]
+            self.assertEqual(symbols[distances.index(min(distances))], self.duration_table.symbols[index])
+
+    def test_ties(self):
+        # equally distant from '4' (0.5) and '4dot' (0.75) at 120 bpm
+        duration_table = DurationTable(get_durations(120))
+        self.assertEqual('4', duration_table.symbols[quantize_intervals(0.625, duration_table)])
+
+    def test_wrapper(self):
+        self.assertEqual('4dot', get_nearest_rhythm(3 / 2 * 60 / 93, self.duration_table))
+
+
 class TestParseRhythm(unittest.TestCase):
     def setUp(self):
         self.durations = get_durations(60)
@@ -152,6 +579,24 @@ class TestParseRhythm(unittest.TestCase):
         self.assertEqual(['1', '16', 'r16', '4'], result)
 
 
+class TestGetNoteSpans(unittest.TestCase):
+    def test_mock_4(self):
+        midi_queue = MidiNoteQueue()
+        for msg in midi_note_queue_mock_4:
+            midi_queue.push(msg['type'], msg['note'], msg['timestamp'])
+        spans = get_note_spans(midi_queue)
+        self.assertEqual([65, 55, 76], spans['pitch'].tolist())
+        self.assertEqual([2 - 0.003, 6, 8], spans['onset'].tolist())
+        self.assertEqual([6 - 0.001, 6.25 + 0.001, 9 + 0.02], spans['offset'].tolist())
+        self.assertAlmostEqual(8 - 6.251, spans['rest'][1])
+
+    def test_unclosed_note_on(self):
+        midi_queue = MidiNoteQueue()
+        for msg in midi_note_queue_mock_2:
+            midi_queue.push(msg['type'], msg['note'], msg['timestamp'])
+        self.assertEqual([70], get_note_spans(midi_queue)['pitch'].tolist())
+
+
 class TestParseMelody(unittest.TestCase):
     def setUp(self):
         self.durations = get_durations(60)
@@ -164,6 +609,549 @@ class TestParseMelody(unittest.TestCase):
         self.assertEqual(['l1', 'c16', 'r16', 'c4'], result)
 
 
+class TestParseMelodyBatch(unittest.TestCase):
+    def setUp(self):
+        durations = [get_durations(60), get_durations(120)]
+        self.jobs = []
+        for i, mock in enumerate([midi_note_queue_mock_1, midi_note_queue_mock_4, []] * 3):
+            midi_queue = MidiNoteQueue()
+            for msg in mock:
+                midi_queue.push(msg['type'], msg['note'], msg['timestamp'])
+            self.jobs.append((midi_queue, ['CM', 'Dm', 'G7', 'Cmaj9'][i % 4], durations[i % 2]))
+
+    def expected(self):
+        return [parse_melody(*job) for job in self.jobs]
+
+    def test_batch(self):
+        codes, offsets = parse_melody_batch(self.jobs)
+        self.assertEqual('uint16', codes.dtype.name)
+        self.assertEqual(len(self.jobs) + 1, len(offsets))
+        self.assertEqual(self.expected(), decode_melody_batch(codes, offsets))
+
+    def test_executor(self):
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            codes, offsets = parse_melody_batch(self.jobs, executor, chunk_size=2)
+        self.assertEqual(self.expected(), decode_melody_batch(codes, offsets))
+
+    def test_process_executor_cleans_queues(self):
+        for midi_queue, _, _ in self.jobs:
+            midi_queue.push('note_on', 72, 100.0)
+        with concurrent.futures.ProcessPoolExecutor(2) as executor:
+            codes, offsets = parse_melody_batch(self.jobs, executor, chunk_size=2)
+        for midi_queue, _, _ in self.jobs:
+            self.assertNotIn(100.0, [msg['timestamp'] for msg in midi_queue.get_container()])
+        self.assertEqual(self.expected(), decode_melody_batch(codes, offsets))
+
+    def test_empty(self):
+        codes, offsets = parse_melody_batch([])
+        self.assertEqual([0], offsets.tolist())
+        self.assertEqual(0, len(codes))
+
+    def test_unknown_figure(self):
+        self.assertRaises(ValueError, parse_melody_batch, [(self.jobs[0][0], 'CM', {'4': 1.0, '5': 1.25})])
+
+
+class TestVocabulary(unittest.TestCase):
+    def test_codes(self):
+        self.assertEqual(len(melody_symbols), len(set(melody_symbols)))
+        self.assertEqual('c1', melody_symbols[0])
+        self.assertEqual(encode_symbol('4dot', 'l'), melody_symbol_codes['l4dot'])
+        self.assertEqual(encode_symbol('16', rest=True), melody_symbol_codes['r16'])
+        self.assertEqual(encode_symbol('8t'), melody_symbol_codes['8t'])
+
+    def test_components(self):
+        for code, symbol in enumerate(melody_symbols):
+            figure, melodic_class, rest = symbol_components(code)
+            self.assertEqual(code, encode_symbol(figure, melodic_class, rest))
+        self.assertEqual(('4t', 'x', False), symbol_components(melody_symbol_codes['x4t']))
+        self.assertRaises(ValueError, symbol_components, len(melody_symbols))
+
+    def test_encode_decode(self):
+        symbols = ['c4', 'x8', 'r4', 'l2', '16t', 'r1']
+        codes = encode_symbols(symbols)
+        self.assertEqual('uint16', codes.dtype.name)
+        self.assertEqual(symbols, decode_symbols(codes))
+        self.assertRaises(ValueError, encode_symbols, ['c5'])
+
+    def test_encoded_parsers(self):
+        durations = get_durations(60)
+        for mock in [midi_note_queue_mock_1, midi_note_queue_mock_2, midi_note_queue_mock_4]:
+            midi_queue = MidiNoteQueue()
+            for msg in mock:
+                midi_queue.push(msg['type'], msg['note'], msg['timestamp'])
+            self.assertEqual(parse_melody(midi_queue, 'Dm', durations),
+                             decode_symbols(parse_melody(midi_queue, 'Dm', durations, encoded=True)))
+            self.assertEqual(parse_rhythm(midi_queue, durations),
+                             decode_symbols(parse_rhythm(midi_queue, durations, encoded=True)))
+
+
+class TestNGramCounter(unittest.TestCase):
+    def setUp(self):
+        self.symbols = ['c4', 'l8', 'c4', 'l8', 'x4', 'r4', 'c4', 'l8', 'c4']
+        self.codes = encode_symbols(self.symbols)
+
+    def test_update(self):
+        counter = NGramCounter(2)
+        counter.update(self.codes)
+        self.assertEqual(3, counter.get_count(encode_symbols(['c4', 'l8'])))
+        self.assertEqual(2, counter.get_count(encode_symbols(['l8', 'c4'])))
+        self.assertEqual(0, counter.get_count(encode_symbols(['c4', 'c4'])))
+        self.assertEqual(5, len(counter))
+        self.assertEqual((tuple(encode_symbols(['c4', 'l8']).tolist()), 3), counter.most_common(1)[0])
+
+    def test_ragged_update(self):
+        counter = NGramCounter(3)
+        counter.update(np.concatenate([self.codes[:4], self.codes[4:]]), [0, 4, len(self.codes)])
+        # the trigrams crossing the two phrases are not counted
+        self.assertEqual(2 + 3, sum(counter.get_arrays()[1].tolist()))
+        self.assertEqual(0, counter.get_count(self.codes[2:5]))
+
+    def test_push(self):
+        counter = NGramCounter(2)
+        for code in self.codes:
+            counter.push(code)
+        reference = NGramCounter(2)
+        reference.update(self.codes)
+        self.assertEqual(reference.most_common(), counter.most_common())
+        counter.end_phrase()
+        counter.push(self.codes[0])
+        self.assertEqual(8, sum(counter.get_arrays()[1].tolist()))
+
+    def test_merge_and_prune(self):
+        counter = NGramCounter(2)
+        counter.update(self.codes[:5])
+        other = NGramCounter(2)
+        other.update(self.codes[4:])
+        counter.merge(other)
+        reference = NGramCounter(2)
+        reference.update(self.codes)
+        self.assertEqual(reference.most_common(), counter.most_common())
+        counter.prune(2)
+        self.assertEqual(2, len(counter))
+        self.assertEqual(3, counter.get_count(encode_symbols(['c4', 'l8'])))
+        self.assertRaises(ValueError, counter.merge, NGramCounter(3))
+
+    def test_transitions(self):
+        counter = NGramCounter(2)
+        counter.update(self.codes)
+        next_codes, counts = counter.get_transitions(encode_symbols(['l8']))
+        self.assertEqual(['c4', 'x4'], decode_symbols(next_codes))
+        self.assertEqual([2, 1], counts.tolist())
+
+    def test_save_load(self):
+        counter = NGramCounter(3)
+        counter.update(self.codes)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'counts.ngrams')
+            counter.save(path)
+            for mmap in (True, False):
+                loaded = NGramCounter.load(path, mmap)
+                self.assertEqual(counter.most_common(), loaded.most_common())
+                loaded.update(self.codes[:3])
+                self.assertEqual(counter.get_count(self.codes[:3]) + 1, loaded.get_count(self.codes[:3]))
+                del loaded
+            NGramCounter(2).save(path)
+            self.assertEqual(0, len(NGramCounter.load(path)))
+            counter.save(path)
+            with open(path, 'rb') as file:
+                data = file.read()
+            for length in [10, len(data) - 8]:
+                with open(path, 'wb') as file:
+                    file.write(data[:length])
+                self.assertRaises(ValueError, NGramCounter.load, path)
+
+    def test_invalid_codes(self):
+        counter = NGramCounter(2, 10)
+        self.assertRaises(ValueError, counter.update, [1, 12])
+        self.assertRaises(ValueError, counter.update, [-1, 2])
+        self.assertRaises(ValueError, counter.push, 10)
+        self.assertRaises(ValueError, counter.get_count, [1, 10])
+        self.assertRaises(ValueError, NGramCounter(2).push, mode_vocabulary_size - 1)
+        self.assertEqual(0, len(counter))
+
+    def test_mode_transitions(self):
+        harmonic_state = HarmonicState(4)
+        counter = NGramCounter(2, mode_vocabulary_size)
+        for notes in [['C', 'E', 'G', 'C'], ['A', 'C', 'E', 'A'], ['C', 'E', 'G', 'C']]:
+            harmonic_state.push_notes(notes)
+            counter.push(encode_mode(harmonic_state.update_scale()))
+        (first, second), count = counter.most_common(1)[0]
+        self.assertEqual('C', decode_mode(first)['root'])
+        self.assertEqual('A', decode_mode(second)['root'])
+        self.assertEqual(1, count)
+
+
+class TestMarkovMelodyGenerator(unittest.TestCase):
+    def setUp(self):
+        self.symbols = ['c4', 'l8', 'c8', 'x4', 'r4', 'c2', 'l4', 'c4', 'l8', 'c8', 'c1', 'r2']
+        counter = NGramCounter(3)
+        counter.update(encode_symbols(self.symbols * 3))
+        self.generator = MarkovMelodyGenerator(counter)
+
+    def test_tone_tables(self):
+        tones, lengths = get_tone_tables(['CM', 'Bb13#11'])
+        self.assertEqual([3, 4, 5], lengths[0].tolist())
+        self.assertEqual([0, 4, 7], tones[0, 0, :3].tolist())
+        self.assertEqual([7, 7, 5], lengths[1].tolist())  # no color tones: chord tones used
+
+    def test_sample(self):
+        codes = self.generator.sample(100, n_chains=20, seed=0)
+        self.assertEqual((20, 100), codes.shape)
+        self.assertEqual('uint16', codes.dtype.name)
+        # every trigram of the chains is a trigram of the training phrase
+        trigrams = set(zip(self.symbols * 2, (self.symbols * 2)[1:], (self.symbols * 2)[2:]))
+        for chain in codes:
+            symbols = decode_symbols(chain)
+            self.assertTrue(set(zip(symbols, symbols[1:], symbols[2:])) <= trigrams)
+        self.assertEqual(codes.tolist(), self.generator.sample(100, n_chains=20, seed=0).tolist())
+
+    def test_realize(self):
+        codes = encode_symbols(['c4', 'l4', 'x4', 'r4', 'c1', 'l4'])
+        pitches = MarkovMelodyGenerator.realize(codes, ['CM', 'Am'], seed=0)
+        self.assertEqual(-1, pitches[3])
+        chords = ['CM'] * 3 + ['Am'] * 2
+        classes = [get_melodic_classes(chord)[p % 12] for chord, p in zip(chords, pitches[[0, 1, 2, 4, 5]])]
+        self.assertEqual(['c', 'l', 'x', 'c', 'l'], classes)
+        self.assertTrue(all(48 <= p <= 84 for p in pitches[pitches >= 0]))
+
+    def test_schedule(self):
+        codes = encode_symbols(['c4', 'r8', 'l8', 'c2'])
+        messages = MarkovMelodyGenerator.schedule(codes, [60, -1, 62, 64], get_durations(60), start=1.0)
+        self.assertEqual([('note_on', 60, 1.0), ('note_off', 60, 2.0), ('note_on', 62, 2.5), ('note_off', 62, 3.0),
+                          ('note_on', 64, 3.0), ('note_off', 64, 5.0)],
+                         [(msg['type'], msg['note'], msg['timestamp']) for msg in messages])
+
+    def test_generate(self):
+        messages = self.generator.generate(32, ['Dm', 'G7'], get_durations(120), seed=1)
+        midi_queue = MidiNoteQueue()
+        for msg in messages:
+            midi_queue.push(msg['type'], msg['note'], msg['timestamp'] + 1)
+        self.assertEqual(len(messages), len(midi_queue.get_container()))
+        self.assertRaises(ValueError, MarkovMelodyGenerator, NGramCounter(2))
+
+    def test_generate_parse_round_trip(self):
+        # the default start is a zero timestamp, that must be kept by the queue
+        messages = self.generator.generate(12, 'CM', get_durations(120), seed=0)
+        self.assertEqual(0.0, messages[0]['timestamp'])
+        midi_queue = MidiNoteQueue()
+        for msg in messages:
+            midi_queue.push(msg['type'], msg['note'], msg['timestamp'])
+        self.assertEqual(0.0, midi_queue.get_container()[0]['timestamp'])
+        codes = self.generator.sample(12, 1, np.random.default_rng(0))[0]
+        self.assertEqual([s for s in decode_symbols(codes) if s[0] != 'r'],
+                         [s for s in parse_melody(midi_queue, 'CM', get_durations(120)) if s[0] != 'r'])
+
+
+class TestStreamingMelodyParser(unittest.TestCase):
+    def setUp(self):
+        self.parser = StreamingMelodyParser('CM', get_durations(60))
+
+    def push_all(self, mock):
+        result = []
+        for msg in mock:
+            result.append(self.parser.push(msg['type'], msg['note'], msg['timestamp']))
+        return result
+
+    def test_mock_3(self):
+        self.assertEqual([[], ['l1'], [], ['c16'], [], ['x4']], self.push_all(midi_note_queue_mock_3))
+
+    def test_rest(self):
+        result = self.push_all(midi_note_queue_mock_4)
+        self.assertEqual([[], ['l1'], [], ['c16'], ['r4dot'], ['c4']], result)
+
+    def test_bad_messages(self):
+        result = self.push_all(midi_note_queue_mock_1)
+        self.assertEqual(['x2', 'x2', 'c8', 'r1'], sum(result, []))
+
+    def test_set_chord(self):
+        self.parser.push('note_on', 64, 1)
+        self.parser.set_chord('Am')
+        self.assertEqual(['c4'], self.parser.push('note_off', 64, 2))
+
+
+class TestMidiPipeline(unittest.TestCase):
+    def setUp(self):
+        # deterministic clock advancing of half a second at each message
+        self.time = 0
+        self.pipeline = MidiPipeline(maxsize=2, clock=self.clock)
+
+    def clock(self):
+        self.time = self.time + 0.5
+        return self.time
+
+    def test_sources_and_consumers(self):
+        port = VirtualMidiPort()
+
+        async def play():
+            for note in [60, 64]:
+                await port.send('note_on', note)
+                await port.send('note_off', note)
+            await port.close()
+
+        async def run():
+            await asyncio.gather(play(), self.pipeline.run())
+
+        self.pipeline.add_source('port', port)
+        self.pipeline.add_source('file', replay_messages(midi_note_queue_mock_3, speed=0))
+        note_queues = NoteQueueConsumer()
+        harmonic_states = HarmonicStateConsumer()
+        melodies = MelodyParserConsumer('CM', get_durations(60))
+        events = []
+        self.pipeline.add_consumer(note_queues)
+        self.pipeline.add_consumer(harmonic_states)
+        self.pipeline.add_consumer(melodies)
+        self.pipeline.add_consumer(events.append, maxsize=1)
+        asyncio.run(run())
+
+        self.assertEqual(10, len(events))
+        for source in ['port', 'file']:
+            timestamps = [e.timestamp for e in events if e.source == source]
+            self.assertEqual(sorted(timestamps), timestamps)
+        self.assertEqual(['C', 'E'], note_queues.queues['port'].get_notes())
+        self.assertEqual(['F', 'G', 'D#'], harmonic_states.states['file'].noteBuffer)
+        # the durations depend on how the two sources are interleaved
+        self.assertEqual(['c', 'c'], [s[0] for s in melodies.symbols['port'] if s[0] != 'r'])
+        self.assertEqual(['l', 'c', 'x'], [s[0] for s in melodies.symbols['file'] if s[0] != 'r'])
+
+    def test_stream_reader(self):
+        async def run():
+            reader = asyncio.StreamReader()
+            reader.feed_data(b'note_on 62\nprogram_change 3\nnote_off 62\n')
+            reader.feed_eof()
+            self.pipeline.add_source('socket', read_stream_messages(reader))
+            events = []
+            self.pipeline.add_consumer(events.append)
+            await self.pipeline.run()
+            return events
+
+        events = asyncio.run(run())
+        self.assertEqual([('socket', 'note_on', 62, 0.5), ('socket', 'note_off', 62, 1.0)], events)
+
+
+class TestSessionStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'rehearsal.session')
+        self.midi_queue = MidiNoteQueue()
+        with SessionWriter(self.path, index_interval=4) as writer:
+            self.midi_queue.add_listener(writer.push)
+            for i in range(20):
+                self.midi_queue.push('note_on', 60 + i % 12, 1 + i)
+                self.midi_queue.push('note_off', 60 + i % 12, 1.5 + i)
+                self.midi_queue.push('note_off', 30, 1.6 + i)  # discarded by the queue
+            self.assertEqual(40, len(writer))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_records(self):
+        reader = SessionReader(self.path)
+        self.assertEqual(40, len(reader))
+        self.assertEqual(self.midi_queue.get_container(),
+                         [{'type': midi_event_types[t], 'note': n, 'timestamp': ts}
+                          for ts, n, t in reader.records.tolist()])
+
+    def test_range(self):
+        reader = SessionReader(self.path)
+        for start, end in [(0, 100), (3, 7.5), (3.2, 3.4), (5.5, 5.5), (30, 40), (None, 2), (19.5, None)]:
+            records = reader.get_range(start, end)
+            timestamps = reader.records['timestamp']
+            selected = (timestamps >= (start or 0)) & (timestamps < (end or 100))
+            self.assertEqual(timestamps[selected].tolist(), records['timestamp'].tolist())
+        self.assertTrue(np.shares_memory(reader.get_range(3, 7), reader.records))
+
+    def test_replay(self):
+        reader = SessionReader(self.path)
+        midi_queue = reader.replay(MidiNoteQueue(), 3, 6)
+        self.assertEqual(['l4', 'r4', 'x4', 'r4', 'c4'], parse_melody(midi_queue, 'CM', get_durations(120)))
+        harmonic_state = HarmonicState(4)
+        harmonic_state.push_notes(reader.get_notes(3, 6))
+        self.assertEqual(['D', 'D#', 'E'], harmonic_state.noteBuffer)
+
+    def test_replay_zero_timestamp(self):
+        path = os.path.join(self.directory.name, 'zero.session')
+        with SessionWriter(path) as writer:
+            writer.push('note_on', 60, 0.0)
+            writer.push('note_off', 60, 1.0)
+        midi_queue = SessionReader(path).replay(MidiNoteQueue())
+        self.assertEqual([('note_on', 0.0), ('note_off', 1.0)],
+                         [(msg['type'], msg['timestamp']) for msg in midi_queue.get_container()])
+
+    def test_append(self):
+        with open(self.path, 'ab') as file:
+            file.write(b'partial')  # record truncated by a crash
+        with SessionWriter(self.path, index_interval=3) as writer:
+            self.assertEqual(40, len(writer))
+            writer.push('note_on', 72, 30.0)
+        reader = SessionReader(self.path)
+        self.assertEqual(41, len(reader))
+        self.assertEqual([(30.0, 72, 1)], reader.get_range(25, 35).tolist())
+
+    def test_invalid_file(self):
+        path = os.path.join(self.directory.name, 'invalid.session')
+        with open(path, 'wb') as file:
+            file.write(b'not a session file')
+        self.assertRaises(ValueError, SessionReader, path)
+        self.assertRaises(ValueError, SessionWriter, path)
+        with open(path, 'wb') as file:
+            file.write(b'MLSS')
+        self.assertRaises(ValueError, SessionReader, path)
+        self.assertRaises(ValueError, SessionWriter, path)
+        with open(path, 'rb') as file:
+            self.assertEqual(b'MLSS', file.read())
+
+
+class TestInstrumentation(unittest.TestCase):
+    def tearDown(self):
+        disable_instrumentation()
+
+    def test_queue_counters(self):
+        with instrument() as registry:
+            midi_queue = MidiNoteQueue()
+            midi_queue.push('note_on', 60, 1.0)
+            midi_queue.push('note_on', 62, 1.01)  # too close
+            midi_queue.push('note_off', 64, 1.2)  # unmatched
+            midi_queue.push('note_off', 60, 1.5)
+            midi_queue.push('control_change', 60, 1.6)
+        snapshot = registry.snapshot()
+        self.assertEqual({'events_pushed': {'MidiNoteQueue': 2}, 'events_dropped_interval': {'MidiNoteQueue': 1},
+                          'events_dropped_unmatched': {'MidiNoteQueue': 1}, 'events_ignored': {'MidiNoteQueue': 1}},
+                         snapshot['counters'])
+        self.assertEqual({'MidiNoteQueue': 2}, snapshot['gauges']['queue_size'])
+        self.assertEqual(5, snapshot['latencies']['MidiNoteQueue.push']['count'])
+        self.assertEqual((float('inf'), 5), snapshot['latencies']['MidiNoteQueue.push']['buckets'][-1])
+
+    def test_parsers_and_harmonic_state(self):
+        midi_queue = CompactMidiNoteQueue()
+        for i in range(4):
+            midi_queue.push('note_on', 60 + i, 1.0 + i)
+            midi_queue.push('note_off', 60 + i, 1.5 + i)
+        with instrument() as registry:
+            self.assertEqual(['c4', 'r4', 'x4', 'r4', 'l4', 'r4', 'x4'],
+                             parse_melody(midi_queue, 'CM', get_durations(120)))
+            parse_rhythm(midi_queue, get_durations(120))
+            harmonic_state = IncrementalHarmonicState(8)
+            harmonic_state.push_notes(['C', 'E', 'G'])
+            harmonic_state.update_scale()
+        snapshot = registry.snapshot()
+        self.assertEqual({'parse_melody': 8, 'parse_rhythm': 8, 'IncrementalHarmonicState': 3},
+                         dict(snapshot['gauges']['queue_size'], **snapshot['gauges']['buffer_size']))
+        self.assertEqual(1, snapshot['latencies']['parse_rhythm']['count'])
+        self.assertEqual(1, snapshot['latencies']['IncrementalHarmonicState.update_scale']['count'])
+
+    def test_disabled(self):
+        push = MidiNoteQueue.push
+        with instrument():
+            self.assertIsNot(push, MidiNoteQueue.push)
+            self.assertRaises(RuntimeError, enable_instrumentation)
+        self.assertIs(push, MidiNoteQueue.push)
+        self.assertIsNone(get_registry())
+        registry = MetricsRegistry()
+        parse_rhythm(MidiNoteQueue(), get_durations(120))
+        self.assertEqual({'counters': {}, 'gauges': {}, 'latencies': {}}, registry.snapshot())
+
+    def test_prometheus(self):
+        registry = MetricsRegistry(buckets=[0.001, 0.01])
+        registry.increment('events_pushed', 'MidiNoteQueue', 3)
+        registry.set_gauge('queue_size', 'MidiNoteQueue', 3)
+        registry.observe('parse_melody', 0.005)
+        text = registry.to_prometheus()
+        self.assertIn('# TYPE melodically_events_pushed_total counter\n'
+                      'melodically_events_pushed_total{source="MidiNoteQueue"} 3\n', text)
+        self.assertIn('melodically_queue_size{source="MidiNoteQueue"} 3\n', text)
+        self.assertIn('melodically_latency_seconds_bucket{source="parse_melody",le="0.001"} 0\n'
+                      'melodically_latency_seconds_bucket{source="parse_melody",le="0.01"} 1\n'
+                      'melodically_latency_seconds_bucket{source="parse_melody",le="+Inf"} 1\n', text)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'melodically.prom')
+            registry.write_prometheus(path)
+            with open(path) as file:
+                self.assertEqual(text, file.read())
+
+
+class TestMidiFile(unittest.TestCase):
+    def test_write_read(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'take.mid')
+            write_midi_file(path, [midi_note_queue_mock_4], bpm=90)
+            tracks, bpm = read_midi_file(path)
+        self.assertAlmostEqual(90, bpm, places=3)
+        self.assertEqual([], tracks[0])  # tempo track
+        self.assertEqual([(msg['type'], msg['note']) for msg in midi_note_queue_mock_4],
+                         [(msg['type'], msg['note']) for msg in tracks[1]])
+        for msg, expected in zip(tracks[1], midi_note_queue_mock_4):
+            self.assertAlmostEqual(expected['timestamp'], msg['timestamp'], places=2)
+
+    def test_truncated(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'take.mid')
+            write_midi_file(path, [midi_note_queue_mock_4])
+            with open(path, 'rb') as file:
+                data = file.read()
+            for length in [9, 20, len(data) - 1]:
+                with open(path, 'wb') as file:
+                    file.write(data[:length])
+                with self.assertRaises(ValueError):
+                    read_midi_file(path)
+
+
+    @staticmethod
+    def write_track(path, track):
+        # format 0 file with a single track chunk, 480 ticks per beat
+        with open(path, 'wb') as file:
+            file.write(b'MThd' + struct.pack('>IHHH', 6, 0, 1, 480) + b'MTrk' + struct.pack('>I', len(track)) + track)
+
+    def test_truncated_events(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'take.mid')
+            for track in [b'\x00\x90\x3c', b'\x00\xff\x51', b'\x00\xff\x51\x03\x07', b'\x00\xc0', b'\x00\x3c\x40']:
+                self.write_track(path, track)
+                with self.assertRaises(ValueError):
+                    read_midi_file(path)
+
+    def test_drums(self):
+        track = b'\x00\x99\x24\x64\x00\x90\x3c\x64\x83\x60\x89\x24\x00\x00\x80\x3c\x00\x00\xff\x2f\x00'
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'take.mid')
+            self.write_track(path, track)
+            tracks, _ = read_midi_file(path)
+            self.assertEqual([('note_on', 60, 0.0), ('note_off', 60, 0.5)],
+                             [(msg['type'], msg['note'], msg['timestamp']) for msg in tracks[0]])
+            tracks, _ = read_midi_file(path, drums=True)
+            self.assertEqual([36, 60, 36, 60], [msg['note'] for msg in tracks[0]])
+
+
+class TestAnalyzeCorpus(unittest.TestCase):
+    def test_corpus(self):
+        with tempfile.TemporaryDirectory() as directory:
+            write_midi_file(os.path.join(directory, 'a.mid'), [midi_note_queue_mock_4], bpm=60)
+            write_midi_file(os.path.join(directory, 'b.midi'), [midi_note_queue_mock_3, midi_note_queue_mock_2], bpm=60)
+            with open(os.path.join(directory, 'broken.mid'), 'wb') as file:
+                file.write(b'not a midi file')
+            with open(os.path.join(directory, 'truncated.mid'), 'wb') as file:
+                file.write(b'MThd\x00\x00\x00\x06\x00')
+            output_path = os.path.join(directory, 'corpus.npz')
+            stats = analyze_corpus(directory, output_path, processes=2, chunk_size=1)
+            with np.load(output_path) as output:
+                self.assertEqual(['a.mid', 'b.midi', 'b.midi'], [os.path.basename(f) for f in output['path']])
+                self.assertEqual([1, 1, 2], output['track'].tolist())
+                offsets = output['offsets']
+                self.assertEqual('uint16', output['symbols'].dtype.name)
+                symbols = decode_symbols(output['symbols'][offsets[0]:offsets[1]])
+                self.assertEqual(4, len(symbols))
+                self.assertEqual(['1', '16', 'r16', '4'], [s if s[0] == 'r' else s[1:] for s in symbols])
+        self.assertEqual(4, stats['files'])
+        self.assertEqual(3 + 3 + 1, stats['notes'])
+
+    def test_note_at_zero(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'a.mid')
+            first = midi_note_queue_mock_4[0]['timestamp']
+            write_midi_file(path, [[dict(msg, timestamp=msg['timestamp'] - first) for msg in midi_note_queue_mock_4]])
+            tracks = analyze_midi_files([path])
+        self.assertEqual(3, tracks[0]['n_notes'])
+
+
 class TestHarmonicState(unittest.TestCase):
     def setUp(self):
         self.hstate = HarmonicState(8)
@@ -184,6 +1172,180 @@ class TestHarmonicState(unittest.TestCase):
         self.assertEqual(modes_dict['A'][0][5], self.hstate.get_mode_notes())
 
 
+class TestDetectModes(unittest.TestCase):
+    def setUp(self):
+        self.buffers = [
+            ['C', 'D', 'E', 'F', 'G', 'A', 'B', 'C'],
+            ['A', 'A#', 'C', 'D', 'D#', 'F', 'G', 'A'],
+            ['D', 'E', 'F#', 'D', 'A', 'C', 'B', 'D', 'G#'],
+            ['F#', 'F#', 'G', 'A#', 'C#', 'D#'],
+        ]
+
+    def test_same_as_harmonic_affinities(self):
+        # the last buffers have ties between the most common notes
+        buffers = self.buffers + [['D', 'C'], ['G', 'E', 'E', 'G', 'A']]
+        for notes, mode in zip(buffers, detect_modes(buffers)):
+            root = get_root(notes)
+            affinities = harmonic_affinities(root, notes)
+            mode_signature_index = affinities.index(max(affinities))
+            mode_index = affinities[mode_signature_index].index(max(affinities[mode_signature_index]))
+            self.assertEqual({'root': root, 'mode_signature_index': mode_signature_index, 'mode_index': mode_index},
+                             mode)
+
+    def test_batch_affinities(self):
+        notes = self.buffers[2]
+        affinities = batch_harmonic_affinities(pitch_class_histogram(notes))
+        expected = harmonic_affinities('D', notes)
+        for i in range(len(mode_signatures)):
+            for j in range(7):
+                self.assertAlmostEqual(expected[i][j], affinities[0, 2, i, j])
+
+    def test_empty_buffer(self):
+        self.assertEqual([None], detect_modes([[]]))
+
+    def test_root_ties(self):
+        self.assertEqual('C', get_root(['D', 'C']))
+        self.assertEqual('C', detect_modes([['D', 'C']])[0]['root'])
+        hstate = HarmonicState(2)
+        hstate.push_notes(['D', 'C'])
+        self.assertEqual('C', hstate.update_scale()['root'])
+
+
+class TestSearchModes(unittest.TestCase):
+    def test_tonic_not_most_common(self):
+        # the most common note is E, but the melody is in C ionian
+        notes = ['C', 'E', 'G', 'E', 'G', 'E', 'C', 'D', 'F', 'E', 'G', 'C', 'B', 'A']
+        self.assertEqual('E', detect_modes([notes])[0]['root'])
+        best = search_modes([notes], k=1)[0][0]
+        self.assertEqual(('C', 0, 0), (best['root'], best['mode_signature_index'], best['mode_index']))
+        self.assertEqual(modes_dict['C'][0][0], best['notes'])
+
+    def test_extended_signatures(self):
+        best = search_modes([['A', 'B', 'C', 'D', 'E', 'F', 'G#', 'A', 'E', 'C']], k=1)[0][0]
+        self.assertEqual(['A', 'B', 'C', 'D', 'E', 'F', 'G#'], best['notes'])
+        self.assertEqual([2, 1, 2, 2, 1, 3, 1], extended_mode_signatures[best['mode_signature_index']])
+        self.assertEqual(mode_signatures, extended_mode_signatures[:len(mode_signatures)])
+
+    def test_affinities_and_confidences(self):
+        notes = ['D', 'E', 'F#', 'D', 'A', 'C', 'B', 'D', 'G#']
+        modes = search_modes([notes], k=None, signatures=mode_signatures)[0]
+        self.assertEqual(12 * len(mode_signatures) * 7, len(modes))
+        self.assertAlmostEqual(1, sum(mode['confidence'] for mode in modes))
+        affinities = [mode['affinity'] for mode in modes]
+        self.assertEqual(sorted(affinities, reverse=True), affinities)
+        for mode in modes[:5]:
+            expected = sum(search_degree_weights[mode['notes'].index(note)] if note in mode['notes']
+                           else -affinity_negative_weight for note in notes) / len(notes)
+            self.assertAlmostEqual(expected, mode['affinity'])
+
+    def test_harmonic_states(self):
+        notes = ['C', 'E', 'G', 'E', 'G', 'E', 'C', 'D', 'F', 'E', 'G', 'C', 'B', 'A']
+        expected = search_modes([notes], k=3)[0]
+        for hstate in [HarmonicState(20), IncrementalHarmonicState(20),
+                       DecayingHarmonicState(half_life=float('inf'), decay='notes')]:
+            hstate.push_notes(notes)
+            self.assertEqual(expected, hstate.search_modes(k=3))
+
+    def test_empty_and_invalid(self):
+        self.assertEqual([[]], search_modes([[]]))
+        self.assertRaises(ValueError, search_modes, [['C']], 1, [[2, 2, 2, 2, 2, 2]])
+        self.assertRaises(ValueError, search_modes, [['C']], 0)
+        self.assertRaises(ValueError, search_modes, [['C']], 1, None, 0)
+        self.assertRaises(ValueError, search_modes, [['C']], 1, None, -0.5)
+
+
+class TestIncrementalHarmonicState(unittest.TestCase):
+    def setUp(self):
+        self.hstate = IncrementalHarmonicState(8)
+
+    def test_C_ionic(self):
+        self.hstate.push_notes(['C', 'D', 'E', 'F', 'G', 'A', 'B', 'C'])
+        self.assertEqual(modes_dict['C'][0][0], self.hstate.get_mode_notes())
+
+    def test_A_locrian(self):
+        self.hstate.push_notes(['A', 'A#', 'C', 'D', 'D#', 'F', 'G', 'A'])
+        self.assertEqual(modes_dict['A'][0][6], self.hstate.get_mode_notes())
+
+    def test_overflow(self):
+        self.hstate.push_notes(['F#', 'F#', 'F#', 'C#'])
+        self.hstate.push_notes(['A', 'B', 'C', 'D', 'E', 'F', 'G', 'A'])
+        self.assertEqual(['A', 'B', 'C', 'D', 'E', 'F', 'G', 'A'], self.hstate.noteBuffer)
+        self.assertEqual(modes_dict['A'][0][5], self.hstate.get_mode_notes())
+
+    def test_same_as_harmonic_state(self):
+        reference = HarmonicState(5)
+        hstate = IncrementalHarmonicState(5)
+        notes = ['D', 'E', 'F#', 'D', 'A', 'C', 'B', 'D', 'G#', 'G', 'G', 'C#']
+        for note in notes:
+            reference.push_notes([note])
+            hstate.push_note(note)
+            self.assertEqual(reference.noteBuffer, hstate.noteBuffer)
+            self.assertEqual(reference.update_scale(), hstate.update_scale())
+
+
+class TestDecayingHarmonicState(unittest.TestCase):
+    def test_same_as_harmonic_state(self):
+        # without decay, the weights are the counts of all the notes
+        for notes in [['C', 'D', 'E', 'F', 'G', 'A', 'B', 'C'], ['A', 'A#', 'C', 'D', 'D#', 'F', 'G', 'A'],
+                      ['D', 'E', 'F#', 'D', 'A', 'C', 'B', 'D', 'G#'], ['F#', 'F#', 'G', 'A#', 'C#', 'D#']]:
+            hstate = HarmonicState(100)
+            hstate.push_notes(notes)
+            decaying_hstate = DecayingHarmonicState(half_life=float('inf'), decay='notes')
+            decaying_hstate.push_notes(notes)
+            self.assertEqual(hstate.update_scale(), decaying_hstate.update_scale())
+
+    def test_note_decay(self):
+        hstate = DecayingHarmonicState(half_life=1, decay='notes')
+        hstate.push_notes(['C', 'D', 'D'])
+        self.assertEqual([0.25, 0, 1.5], hstate.get_histogram()[:3].tolist())
+        self.assertEqual(['D'], hstate.noteBuffer)
+
+    def test_time_decay(self):
+        hstate = DecayingHarmonicState(half_life=2)
+        hstate.push_note('C', 1.0)
+        hstate.push_note('D', 3.0)
+        self.assertEqual([0.5, 0, 1], hstate.get_histogram()[:3].tolist())
+        hstate.advance(5.0)
+        self.assertEqual([0.25, 0, 0.5], hstate.get_histogram()[:3].tolist())
+
+    def test_zero_timestamp(self):
+        hstate = DecayingHarmonicState(half_life=2)
+        hstate.push_note('C', 0.0)
+        hstate.advance(2.0)
+        self.assertEqual([0.5], hstate.get_histogram()[:1].tolist())
+
+    def test_old_notes_fade(self):
+        hstate = DecayingHarmonicState(half_life=2)
+        hstate.push_clusters([{'timestamp': 1.0 + i, 'notes': [60 + n]} for i, n in enumerate([0, 2, 4, 5, 7, 0])])
+        self.assertEqual('C', hstate.update_scale()['root'])
+        for i, note in enumerate(['A', 'B', 'C', 'D', 'E', 'A', 'F', 'G', 'A']):
+            hstate.push_note(note, 20.0 + i)
+        self.assertEqual({'root': 'A', 'mode_signature_index': 0, 'mode_index': 5}, hstate.update_scale())
+
+    def test_hysteresis(self):
+        for hysteresis, expected_mode_index in [(0, 1), (0.5, 0)]:
+            hstate = DecayingHarmonicState(half_life=8, decay='notes', hysteresis=hysteresis)
+            hstate.push_notes(['C', 'D', 'E', 'F', 'G', 'A', 'B', 'C'])
+            self.assertEqual({'root': 'C', 'mode_signature_index': 0, 'mode_index': 0}, hstate.update_scale())
+            hstate.push_notes(['D', 'D', 'D', 'D', 'D'])
+            self.assertEqual(expected_mode_index, hstate.update_scale()['mode_index'])
+
+    def test_many_streams(self):
+        hstates = [DecayingHarmonicState(half_life=3, decay='notes') for _ in range(3)]
+        for k, hstate in enumerate(hstates):
+            hstate.push_notes([musical_notes[(k * 5 + i * 2) % 12] for i in range(10)])
+        self.assertEqual([hstate.update_scale() for hstate in hstates],
+                         detect_histogram_modes([hstate.get_histogram() for hstate in hstates]))
+
+    def test_invalid_decay(self):
+        self.assertRaises(ValueError, DecayingHarmonicState, 4.0, 'beats')
+
+    def test_invalid_parameters(self):
+        for half_life in [0, -1, float('nan')]:
+            self.assertRaises(ValueError, DecayingHarmonicState, half_life)
+        self.assertRaises(ValueError, DecayingHarmonicState, 4.0, 'notes', -0.1)
+
+
 class TestSequenceFitsMeasures(unittest.TestCase):
     def test_sequence1(self):
         sequence = ['4', '4', '4', '4']
@@ -240,6 +1402,58 @@ class TestClipRhythmicSequence(unittest.TestCase):
         clip_rhythmic_sequence(sequence, 1)
         self.assertEqual(['1', '1', '1', '1'], sequence)
 
+    def test_prefix_sums(self):
+        sequence = ['1', '4', 'r8', '8t', '16']
+        prefix_sums = rhythmic_prefix_sums(sequence)
+        self.assertEqual([0, 48, 60, 66, 70, 73], prefix_sums)
+        self.assertEqual(['1', '4', 'r8', '8t'], clip_rhythmic_sequence(sequence, 1.5, prefix_sums))
+
+    def test_triplets(self):
+        sequence = ['4t'] * 7
+        self.assertEqual(['4t'] * 6, clip_rhythmic_sequence(sequence, 1))
+
+
+class TestSplitMeasures(unittest.TestCase):
+    def test_split(self):
+        sequence = ['2', '4', 'r4', '8', '8', '2', '4', '4']
+        self.assertEqual([['2', '4', 'r4'], ['8', '8', '2', '4'], ['4']], split_measures(sequence))
+
+    def test_crossing_symbols(self):
+        sequence = ['2', '4', '2', '1', '4']
+        self.assertEqual([['2', '4', '2'], ['1'], ['4']], split_measures(sequence))
+        self.assertEqual([['1'], ['r1'], ['4']], split_measures(['1', 'r1', '4']))
+        self.assertEqual([], split_measures([]))
+
+
+class TestFitRhythmicSequence(unittest.TestCase):
+    def test_already_fitting(self):
+        sequence = ['4', '8', '8', '2']
+        self.assertEqual(sequence, fit_rhythmic_sequence(sequence, 1))
+
+    def test_minimal_change(self):
+        sequence = ['4', '4', '4', '4dot']
+        result = fit_rhythmic_sequence(sequence, 1)
+        self.assertEqual(measure_ticks, sum(symbol_ticks(s) for s in result))
+        self.assertEqual(1, sum(a != b for a, b in zip(result, sequence)))
+
+    def test_rests(self):
+        result = fit_rhythmic_sequence(['r2', '4', '4', '4'], 1)
+        self.assertTrue(result[0].startswith('r'))
+        self.assertEqual(measure_ticks, sum(symbol_ticks(s) for s in result))
+
+    def test_impossible(self):
+        self.assertIsNone(fit_rhythmic_sequence(['16'] * 30, 1))
+        self.assertIsNone(fit_rhythmic_sequence(['1'], 2))
+
+    def test_fractional_measures(self):
+        self.assertEqual(['4', '8', '8'], fit_rhythmic_sequence(['4', '8', '8'], 0.5))
+        result = fit_rhythmic_sequence(['4', '4'], 0.625)
+        self.assertEqual(30, sum(symbol_ticks(s) for s in result))
+        self.assertEqual(['4', '4dot'], sorted(result))
+        for measures in [0.1, 1 / 5, -1]:
+            with self.assertRaises(ValueError):
+                fit_rhythmic_sequence(['4'], measures)
+
 
 if __name__ == '__main__':
     unittest.main()